@@ -0,0 +1,9 @@
+'''
+Benchmarks for the Nuke command server interface.
+
+These run the server in-process against the stub 'nuke' module in
+benchmarks/stub, so they do not need a copy of Nuke. Run them from the
+directory containing the nukeExternalControl package, e.g.:
+
+    python -m benchmarks.bench_connection
+'''
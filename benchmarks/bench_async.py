@@ -0,0 +1,71 @@
+'''
+Time taken to poll many servers from one thread, one request at a time
+with NukeConnection compared to all at once with NukeAsyncConnection, and
+the throughput of one connection with many requests in flight.
+
+Each poll stands in for a request that keeps Nuke busy for a little while,
+such as a dashboard asking each artist's session for its status.
+'''
+
+import sys
+import time
+
+from benchmarks import harness
+from nukeExternalControl import server
+
+
+def session_status(work):
+    time.sleep(work)
+    return {'nodes': len(harness.nuke.allNodes()), 'time': time.time()}
+
+def poll_each(connections, work):
+    return [conn.call_action("session_status", work) for conn in connections]
+
+def poll_async(connections, work):
+    futures = [conn.call_action_async("session_status", work) for conn in connections]
+    return [future.result() for future in futures]
+
+def time_polls(poll, connections, work, count):
+    row = harness.time_calls(lambda: poll(connections, work), count)
+    row['median_ms'] = row['median_us'] / 1e3
+    row['p95_ms'] = row['p95_us'] / 1e3
+    return row
+
+def main(servers=30, work=0.005, count=20):
+    server.register_action("session_status", session_status, main_thread=False)
+    ports = [harness.start_server() for i in xrange(servers)]
+
+    rows = []
+    for name, connection_class, poll in [("one at a time", harness.client.NukeConnection, poll_each),
+                                         ("async", harness.client.NukeAsyncConnection, poll_async)]:
+        connections = [connection_class(port) for port in ports]
+        row = time_polls(poll, connections, work, count)
+        row['mode'] = name
+        row['servers'] = servers
+        rows.append(row)
+        for conn in connections:
+            conn.close()
+    harness.print_table("Polling servers (%.0fms of work each)" % (work * 1e3), rows,
+                        ['mode', 'servers', 'median_ms', 'p95_ms'])
+
+    rows = []
+    for name, connection_class, poll in [("one at a time", harness.client.NukeConnection, poll_each),
+                                         ("async", harness.client.NukeAsyncConnection, poll_async)]:
+        conn = connection_class(ports[0])
+        row = time_polls(poll, [conn] * servers, work, count)
+        row['mode'] = name
+        row['requests'] = servers
+        rows.append(row)
+        conn.close()
+    harness.print_table("Requests on one connection", rows,
+                        ['mode', 'requests', 'median_ms', 'p95_ms'])
+
+    for port in ports:
+        harness.stop_server(port)
+    server.unregister_action("session_status")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
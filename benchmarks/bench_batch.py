@@ -0,0 +1,49 @@
+'''
+Setting knobs on many nodes one round trip at a time, compared to
+sending the same operations as a single batch.
+'''
+
+import sys
+import time
+
+from benchmarks import harness
+
+
+def set_knobs_sequentially(conn, nodes):
+    for i, node in enumerate(nodes):
+        node['disable'].setValue(bool(i % 2))
+        node.setName("Sequential%d" % i)
+
+def set_knobs_in_batch(conn, nodes):
+    batch = conn.batch()
+    for i, node in enumerate(nodes):
+        node = batch.wrap(node)
+        node['disable'].setValue(bool(i % 2))
+        node.setName("Batched%d" % i)
+    batch.run()
+
+def main(node_count=200):
+    port = harness.start_server()
+    conn = harness.client.NukeConnection(port)
+    nuke = conn.nuke
+    nuke.scriptClear()
+    for i in xrange(node_count):
+        nuke.createNode("Blur")
+    nodes = nuke.allNodes()
+
+    rows = []
+    for name, func in [('sequential', set_knobs_sequentially), ('batch', set_knobs_in_batch)]:
+        start = time.time()
+        func(conn, nodes)
+        rows.append({'mode': name, 'nodes': node_count, 'total_ms': 1e3 * (time.time() - start)})
+    harness.print_table("Setting a knob and the name of %d nodes" % node_count, rows,
+                        ['mode', 'nodes', 'total_ms'])
+    del nodes, nuke
+    conn.close()
+    harness.stop_server(port)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,60 @@
+'''
+Processing many scripts one at a time through a single managed server,
+compared to spreading them across a cluster of managed servers.
+Each script takes a fixed amount of time to process inside Nuke.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import harness
+from nukeExternalControl.client import NukeCommandManager, NukeCluster
+
+
+def process_script(path, seconds):
+    import time
+    time.sleep(seconds)
+    return len(nuke.allNodes())
+
+def write_scripts(directory, count):
+    paths = []
+    for i in xrange(count):
+        path = os.path.join(directory, "script%d.nk" % i)
+        f = open(path, 'w')
+        f.write("Blur\n" * (i % 10))
+        f.close()
+        paths.append(path)
+    return paths
+
+def main(script_count=40, cluster_size=4, seconds=0.05):
+    directory = tempfile.mkdtemp()
+    try:
+        paths = write_scripts(directory, script_count)
+        rows = []
+
+        start = time.time()
+        with NukeCommandManager() as conn:
+            for path in paths:
+                conn.nuke.scriptOpen(path)
+                conn.run(process_script, path, seconds)
+        rows.append({'mode': 'one server', 'scripts': script_count, 'total_s': time.time() - start})
+
+        start = time.time()
+        with NukeCluster(cluster_size) as cluster:
+            for path, result in cluster.map(process_script, paths, seconds, scripts=True):
+                pass
+        rows.append({'mode': 'cluster of %d' % cluster_size, 'scripts': script_count, 'total_s': time.time() - start})
+
+        harness.print_table("Processing scripts (%.0fms each), including server start up" % (1e3 * seconds), rows,
+                            ['mode', 'scripts', 'total_s'])
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,142 @@
+'''
+Bytes on the wire and latency for replies of various sizes, with and
+without compression, over loopback and through a proxy that limits the
+bandwidth to simulate a connection to a server on another machine.
+
+The replies are text in the style of a Nuke script, such as
+nodesToString() or writeKnobs() return.
+'''
+
+import random
+import socket
+import sys
+import threading
+import time
+
+from benchmarks import harness
+from nukeExternalControl import server
+
+
+# Simulated links, in bytes per second (None for plain loopback)
+LINKS = [
+    ("loopback", None),
+    ("1 Gbit", 125 * 1000 * 1000),
+    ("100 Mbit", 12.5 * 1000 * 1000),
+    ("10 Mbit", 1.25 * 1000 * 1000),
+]
+
+PAYLOAD_SIZES = [1024, 64 * 1024, 1024 * 1024]
+
+_payloads = {}
+
+def script_text(size):
+    '''
+    Get roughly 'size' bytes of text that looks like a Nuke script
+    '''
+    text = _payloads.get(size)
+    if text is None:
+        rand = random.Random(size)
+        nodes = []
+        length = 0
+        while length < size:
+            node = "Blur {\n size %.3f\n channels rgba\n mix %.4f\n name Blur%d\n xpos %d\n ypos %d\n}\n" % (
+                rand.uniform(0, 100), rand.random(), len(nodes), rand.randint(-5000, 5000), rand.randint(-5000, 5000))
+            nodes.append(node)
+            length += len(node)
+        text = _payloads[size] = "".join(nodes)[:size]
+    return text
+
+
+class ThrottlingProxy(object):
+    '''
+    Forwards connections to a server, passing on at most 'bandwidth' bytes
+    per second in each direction
+    '''
+    def __init__(self, target_port, bandwidth):
+        self.target_port = target_port
+        self.bandwidth = bandwidth
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('localhost', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        t = threading.Thread(target=self.accept)
+        t.setDaemon(True)
+        t.start()
+
+    def accept(self):
+        while True:
+            try:
+                source, address = self.listener.accept()
+            except socket.error:
+                return
+            target = socket.create_connection(('localhost', self.target_port))
+            for a, b in [(source, target), (target, source)]:
+                a.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                t = threading.Thread(target=self.pump, args=(a, b))
+                t.setDaemon(True)
+                t.start()
+
+    def pump(self, source, target):
+        # Data is let through as fast as the link would carry it, measured
+        # from when it first started to queue up
+        available = time.time()
+        try:
+            while True:
+                data = source.recv(64 * 1024)
+                if not data:
+                    break
+                available = max(available, time.time()) + len(data) / float(self.bandwidth)
+                delay = available - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                target.sendall(data)
+        except socket.error:
+            pass
+        source.close()
+        target.close()
+
+    def close(self):
+        self.listener.close()
+
+
+def main(count=20):
+    server.register_action("script_text", script_text, main_thread=False)
+    port = harness.start_server()
+
+    rows = []
+    for link, bandwidth in LINKS:
+        link_port = port
+        proxy = None
+        if bandwidth is not None:
+            proxy = ThrottlingProxy(port, bandwidth)
+            link_port = proxy.port
+        for size in PAYLOAD_SIZES:
+            script_text(size)
+            for compression in [False, True]:
+                conn = harness.client.NukeConnection(link_port, compression=compression, instrument=True)
+                conn.actions.script_text(size)
+                conn.instrumentation.reset()
+                stats = harness.time_calls(lambda: conn.actions.script_text(size), count)
+                entry = conn.instrumentation.snapshot()['actions']['script_text']
+                rows.append({
+                    'link': link,
+                    'payload_kb': size / 1024.0,
+                    'compression': compression,
+                    'wire_kb': entry['bytes_in'] / 1024.0 / entry['count'],
+                    'median_ms': stats['median_us'] / 1e3,
+                    'p95_ms': stats['p95_us'] / 1e3,
+                })
+                conn.close()
+        if proxy is not None:
+            proxy.close()
+
+    harness.print_table("Replies of Nuke script text (%d calls each)" % count, rows,
+                        ['link', 'payload_kb', 'compression', 'wire_kb', 'median_ms', 'p95_ms'])
+    harness.stop_server(port)
+    server.unregister_action("script_text")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
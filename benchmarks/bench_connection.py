@@ -0,0 +1,48 @@
+'''
+Round-trip latency with a new connection per request (the behaviour
+before persistent sessions) compared to a single persistent session.
+'''
+
+import sys
+
+from benchmarks import harness
+
+
+def measure(conn, reconnect, count):
+    # Objects only live as long as the session they were passed to, so
+    # stick to actions on the globals that work across reconnections
+    operations = [
+        ('test', lambda: conn.get('test')),
+        ('getitem', lambda: conn.DEFAULT_START_PORT),
+        ('setitem', lambda: conn.set_object_item(-1, 'bench_value', 1.0)),
+    ]
+
+    rows = []
+    for name, operation in operations:
+        if reconnect:
+            def func(operation = operation):
+                conn.close()
+                return operation()
+        else:
+            func = operation
+        row = harness.time_calls(func, count)
+        row['action'] = name
+        row['session'] = reconnect and "per-request" or "persistent"
+        rows.append(row)
+    return rows
+
+def main(count=2000):
+    port = harness.start_server()
+    conn = harness.client.NukeConnection(port)
+
+    rows = measure(conn, True, count) + measure(conn, False, count)
+    harness.print_table("Round-trip latency (%d calls each)" % count, rows,
+                        ['action', 'session', 'mean_us', 'median_us', 'p95_us'])
+    conn.close()
+    harness.stop_server(port)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,52 @@
+'''
+Time taken for a client to find a server with no port given, when the
+server is on the last port in the default range: through the registry,
+by probing every port at once, and by testing each port in turn (the
+behaviour before the registry).
+'''
+
+import sys
+
+from benchmarks import harness
+from nukeExternalControl import common
+from nukeExternalControl.client import NukeConnection
+
+
+class SequentialConnection(NukeConnection):
+    '''
+    Tests each port in turn, as clients did before the registry
+    '''
+    def find_registered_port(self, start_port, end_port):
+        return -1
+
+    def find_connection_port(self, start_port, end_port):
+        for port in range(start_port, end_port + 1):
+            self._port = port
+            if self.test_connection():
+                return port
+        return -1
+
+class ProbingConnection(NukeConnection):
+    def find_registered_port(self, start_port, end_port):
+        return -1
+
+def main(count=20):
+    port = harness.start_server(port=common.DEFAULT_END_PORT)
+    rows = []
+    for name, connection_class in [('registry', NukeConnection), ('probe', ProbingConnection), ('sequential', SequentialConnection)]:
+        def connect():
+            conn = connection_class()
+            assert conn._port == port
+            conn.close()
+        row = harness.time_calls(connect, count)
+        row['discovery'] = name
+        rows.append(row)
+    harness.print_table("Finding a server on port %d (%d connections each)" % (port, count), rows,
+                        ['discovery', 'mean_us', 'median_us', 'p95_us'])
+    harness.stop_server(port)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,52 @@
+'''
+Latency of calls into Nuke made directly (as in a terminal Nuke) compared
+to hopping to the main thread for each one (as in a GUI Nuke), and a batch
+of the same calls sharing a single hop.
+'''
+
+import sys
+import time
+
+from benchmarks import harness
+
+
+def measure(conn, direct, count):
+    node = conn.nuke.createNode("Blur")
+    rows = []
+
+    row = harness.time_calls(lambda: node.name(), count)
+    row['calls'] = "one per request"
+    row['dispatch'] = direct and "direct" or "main thread"
+    rows.append(row)
+
+    batch_size = 50
+    def run_batch():
+        batch = conn.batch()
+        wrapped = batch.wrap(node)
+        for i in xrange(batch_size):
+            wrapped.name()
+        batch.run()
+    row = harness.time_calls(run_batch, max(1, count / batch_size))
+    for key in ['mean_us', 'median_us', 'p95_us']:
+        row[key] /= batch_size
+    row['calls'] = "%d per batch" % batch_size
+    row['dispatch'] = direct and "direct" or "main thread"
+    rows.append(row)
+    return rows
+
+def main(count=2000):
+    rows = []
+    for direct in [False, True]:
+        port = harness.start_server(direct_calls=direct)
+        conn = harness.client.NukeConnection(port)
+        rows += measure(conn, direct, count)
+        conn.close()
+        harness.stop_server(port)
+    harness.print_table("Latency per call into Nuke (%d calls each)" % count, rows,
+                        ['dispatch', 'calls', 'mean_us', 'median_us', 'p95_us'])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,68 @@
+'''
+Time to first command for a managed server started from scratch,
+compared to one forked from a running zygote, along with the median
+time to each event in the managers' start up timelines.
+
+Managed servers run the stub Nuke executable, which waits for
+$NUKE_STUB_STARTUP_DELAY seconds (0.5 by default here) to mimic Nuke's
+start up time.
+'''
+
+import os
+import sys
+import time
+
+from benchmarks import harness
+from nukeExternalControl.client import NukeCommandManager, NukeZygote
+
+os.environ.setdefault('NUKE_STUB_STARTUP_DELAY', '0.5')
+
+
+TIMELINE_EVENTS = ['spawn', 'interpreter_up', 'port_bound', 'callback', 'first_command']
+
+def time_to_first_command(make_manager, count):
+    samples = []
+    timelines = []
+    for i in xrange(count):
+        start = time.time()
+        manager = make_manager()
+        conn = manager.start()
+        conn.nuke.createNode("Blur")
+        samples.append(time.time() - start)
+        timelines.append(manager.timeline)
+        manager.stop()
+    samples.sort()
+    row = {
+        'count': count,
+        'mean_ms': 1e3 * sum(samples) / count,
+        'median_ms': 1e3 * samples[count // 2],
+        'max_ms': 1e3 * samples[-1],
+    }
+    for event in TIMELINE_EVENTS:
+        times = sorted([timeline[event] for timeline in timelines])
+        row[event] = 1e3 * times[count // 2]
+    return row
+
+def main(count=10):
+    rows = []
+    row = time_to_first_command(NukeCommandManager, count)
+    row['server'] = "cold start"
+    rows.append(row)
+
+    start = time.time()
+    zygote = NukeZygote().start()
+    zygote_start = time.time() - start
+    row = time_to_first_command(zygote.manager, count)
+    row['server'] = "forked"
+    rows.append(row)
+    zygote.stop()
+
+    harness.print_table("Time to first command (zygote started in %.0fms)" % (1e3 * zygote_start), rows,
+                        ['server', 'count', 'mean_ms', 'median_ms', 'max_ms'])
+    harness.print_table("Median start up timeline (ms since spawn)", rows, ['server'] + TIMELINE_EVENTS)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,54 @@
+'''
+Round trips, time taken and the most node proxies held by the client at
+once when visiting every node in a large script, getting nuke.allNodes()
+as a whole compared to iterating over it a page at a time.
+'''
+
+import sys
+import time
+
+from benchmarks import harness
+
+
+def visit_nodes(conn, page_size):
+    nuke = conn.nuke
+    if page_size is None:
+        nodes = nuke.allNodes()
+    else:
+        nodes = conn.iterate(nuke.allNodes, page_size=page_size)
+    most_proxies = 0
+    for node in nodes:
+        node.name()
+        most_proxies = max(most_proxies, len(conn._proxies))
+    return most_proxies
+
+def main(node_count=5000):
+    port = harness.start_server()
+    conn = harness.client.NukeConnection(port, prefetch_schema=True)
+    conn.nuke.scriptClear()
+    conn.execute("for i in range(%d): nuke.createNode('Blur')" % node_count)
+    conn.close()
+
+    rows = []
+    for page_size in [None, 10, 100, 1000]:
+        conn = harness.client.NukeConnection(port, prefetch_schema=True)
+        conn.nuke
+        start_round_trips = conn.round_trips
+        start = time.time()
+        most_proxies = visit_nodes(conn, page_size)
+        rows.append({
+            'page_size': page_size or "whole list",
+            'round_trips': conn.round_trips - start_round_trips,
+            'total_ms': 1e3 * (time.time() - start),
+            'most_proxies': most_proxies,
+        })
+        conn.close()
+    harness.print_table("Visiting %d nodes" % node_count, rows,
+                        ['page_size', 'round_trips', 'total_ms', 'most_proxies'])
+    harness.stop_server(port)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
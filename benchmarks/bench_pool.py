@@ -0,0 +1,52 @@
+'''
+Time taken by many short 'with' blocks that each start their own managed
+server, compared to the same blocks leasing servers from a warm pool.
+
+Managed servers run the stub Nuke executable, which waits for
+$NUKE_STUB_STARTUP_DELAY seconds (0.5 by default here) to mimic Nuke's
+start up time.
+'''
+
+import os
+import sys
+import time
+
+from benchmarks import harness
+from nukeExternalControl.client import NukeCommandManager, NukeServerPool
+
+os.environ.setdefault('NUKE_STUB_STARTUP_DELAY', '0.5')
+
+
+def job(conn):
+    nuke = conn.nuke
+    blur = nuke.createNode("Blur")
+    blur['disable'].setValue(True)
+    return len(nuke.allNodes())
+
+def main(block_count=20, pool_size=2):
+    rows = []
+
+    start = time.time()
+    for i in xrange(block_count):
+        with NukeCommandManager() as conn:
+            job(conn)
+    rows.append({'mode': 'per block', 'warm_up_s': 0.0, 'blocks': block_count, 'total_s': time.time() - start})
+
+    start = time.time()
+    pool = NukeServerPool(pool_size)
+    warm = time.time() - start
+    for i in xrange(block_count):
+        with pool.lease() as conn:
+            job(conn)
+    rows.append({'mode': 'pool of %d' % pool_size, 'warm_up_s': warm, 'blocks': block_count, 'total_s': time.time() - start})
+    report = pool.report()
+    pool.close()
+
+    harness.print_table("%d short 'with' blocks" % block_count, rows, ['mode', 'blocks', 'warm_up_s', 'total_s'])
+    harness.print_table("Pool report", [report], ['leases', 'started', 'recycled', 'mean_wait_time', 'utilisation'])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,92 @@
+'''
+Time taken and peak memory used by large plain-data results and
+requests, with objects swapped for proxies while messages are serialized
+(persistent ids) compared to copying every message with the proxies
+swapped in first.
+
+Each measurement is made in a fresh process, so that peak memory use
+(which covers both the client and the in-process server) can be compared.
+'''
+
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from benchmarks import harness
+from nukeExternalControl import server
+
+
+def floats(count):
+    return [i * 0.5 for i in xrange(count)]
+
+def records(count):
+    return [{'name': "Blur%d" % i, 'size': i * 0.5, 'disable': False} for i in xrange(count)]
+
+def nested(depth):
+    data = []
+    for i in xrange(depth):
+        data = [i, data]
+    return data
+
+PAYLOADS = [
+    ("100k floats", floats, 100000),
+    ("1M floats", floats, 1000000),
+    ("100k dicts", records, 100000),
+    ("nested 900 deep", nested, 900),
+]
+
+def peak_memory():
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+def measure(name, persistent_ids, count):
+    '''
+    Time getting and sending a payload, in this process
+    '''
+    func, size = [(func, size) for payload, func, size in PAYLOADS if payload == name][0]
+    server.register_action("payload", func, main_thread=False)
+    port = harness.start_server()
+    conn = harness.client.NukeConnection(port, persistent_ids=persistent_ids)
+    baseline = peak_memory()
+
+    start = time.time()
+    for i in xrange(count):
+        data = conn.actions.payload(size)
+    get_ms = 1e3 * (time.time() - start) / count
+    start = time.time()
+    for i in xrange(count):
+        conn.evaluate("len(data)", data=data)
+    send_ms = 1e3 * (time.time() - start) / count
+
+    return {
+        'payload': name,
+        'persistent_ids': persistent_ids,
+        'get_ms': get_ms,
+        'send_ms': send_ms,
+        'peak_mb': (peak_memory() - baseline) / 1024.0,
+    }
+
+def main(count=5):
+    rows = []
+    for name, func, size in PAYLOADS:
+        for persistent_ids in [False, True]:
+            output = subprocess.check_output([sys.executable, "-m", "benchmarks.bench_recode", "--measure",
+                                              name, str(int(persistent_ids)), str(count)])
+            rows.append(eval(output.strip().splitlines()[-1]))
+    harness.print_table("Plain data results and requests (%d each)" % count, rows,
+                        ['payload', 'persistent_ids', 'get_ms', 'send_ms', 'peak_mb'])
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        print repr(measure(sys.argv[2], bool(int(sys.argv[3])), int(sys.argv[4])))
+        sys.stdout.flush()
+        os._exit(0)
+    elif len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,55 @@
+'''
+Time taken to get the RGBA samples of a region of an image, calling
+node.sample() for each one compared to getting them all with a single
+conn.sample() request.
+'''
+
+import sys
+import time
+
+from benchmarks import harness
+
+
+CHANNELS = ["rgba.red", "rgba.green", "rgba.blue", "rgba.alpha"]
+
+def sample_each(conn, node, size):
+    samples = []
+    for y in xrange(size):
+        for x in xrange(size):
+            for channel in CHANNELS:
+                samples.append(node.sample(channel, x + 0.5, y + 0.5))
+    return samples
+
+def sample_region(conn, node, size):
+    return conn.sample(node, CHANNELS, 0, 0, size, size).array()
+
+def main(size=32):
+    port = harness.start_server()
+    conn = harness.client.NukeConnection(port, prefetch_schema=True)
+    node = conn.nuke.createNode("Read")
+
+    rows = []
+    for name, func, region in [("node.sample()", sample_each, size), ("conn.sample()", sample_region, size),
+                               ("conn.sample()", sample_region, size * 8)]:
+        start_round_trips = conn.round_trips
+        start = time.time()
+        samples = func(conn, node, region)
+        total = time.time() - start
+        rows.append({
+            'method': name,
+            'region': "%dx%d" % (region, region),
+            'samples': len(samples),
+            'round_trips': conn.round_trips - start_round_trips,
+            'total_ms': 1e3 * total,
+            'us_per_sample': 1e6 * total / len(samples),
+        })
+    conn.close()
+    harness.print_table("Sampling %d channels" % len(CHANNELS), rows,
+                        ['method', 'region', 'samples', 'round_trips', 'total_ms', 'us_per_sample'])
+    harness.stop_server(port)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
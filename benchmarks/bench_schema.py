@@ -0,0 +1,45 @@
+'''
+Round trips and time taken by a typical script with and without
+schema prefetching.
+'''
+
+import sys
+import time
+
+from benchmarks import harness
+
+
+def script(conn, node_count):
+    nuke = conn.nuke
+    nuke.scriptClear()
+    for i in xrange(node_count):
+        conn.nuke.createNode("Blur")
+    for node in nuke.allNodes():
+        same = nuke.toNode(node.name())
+        same.setSelected(same.Class() == "Blur")
+    return len(nuke.selectedNodes())
+
+def main(node_count=200):
+    port = harness.start_server()
+
+    rows = []
+    for prefetch in [False, True]:
+        conn = harness.client.NukeConnection(port, prefetch_schema=prefetch)
+        start_round_trips = conn.round_trips
+        start = time.time()
+        script(conn, node_count)
+        rows.append({
+            'prefetch': prefetch,
+            'round_trips': conn.round_trips - start_round_trips,
+            'total_ms': 1e3 * (time.time() - start),
+        })
+        conn.close()
+    harness.print_table("Script touching %d nodes" % node_count, rows,
+                        ['prefetch', 'round_trips', 'total_ms'])
+    harness.stop_server(port)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,59 @@
+'''
+Payload size and encode/decode time for each serializer that can be
+negotiated, plus the round-trip time of fetching the same payloads from
+a server with each serializer forced.
+'''
+
+import sys
+
+from benchmarks import harness
+from nukeExternalControl.common import SERIALIZERS, SERIALIZER_PREFERENCE
+
+
+def payloads():
+    return [
+        ('knob array', [i * 0.25 for i in xrange(100000)]),
+        ('curve data', [(float(f), f * 1.5, 0.0, 0.0) for f in xrange(10000)]),
+        ('script text', "Blur {\n size 10\n name Blur1\n}\n" * 30000),
+        ('node info', [{'name': "Blur%d" % i, 'class': "Blur", 'size': float(i), 'disable': False} for i in xrange(5000)]),
+    ]
+
+def measure_serializers(count):
+    rows = []
+    for payload_name, payload in payloads():
+        for name in SERIALIZER_PREFERENCE:
+            serializer = SERIALIZERS[name]
+            encoded = serializer.dumps(payload)
+            row = {'payload': payload_name, 'serializer': name, 'bytes': len(encoded)}
+            row['encode_us'] = harness.time_calls(lambda: serializer.dumps(payload), count)['median_us']
+            row['decode_us'] = harness.time_calls(lambda: serializer.loads(encoded), count)['median_us']
+            rows.append(row)
+    return rows
+
+def measure_round_trips(port, count):
+    rows = []
+    for name in SERIALIZER_PREFERENCE:
+        conn = harness.client.NukeConnection(port, serializers=[name])
+        for payload_name, payload in payloads():
+            conn.set_object_item(-1, 'bench_payload', payload)
+            row = harness.time_calls(lambda: conn.bench_payload, count)
+            row['payload'] = payload_name
+            row['serializer'] = name
+            rows.append(row)
+        conn.close()
+    return rows
+
+def main(count=20):
+    harness.print_table("Serializer payload size and time (median of %d)" % count, measure_serializers(count),
+                        ['payload', 'serializer', 'bytes', 'encode_us', 'decode_us'])
+
+    port = harness.start_server()
+    harness.print_table("Round trip fetching each payload (%d calls each)" % count, measure_round_trips(port, count),
+                        ['payload', 'serializer', 'mean_us', 'median_us', 'p95_us'])
+    harness.stop_server(port)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
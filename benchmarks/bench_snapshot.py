@@ -0,0 +1,54 @@
+'''
+Reading every knob of every node through proxies, compared to taking a
+snapshot of them in one request, and the same for writing values back.
+'''
+
+import sys
+import time
+
+from benchmarks import harness
+
+
+def read_with_proxies(conn):
+    result = []
+    for node in conn.nuke.allNodes():
+        knobs = node.knobs()
+        values = {}
+        for name, knob in knobs.items():
+            values[name] = knob.value()
+        result.append({'name': node.name(), 'class': node.Class(), 'knobs': values})
+    return result
+
+def write_with_proxies(conn, values):
+    for node_name, knob_values in values.items():
+        node = conn.nuke.toNode(node_name)
+        for knob_name, value in knob_values.items():
+            node[knob_name].setValue(value)
+
+def main(node_count=200):
+    port = harness.start_server()
+    conn = harness.client.NukeConnection(port)
+    conn.nuke.scriptClear()
+    conn.execute("for i in xrange(count): nuke.createNode('Blur')", count = node_count)
+    values = dict([("Blur%d" % (i + 1), {'mix': 0.5, 'label': "checked"}) for i in xrange(node_count)])
+
+    rows = []
+    for name, func in [('read with proxies', lambda: read_with_proxies(conn)),
+                       ('snapshot', lambda: conn.snapshot()),
+                       ('write with proxies', lambda: write_with_proxies(conn, values)),
+                       ('apply_snapshot', lambda: conn.apply_snapshot(values))]:
+        round_trips = conn.round_trips
+        start = time.time()
+        func()
+        rows.append({'mode': name, 'nodes': node_count, 'round_trips': conn.round_trips - round_trips,
+                     'total_ms': 1e3 * (time.time() - start)})
+    harness.print_table("Reading and writing the knobs of %d nodes" % node_count, rows,
+                        ['mode', 'nodes', 'round_trips', 'total_ms'])
+    conn.close()
+    harness.stop_server(port)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
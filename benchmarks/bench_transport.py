@@ -0,0 +1,60 @@
+'''
+Round trip latency and time taken by large replies on the same machine,
+over TCP loopback compared to the server's Unix domain socket, with and
+without large messages being passed through shared memory.
+'''
+
+import sys
+
+from benchmarks import harness
+from nukeExternalControl import server
+
+
+TRANSPORTS = [
+    ("tcp", {'unix_socket': False}),
+    ("unix", {'shared_memory_threshold': sys.maxint}),
+    ("unix + shared memory", {}),
+]
+
+REPLY_SIZES = [1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024]
+
+_replies = {}
+
+def reply_of_size(size):
+    if size not in _replies:
+        _replies[size] = "x" * size
+    return _replies[size]
+
+def main(count=2000):
+    server.register_action("reply_of_size", reply_of_size, main_thread=False)
+    port = harness.start_server()
+
+    latency_rows = []
+    reply_rows = []
+    for name, args in TRANSPORTS:
+        conn = harness.client.NukeConnection(port, **args)
+        row = harness.time_calls(lambda: conn.get("test"), count)
+        row['transport'] = name
+        latency_rows.append(row)
+        for size in REPLY_SIZES:
+            reply_of_size(size)
+            row = harness.time_calls(lambda: conn.actions.reply_of_size(size), max(5, count // 200))
+            row['transport'] = name
+            row['reply_mb'] = size / (1024.0 * 1024.0)
+            row['median_ms'] = row['median_us'] / 1e3
+            row['p95_ms'] = row['p95_us'] / 1e3
+            reply_rows.append(row)
+        conn.close()
+
+    harness.print_table("Round trip (%d calls)" % count, latency_rows,
+                        ['transport', 'mean_us', 'median_us', 'p95_us'])
+    harness.print_table("Large replies", reply_rows,
+                        ['transport', 'reply_mb', 'median_ms', 'p95_ms'])
+    harness.stop_server(port)
+    server.unregister_action("reply_of_size")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
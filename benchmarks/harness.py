@@ -0,0 +1,102 @@
+'''
+Shared helpers for the benchmarks: running a command server against the
+stub 'nuke' module, and timing repeated calls.
+'''
+
+import os
+import socket
+import sys
+import threading
+import time
+
+STUB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub')
+if STUB_PATH not in sys.path:
+    sys.path.insert(0, STUB_PATH)
+
+# Managed servers are started with the stub stand-in for the Nuke executable
+os.environ.setdefault('NUKE_EXEC', os.path.join(STUB_PATH, 'nuke_exec.py'))
+
+import nuke
+from nukeExternalControl import server
+from nukeExternalControl import client
+
+
+def free_port():
+    '''
+    Ask the OS for a port that nothing is currently listening on
+    '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+_server_threads = {}
+
+def start_server(server_class=server.NukeInternal, **kwargs):
+    '''
+    Start a command server in a background thread, and return the port
+    it is listening on once it is accepting connections.
+    A free port is picked unless one is passed in.
+    '''
+    if not kwargs.get('port'):
+        kwargs['port'] = free_port()
+    port = kwargs['port']
+    t = threading.Thread(None, server_class, kwargs = kwargs)
+    t.setDaemon(True)
+    t.start()
+    _server_threads[port] = t
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(('localhost', port))
+            s.close()
+            return port
+        except socket.error:
+            s.close()
+            time.sleep(0.01)
+    raise RuntimeError("Benchmark server did not start on port %d" % port)
+
+def stop_server(port):
+    '''
+    Shut down a server started with start_server, and wait for it to exit
+    '''
+    client.NukeConnection(port).shutdown_server()
+    _server_threads.pop(port).join(10)
+
+def time_calls(func, count):
+    '''
+    Call 'func' 'count' times, and return a dictionary of timing
+    statistics for a single call, in microseconds.
+    '''
+    samples = []
+    for i in xrange(count):
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    samples.sort()
+    return {
+        'count': count,
+        'mean_us': 1e6 * sum(samples) / count,
+        'median_us': 1e6 * samples[count // 2],
+        'p95_us': 1e6 * samples[min(count - 1, int(count * 0.95))],
+    }
+
+def print_table(title, rows, columns):
+    '''
+    Print a list of result dictionaries as a simple aligned table
+    '''
+    print title
+    print "  ".join("%14s" % c for c in columns)
+    for row in rows:
+        cells = []
+        for c in columns:
+            value = row.get(c, "")
+            if isinstance(value, float):
+                cells.append("%14.1f" % value)
+            else:
+                cells.append("%14s" % (value,))
+        print "  ".join(cells)
+    print
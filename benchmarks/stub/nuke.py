@@ -0,0 +1,191 @@
+'''
+A minimal stand-in for Nuke's 'nuke' module, so that the command server
+can be run and measured outside of Nuke.
+
+Only the small part of the API that the benchmarks exercise is provided.
+'''
+
+import Queue
+import threading
+
+GUI = False
+NUKE_VERSION_STRING = "stub"
+
+_nodes = []
+
+
+class Knob(object):
+    def __init__(self, name, value=0.0, animated=False):
+        self._name = name
+        self._value = value
+        self._animated = animated
+
+    def name(self):
+        return self._name
+
+    def value(self):
+        return self._value
+
+    def setValue(self, value):
+        self._value = value
+        return True
+
+    def isAnimated(self):
+        return self._animated
+
+
+class _NodeState(object):
+    '''
+    The node itself, which every Node wrapper for it refers to
+    '''
+    def __init__(self, node_class, name):
+        self.node_class = node_class
+        self.knobs = {
+            'name': Knob('name', name),
+            'disable': Knob('disable', False),
+            'mix': Knob('mix', 1.0, animated=True),
+            'label': Knob('label', ""),
+        }
+        self.selected = False
+
+
+class Node(object):
+    '''
+    Like Nuke's own nodes, a new wrapper is returned every time a node is
+    looked up, and wrappers for the same node compare equal
+    '''
+    def __init__(self, node_class=None, name=None, state=None):
+        if state is None:
+            state = _NodeState(node_class, name)
+        self._state = state
+
+    def Class(self):
+        return self._state.node_class
+
+    def name(self):
+        return self._state.knobs['name'].value()
+
+    def setName(self, name):
+        self._state.knobs['name'].setValue(name)
+
+    def knobs(self):
+        return dict(self._state.knobs)
+
+    def knob(self, name):
+        return self._state.knobs.get(name)
+
+    def addKnob(self, knob):
+        self._state.knobs[knob.name()] = knob
+
+    def isSelected(self):
+        return self._state.selected
+
+    def setSelected(self, selected):
+        self._state.selected = bool(selected)
+
+    def width(self):
+        return 1920
+
+    def height(self):
+        return 1080
+
+    def sample(self, channel, x, y, dx=1, dy=1, frame=None):
+        # A gradient, with each channel offset from the last
+        return (x / 1920.0 + y / 1080.0) * 0.5 + len(channel) * 0.01
+
+    def __getitem__(self, name):
+        return self._state.knobs[name]
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and other._state is self._state
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return id(self._state)
+
+
+def createNode(node_class, knobs="", inpanel=True):
+    state = _NodeState(node_class, "%s%d" % (node_class, len(_nodes) + 1))
+    _nodes.append(state)
+    return Node(state=state)
+
+def allNodes(filter=None, group=None, recurseGroups=False):
+    return [Node(state=n) for n in _nodes if filter is None or n.node_class == filter]
+
+def selectedNodes():
+    return [Node(state=n) for n in _nodes if n.selected]
+
+def toNode(name):
+    for n in _nodes:
+        if n.knobs['name'].value() == name:
+            return Node(state=n)
+    return None
+
+def delete(node):
+    _nodes.remove(node._state)
+
+def scriptClear():
+    del _nodes[:]
+
+def scriptOpen(path):
+    # Stand in for a script by creating one node per line of it
+    scriptClear()
+    f = open(path)
+    try:
+        for line in f:
+            if line.strip():
+                createNode(line.strip())
+    finally:
+        f.close()
+
+class _MainThread(threading.Thread):
+    '''
+    Stands in for Nuke's main thread, running queued calls one at a time
+    '''
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.calls = Queue.Queue()
+
+    def run(self):
+        while True:
+            call, args, kwargs, done = self.calls.get()
+            try:
+                done.append((True, call(*args, **kwargs)))
+            except Exception, e:
+                done.append((False, e))
+            done[0].set()
+
+_main_thread = None
+_main_thread_lock = threading.Lock()
+
+def _queue_call(call, args, kwargs):
+    global _main_thread
+    _main_thread_lock.acquire()
+    try:
+        if _main_thread is None:
+            _main_thread = _MainThread()
+            _main_thread.start()
+    finally:
+        _main_thread_lock.release()
+    done = [threading.Event()]
+    _main_thread.calls.put((call, args, kwargs, done))
+    return done
+
+def executeInMainThreadWithResult(call, args=(), kwargs={}):
+    if threading.currentThread() is _main_thread:
+        return call(*args, **kwargs)
+    done = _queue_call(call, args, kwargs)
+    done[0].wait()
+    success, result = done[1]
+    if not success:
+        raise result
+    return result
+
+def executeInMainThread(call, args=(), kwargs={}):
+    _queue_call(call, args, kwargs)
+
+def ask(prompt):
+    return True
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+'''
+Stands in for the Nuke executable when running managed servers against
+the stub 'nuke' module:
+
+    nuke_exec.py -t [<flags>] [--] <script> [<args>]
+
+Setting $NUKE_STUB_STARTUP_DELAY to a number of seconds makes it wait
+that long before running the script, to mimic Nuke's start up time.
+'''
+
+import os
+import sys
+import time
+
+STUB_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(os.path.dirname(STUB_PATH))
+
+
+def main(args):
+    if '--' in args:
+        args = args[args.index('--') + 1:]
+    else:
+        # Skip over the flags Nuke understands, along with their values
+        while args and args[0].startswith('-'):
+            if args[0] in ['-m', '-F', '-X']:
+                args = args[1:]
+            args = args[1:]
+    if not args:
+        print "Usage: nuke_exec.py -t [<flags>] [--] <script> [<args>]"
+        return 1
+
+    time.sleep(float(os.getenv("NUKE_STUB_STARTUP_DELAY", 0)))
+
+    sys.path[:0] = [STUB_PATH, ROOT_PATH]
+    sys.argv = args
+    execfile(args[0], {'__name__': '__main__', '__file__': args[0]})
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,218 @@
+'''
+Runs the core measurements of the command server interface, prints them,
+and writes them to a JSON file so that runs can be compared:
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --compare results.json
+
+Measures:
+    latency     round-trip latency of each action type
+    throughput  requests per second with several clients at once
+    payload     round-trip latency as payloads grow, across the 2KB size
+                that messages used to be split into parts at
+    recode      cost of turning lists of objects into proxies and back
+'''
+
+import json
+import optparse
+import platform
+import sys
+import threading
+import time
+
+from benchmarks import harness
+
+SECTIONS = ['latency', 'throughput', 'payload', 'recode']
+
+# The columns that identify a row within each section, for comparisons
+KEYS = {
+    'latency': ['action'],
+    'throughput': ['clients'],
+    'payload': ['bytes'],
+    'recode': ['objects', 'direction'],
+}
+
+
+def node_names():
+    return [n.name() for n in harness.nuke.allNodes()]
+
+def measure_latency(port, count):
+    harness.server.register_action('bench_node_names', node_names)
+    conn = harness.client.NukeConnection(port)
+    nuke = conn.nuke
+    nuke.scriptClear()
+    node = nuke.createNode("Blur")
+    knob = node['disable']
+    value = knob.value
+    environ = conn.import_module("os").environ
+
+    def run_batch():
+        batch = conn.batch()
+        wrapped = batch.wrap(node)
+        for i in xrange(10):
+            wrapped.name()
+        batch.run()
+
+    operations = [
+        ('test', lambda: conn.get("test")),
+        ('getattr', lambda: conn.get_object_attribute(node._id, 'name')),
+        ('setattr', lambda: conn.set_object_attribute(node._id, 'bench_value', 1)),
+        ('getitem', lambda: conn.get_object_item(node._id, 'disable')),
+        ('setitem', lambda: conn.set_object_item(-1, 'bench_value', 1.0)),
+        ('call', lambda: value()),
+        ('callattr', lambda: conn.call_object_method(knob._id, 'value', (), {})),
+        ('len', lambda: len(environ)),
+        ('str', lambda: conn.get_object_string(node._id)),
+        ('repr', lambda: conn.get_object_repr(node._id)),
+        ('import', lambda: conn.import_module("os")),
+        ('batch of 10', run_batch),
+        ('exec', lambda: conn.execute("x = 1")),
+        ('eval', lambda: conn.evaluate("1 + 1")),
+        ('registered', lambda: conn.actions.bench_node_names()),
+        ('stats', lambda: conn.server_stats()),
+    ]
+    rows = []
+    for name, operation in operations:
+        row = harness.time_calls(operation, count)
+        row['action'] = name
+        rows.append(row)
+    conn.close()
+    return rows
+
+def measure_throughput(port, count, client_counts=(1, 2, 4, 8)):
+    rows = []
+    for clients in client_counts:
+        connections = [harness.client.NukeConnection(port) for i in xrange(clients)]
+        errors = []
+        def work(conn):
+            try:
+                node = conn.nuke.toNode("Blur1")
+                for i in xrange(count):
+                    node.name()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(None, work, args = (conn,)) for conn in connections]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        if errors:
+            raise errors[0]
+        for conn in connections:
+            conn.close()
+        rows.append({
+            'clients': clients,
+            'requests': clients * count,
+            'requests_per_s': clients * count / elapsed,
+        })
+    return rows
+
+def measure_payload(port, count, sizes=(256, 1024, 2047, 2048, 2049, 4096, 16384, 65536, 262144, 1048576)):
+    conn = harness.client.NukeConnection(port)
+    rows = []
+    for size in sizes:
+        payload = "x" * size
+        conn.set_object_item(-1, 'bench_payload', payload)
+        row = harness.time_calls(lambda: conn.bench_payload, count)
+        row['bytes'] = size
+        row['mb_per_s'] = size / (row['median_us'] or 1.0)
+        rows.append(row)
+    conn.close()
+    return rows
+
+def measure_recode(port, count, object_counts=(1, 10, 100, 1000, 10000)):
+    conn = harness.client.NukeConnection(port)
+    nuke = conn.nuke
+    rows = []
+    for objects in object_counts:
+        nuke.scriptClear()
+        conn.execute("for i in xrange(count): nuke.createNode('Blur')", count = objects)
+        repeat = max(1, count * 10 / objects)
+
+        # The server turns every node into a handle, and the client into a proxy
+        row = harness.time_calls(lambda: nuke.allNodes(), repeat)
+        row.update({'objects': objects, 'direction': "to client"})
+        rows.append(row)
+
+        # The client turns every proxy back into a reference
+        nodes = nuke.allNodes()
+        row = harness.time_calls(lambda: conn.set_object_item(-1, 'bench_nodes', nodes), repeat)
+        row.update({'objects': objects, 'direction': "to server"})
+        rows.append(row)
+        conn.set_object_item(-1, 'bench_nodes', None)
+    nuke.scriptClear()
+    conn.close()
+    return rows
+
+def compare(results, previous):
+    '''
+    Print the change in median time (or rate) of every row that
+    appears in both sets of results
+    '''
+    print "Compared to previous results (new / old)"
+    for section in SECTIONS:
+        old_rows = {}
+        for row in previous['results'].get(section, []):
+            old_rows[tuple([row.get(k) for k in KEYS[section]])] = row
+        for row in results.get(section, []):
+            key = tuple([row.get(k) for k in KEYS[section]])
+            old = old_rows.get(key)
+            if old is None:
+                continue
+            for column in ['median_us', 'requests_per_s']:
+                if column in row and old.get(column):
+                    print "%12s  %-28s %14s %8.2fx" % (section, ", ".join([str(k) for k in key]), column, row[column] / old[column])
+    print
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage = "python -m benchmarks.suite [options]")
+    parser.add_option('-o', '--output', help = "write the results to this JSON file")
+    parser.add_option('-c', '--compare', help = "compare the results to those in this JSON file")
+    parser.add_option('-n', '--count', type = 'int', default = 500, help = "calls to time for each measurement")
+    parser.add_option('-s', '--section', action = 'append', choices = SECTIONS, help = "only run this section (can be repeated)")
+    options, args = parser.parse_args(argv)
+
+    port = harness.start_server()
+    conn = harness.client.NukeConnection(port)
+    conn.nuke.scriptClear()
+    conn.nuke.createNode("Blur")
+    conn.close()
+
+    measurements = {
+        'latency': (measure_latency, ['action', 'mean_us', 'median_us', 'p95_us']),
+        'throughput': (measure_throughput, ['clients', 'requests', 'requests_per_s']),
+        'payload': (measure_payload, ['bytes', 'mean_us', 'median_us', 'p95_us', 'mb_per_s']),
+        'recode': (measure_recode, ['objects', 'direction', 'count', 'mean_us', 'median_us']),
+    }
+    results = {}
+    for section in options.section or SECTIONS:
+        func, columns = measurements[section]
+        results[section] = func(port, options.count)
+        harness.print_table(section, results[section], columns)
+    harness.stop_server(port)
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            compare(results, json.load(f))
+        finally:
+            f.close()
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump({
+                'meta': {
+                    'time': time.time(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'count': options.count,
+                },
+                'results': results,
+            }, f, indent = 1, sort_keys = True)
+        finally:
+            f.close()
+
+if __name__ == '__main__':
+    main()
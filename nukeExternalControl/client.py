@@ -4,18 +4,41 @@ This module defines the client-side classes for the Nuke command server interfac
 It also functions as an executable to launch NukeCommandManager instances.
 '''
 
+import array
+import collections
+import errno
+import multiprocessing
 import os
 import inspect
+import itertools
 import pickle
+import Queue
+import select
 import socket
+import stat
 import subprocess
 import sys
+import textwrap
 import threading
 import time
 import traceback
+import weakref
 
 from nukeExternalControl.common import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How often (in seconds) a manager checks whether its server process has
+# exited while waiting for it to start
+MANAGER_POLL_INTERVAL = 0.05
+
+# How many items are fetched at a time when iterating over an object on
+# the server
+ITERATION_PAGE_SIZE = 100
+
 try:
     THIS_FILE = inspect.getabsfile(lambda:0)
 except TypeError:
@@ -30,17 +53,88 @@ class NukeConnection(object):
     to a command server on that port, raising an exception
     if one is not found.
 
-    Otherwise, the standard port search routine runs.
+    Otherwise, the first server found on a port between
+    DEFAULT_START_PORT + 'instance' and DEFAULT_END_PORT is used.
+    Servers on this machine are looked up in the registry first, and
+    only if none of them answer are all of the ports in the range probed.
+
+    'max_message_size' limits the size in bytes of any single request
+    or reply on the connection.
+
+    If 'prefetch_schema' is set, the client learns which attributes of
+    remote modules and types are methods (or constants) the first time it
+    needs to, and from then on looks them up locally. Calling a method
+    then only takes a single round trip. The modules in the server's
+    globals are also found up front, along with the schemas of any named
+    in 'prefetch_schema' (just 'nuke' if it is True). Schemas are kept
+    until the session is closed, so close() the connection to pick up
+    functions added to a module, or constants changed, since then.
+
+    If 'instrument' is True (or $NUKE_EXTERNAL_CONTROL_STATS is set), the
+    client records NukeStats for every request in 'instrumentation'.
+
+    Requests and replies of more than 'compression_threshold' bytes are
+    compressed at 'compression_level' if 'compression' is True. By default
+    they are only compressed when the server is on another machine.
+
+    When the server is on this machine and listens on a Unix domain socket,
+    the client connects to that instead of the port, unless 'unix_socket'
+    is False. Messages of more than 'shared_memory_threshold' bytes are
+    then passed through shared memory rather than the socket.
+
+    Objects are swapped for proxies while messages are serialized, unless
+    'persistent_ids' is False (or the server is too old to support it), in
+    which case every message is copied with the proxies swapped in first.
     '''
-    def __init__(self, port=None, host="localhost", instance=0):
+    # Whether to ask the server for request ids, so that more than one
+    # request can be in flight at once (see NukeAsyncConnection)
+    request_ids = False
+
+    def __init__(self, port=None, host="localhost", instance=0, max_message_size=MAX_MESSAGE_SIZE, serializers=None, prefetch_schema=False, instrument=INSTRUMENT,
+                 compression=None, compression_level=COMPRESSION_LEVEL, compression_threshold=COMPRESSION_THRESHOLD,
+                 unix_socket=True, shared_memory_threshold=SHARED_MEMORY_THRESHOLD, persistent_ids=True):
         self._objects = {}
         self._functions = {}
         self._host = host
+        self._max_message_size = max_message_size
+        if compression is None:
+            compression = not is_local_host(host)
+        self._compression = None
+        if compression:
+            self._compression = {'level': compression_level, 'threshold': compression_threshold}
+        self._use_unix_socket = unix_socket and hasattr(socket, 'AF_UNIX') and is_local_host(host)
+        self._shared_memory = {'threshold': shared_memory_threshold}
+        self._persistent_ids = persistent_ids
+        if serializers is None:
+            serializers = SERIALIZER_PREFERENCE
+        self._offered_serializers = list(serializers)
+        self._serializer = SERIALIZERS[DEFAULT_SERIALIZER]
+        self._request_ids = False
+        self._socket = None
+        self._socket_lock = threading.Lock()
+        self._pending_releases = collections.deque()
+        self._proxies = weakref.WeakValueDictionary()
+        self._proxies_lock = threading.Lock()
+        if prefetch_schema is True:
+            prefetch_schema = ['nuke']
+        elif not prefetch_schema:
+            prefetch_schema = None
+        self._prefetch_schema = prefetch_schema
+        self._schemas = {}
+        self._global_ids = None
+        self.round_trips = 0
+        self.actions = NukeActions(self)
+        self.instrumentation = None
+        if instrument:
+            self.instrumentation = NukeStats()
+            self._instrument_local = threading.local()
         self.is_active = False
         if not port:
             start_port = DEFAULT_START_PORT + instance
             end_port = DEFAULT_END_PORT
-            self._port = self.find_connection_port(start_port, end_port)
+            self._port = self.find_registered_port(start_port, end_port)
+            if self._port == -1:
+                self._port = self.find_connection_port(start_port, end_port)
             if self._port == -1:
                 raise NukeConnectionError("Connection with Nuke failed")
             self.is_active = True
@@ -49,50 +143,247 @@ class NukeConnection(object):
             if not self.test_connection():
                 raise NukeConnectionError("Could not connect to Nuke command server on port %d" % self._port)
             self.is_active = True
-        
-        if not self.authenticate_connection():
-            self.is_active = False
-            raise NukeConnectionError("Connection with Nuke denied")
+
+    def find_registered_port(self, start_port, end_port):
+        '''
+        Find the first server in the registry with a port between
+        start_port and end_port that answers
+        '''
+        if not is_local_host(self._host):
+            return -1
+        for entry in registered_servers():
+            port = entry['port']
+            if start_port <= port <= end_port:
+                self._port = port
+                if self.test_connection():
+                    return port
+        return -1
 
     def find_connection_port(self, start_port, end_port):
         '''
-        Find the first available open port between start_port and end_port
+        Find the first available open port between start_port and end_port.
+        Every port is probed at once, so only those with something listening
+        on them are tested.
         '''
-        for port in range(start_port, end_port + 1):
+        for port in self.probe_ports(range(start_port, end_port + 1)):
             self._port = port
             if self.test_connection():
                 return port
         return -1
+
+    def probe_ports(self, ports, timeout=PROBE_TIMEOUT):
+        '''
+        Start connecting to every port at once, and return the ones that
+        accepted a connection within 'timeout' seconds, in order
+        '''
+        pending = {}
+        open_ports = []
+        try:
+            for port in ports:
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setblocking(0)
+                error = s.connect_ex((self._host, port))
+                if error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    pending[s] = port
+                    continue
+                if error == 0:
+                    open_ports.append(port)
+                s.close()
+
+            deadline = time.time() + timeout
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                r, w, x = select.select([], pending.keys(), pending.keys(), remaining)
+                for s in set(w + x):
+                    port = pending.pop(s)
+                    if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0 and s.getsockname() != s.getpeername():
+                        open_ports.append(port)
+                    s.close()
+        finally:
+            for s in pending:
+                s.close()
+        open_ports.sort()
+        return open_ports
     
-    def send(self, data):
+    def find_unix_socket(self):
+        '''
+        Get the path of the Unix domain socket the server on our port is
+        listening on, according to the registry, if there is one.
+        Sockets that do not belong to this user are never used.
+        '''
+        if not self._use_unix_socket:
+            return None
+        entry = read_registry_entry(registry_path(self._port))
+        if entry is None or entry.get('port') != self._port:
+            return None
+        path = entry.get('unix_socket')
+        # Only connect to a socket this user made, where the server will
+        # have been started by this user too
+        if path != unix_socket_path(self._port) or not is_private(path, stat.S_ISSOCK):
+            return None
+        return path
+
+    def open_socket(self):
         '''
-        Send some ASCII data to the server, and then wait for a response
+        Open the socket used for the session with the server.
+        The same socket is reused for every request until the
+        connection is closed.
+        The server's Unix domain socket is used if it has one, falling back
+        to its port if that cannot be connected to.
         '''
+        path = self.find_unix_socket()
+        if path is not None:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.connect(path)
+                return s
+            except socket.error:
+                s.close()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((self._host, self._port))
-            s.send(data)
-            result = s.recv(SOCKET_BUFFER_SIZE)
+            # With nothing listening on a port in the ephemeral range, a
+            # local connection can occasionally end up connected to itself
+            if s.getsockname() == s.getpeername():
+                raise socket.error(errno.ECONNREFUSED, "Connection refused")
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except:
             s.close()
-        except socket.error:
-            raise NukeConnectionError("Connection with Nuke failed")
-            
-        return result
+            raise
+        return s
+
+    def open_session(self):
+        '''
+        Open a new socket and introduce ourselves to the server on it.
+        Raises NukeConnectionDeniedError if the server refuses to talk.
+        '''
+        s = self.open_socket()
+        try:
+            accepted = self.authenticate_connection(s)
+        except:
+            s.close()
+            raise
+        if not accepted:
+            s.close()
+            raise NukeConnectionDeniedError("Connection with Nuke denied")
+        return s
+
+    def close(self):
+        '''
+        Close the session with the server. A new session will be
+        opened automatically if another request is made.
+        Any NukeObjects from the closed session can no longer be used.
+        '''
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            finally:
+                self._socket = None
+                # The server drops everything from the session when it
+                # closes, so there is nothing left to release
+                self._pending_releases.clear()
+                self._global_ids = None
+                self._serializer.close()
+                # Schemas are only fixed for as long as a session lasts
+                self._schemas.clear()
+
+    def send(self, data):
+        '''
+        Serialize some data, send it to the server, and then wait for a
+        response and return it deserialized
+        '''
+        stats = self.instrumentation
+        self._socket_lock.acquire()
+        try:
+            try:
+                if self._socket is None:
+                    self._socket = self.open_session()
+                if stats is not None:
+                    start = time.time()
+                encoded = self._serializer.dumps(data)
+                if stats is not None:
+                    sent = time.time()
+                if len(encoded) > self._max_message_size:
+                    raise NukeMessageSizeError("Request of %d bytes exceeds the maximum message size of %d bytes" % (len(encoded), self._max_message_size))
+                send_message(self._socket, encoded)
+                self.round_trips += 1
+                try:
+                    result = recv_message(self._socket, self._max_message_size)
+                except NukeMessageSizeError:
+                    # The rest of the reply is still on its way, so the
+                    # session cannot be used any more
+                    self.close()
+                    raise
+                if result is None:
+                    raise socket.error("Connection closed by server")
+            except socket.error:
+                self.close()
+                raise NukeConnectionError("Connection with Nuke failed")
+            if stats is None:
+                return self._serializer.loads(result)
+            received = time.time()
+            reply = self._serializer.loads(result)
+            finished = time.time()
+            stats.record(data.get('action'), finished - start, len(result), len(encoded),
+                         serialize = (sent - start) + (finished - received),
+                         network = received - sent)
+            return reply
+        finally:
+            self._socket_lock.release()
     
-    def authenticate_connection(self):
+    def authenticate_connection(self, sock):
         '''
         Pass a message to the server identifying where the client is coming from,
         and give the server the option of refusing to talk.
+        This also agrees on the serializer to use for the rest of the session.
         '''
         if self._host == "localhost":
             host = "localhost"
         else:
             host = os.getenv("HOST")
-        
-        if self.get("initiate", parameters = host) == "accept":
+
+        serializer = SERIALIZERS[DEFAULT_SERIALIZER]
+        parameters = {'host': host, 'serializers': self._offered_serializers, 'schema': self._prefetch_schema is not None, 'persistent_ids': self._persistent_ids,
+                      'request_ids': self.request_ids}
+        if self._compression is not None:
+            parameters['compression'] = self._compression
+        elif sock.family != socket.AF_INET:
+            parameters['shared_memory'] = self._shared_memory
+        send_message(sock, serializer.dumps({'action': "initiate", 'id': -1, 'parameters': parameters}))
+        self.round_trips += 1
+        result = recv_message(sock, self._max_message_size)
+        if result is None:
+            raise socket.error("Connection closed by server")
+        result = serializer.loads(result)
+
+        if isinstance(result, dict) and result.get('status') == "accept":
+            self._serializer = SERIALIZERS[result['serializer']]
+            if result.get('persistent_ids'):
+                self._serializer = self.persistent_id_serializer(self._serializer)
+            if result.get('compression'):
+                self._serializer = CompressedSerializer(self._serializer, max_size = self._max_message_size, **self._compression)
+            elif result.get('shared_memory'):
+                self._serializer = SharedMemorySerializer(self._serializer, max_size = self._max_message_size, **self._shared_memory)
+            self._request_ids = bool(result.get('request_ids'))
+            return True
+        elif result == "accept":
+            self._serializer = serializer
+            self._request_ids = False
             return True
         return False
     
+    def persistent_id_serializer(self, serializer):
+        '''
+        Wrap a serializer so that NukeObjects are swapped for persistent
+        ids as messages are serialized, and back as they are deserialized.
+        The serializer only refers back to the connection weakly, so that
+        a connection that is no longer used is still closed straight away.
+        '''
+        ref = weakref.ref(self)
+        return PersistentIdSerializer(serializer, lambda obj: ref().persistent_id(obj), lambda pid: ref().persistent_load(pid))
+
     def test_connection(self):
         '''
         Test to see if the connection is working.
@@ -100,52 +391,42 @@ class NukeConnection(object):
         '''
         try:
             return self.get("test")
+        except NukeConnectionDeniedError:
+            raise
         except NukeConnectionError, e:
             return False
     
     def get(self, item_type, item_id = -1, parameters = None):
         '''
         Encode the action, object and parameters and pass them over the socket connection.
-        If the pickled data is too long, send it as a multi-part message.
-        Decode any returned data, joining together multiple parts as necessary,
-        and return (or raise, in the case of an Exception) the result.
+        Decode any returned data, and return (or raise, in the case of an Exception) the result.
         '''
-        try:
-            data = {'action': item_type, 'id': item_id, 'parameters': parameters}
-            encoded = pickle.dumps(self.encode(data))
-            
-            if len(encoded) > MAX_SOCKET_BYTES:
-                encodedBits = []
-                while encoded:
-                    encodedBits.append(encoded[:MAX_SOCKET_BYTES])
-                    encoded = encoded[MAX_SOCKET_BYTES:]
-                
-                for i in range(len(encodedBits)):
-                    result = pickle.loads(self.send(pickle.dumps({'type': "NukeTransferPartialObject", 'part': i, 'part_count': len(encodedBits), 'data': encodedBits[i]})))
-                    if i < (len(encodedBits) - 1):
-                        if not (isinstance(result, dict) and 'type' in result and result['type'] == "NukeTransferPartialObjectRequest" and 'part' in result and result['part'] == i+1):
-                            raise NukeConnectionError("Unexpected response to partial object")
-            else:
-                result = pickle.loads(self.send(encoded))
-
-            if isinstance(result, dict) and 'type' in result and result['type'] == "NukeTransferPartialObject":
-                data = result['data']
-                nextPart = 1
-                while nextPart < result['part_count']:
-                    returnData = self.send(pickle.dumps({'type': "NukeTransferPartialObjectRequest", 'part': nextPart}))
-                    result = pickle.loads(returnData)
-                    data += result['data']
-                    nextPart += 1
-                
-                result = pickle.loads(data)
-        except Exception, e:
-            raise e
+        data = self.request(item_type, item_id, parameters)
+        if self.instrumentation is None:
+            result = self.send(self.encode(data))
+        else:
+            # Decoding the result is counted towards this action too
+            self._instrument_local.action = item_type
+            start = time.time()
+            encoded = self.encode(data)
+            self.instrumentation.record_part(item_type, 'recode', time.time() - start)
+            result = self.send(encoded)
         
         if isinstance(result, Exception):
             raise result
         
         return result
 
+    def request(self, item_type, item_id = -1, parameters = None):
+        '''
+        Build the data for a request, including any queued releases
+        '''
+        data = {'action': item_type, 'id': item_id, 'parameters': parameters}
+        releases = self.take_pending_releases()
+        if releases:
+            data['release'] = releases
+        return data
+
     def shutdown_server(self):
         '''
         Passes the 'shutdown' keyword to the server.
@@ -158,7 +439,10 @@ class NukeConnection(object):
         sends back as a string.
         '''
         self.is_active = False
-        return self.get('shutdown')
+        try:
+            return self.get('shutdown')
+        finally:
+            self.close()
 
     def get_object_attribute(self, obj_id, property_name):
         '''
@@ -174,6 +458,60 @@ class NukeConnection(object):
         '''
         return self.decode(self.get("setattr", obj_id, (property_name, value)))
     
+    def call_object_method(self, obj_id, method_name, args, kwargs):
+        '''
+        Call a method of an object on the server
+        result = object.method_name(*args, **kwargs)
+        '''
+        return self.decode(self.get("callattr", obj_id, {'name': method_name, 'args': args, 'kwargs': kwargs}))
+
+    def prefetch_schemas(self):
+        '''
+        Find the modules in the server's globals, and the schemas of those
+        named in 'prefetch_schema'.
+        The connection keeps hold of the modules for the rest of the session,
+        so that getting them from the connection doesn't need a round trip.
+        '''
+        result = self.decode(self.get("schema", -1, self._prefetch_schema))
+        for schema in result['schemas'].values():
+            self.add_schema(schema)
+        global_ids = {}
+        self._proxies_lock.acquire()
+        try:
+            for name, module in result['modules'].items():
+                # Take over one of the proxy's references, which is never
+                # released while the session lasts
+                module.__dict__['_refs'] -= 1
+                global_ids[name] = (module._id, module._class)
+        finally:
+            self._proxies_lock.release()
+        self._global_ids = global_ids
+
+    def add_schema(self, schema):
+        '''
+        Store a schema sent by the server
+        '''
+        schema['callables'] = frozenset(schema['callables'])
+        self._schemas[schema['key']] = schema
+
+    def get_schema(self, obj):
+        '''
+        Get the schema for a NukeObject, fetching it from the server
+        the first time it is needed. Returns None if schemas are not
+        being used.
+        '''
+        key = obj.__dict__.get('_class')
+        if self._prefetch_schema is None or key is None:
+            return None
+        schema = self._schemas.get(key)
+        if schema is None:
+            try:
+                schema = self.decode(self.get("schema", obj._id))
+            except Exception:
+                schema = {'key': key, 'callables': (), 'constants': {}}
+            self.add_schema(schema)
+        return schema
+
     def get_object_item(self, obj_id, property_name):
         '''
         Get an item from an object on the server
@@ -202,6 +540,48 @@ class NukeConnection(object):
         '''
         return self.decode(self.get("len", obj_id))
     
+    def get_object_contains(self, obj_id, item):
+        '''
+        Check whether an object on the server contains an item
+        result = item in object
+        '''
+        return self.decode(self.get("contains", obj_id, item))
+
+    def iterate(self, obj, *args, **kwargs):
+        '''
+        Iterate over an object on the server, getting 'page_size' items
+        (ITERATION_PAGE_SIZE by default) at a time, so that only one page
+        of items is held at either end.
+        If 'obj' is a function or method (such as nuke.allNodes), it is
+        called on the server with the rest of the arguments, and its result
+        is iterated over without ever being sent as a whole:
+
+        for node in conn.iterate(nuke.allNodes, "Blur", page_size=500):
+            ...
+        '''
+        page_size = kwargs.pop('page_size', ITERATION_PAGE_SIZE)
+        parameters = {'page_size': page_size}
+        if isinstance(obj, NukeRemoteMethod):
+            parameters.update({'name': obj._name, 'args': args, 'kwargs': kwargs})
+            obj = obj._object
+        elif args or kwargs:
+            parameters.update({'call': True, 'args': args, 'kwargs': kwargs})
+        else:
+            # Without a schema, functions such as nuke.allNodes are plain
+            # NukeObjects, so the server calls them if they are not iterable
+            parameters['call'] = None
+        page = self.decode(self.get("iter", obj._id, parameters))
+        iterator = page['iterator']
+        items = page['items']
+        while True:
+            for item in items:
+                yield item
+            if iterator is None:
+                return
+            items = self.decode(self.get("next", iterator._id, page_size))
+            if len(items) < page_size:
+                iterator = None
+
     def get_object_string(self, obj_id):
         '''
         Get the string equivalent of an object on the server
@@ -217,7 +597,70 @@ class NukeConnection(object):
         return self.decode(self.get("repr", obj_id))
     
     def delete_object(self, obj_id):
+        '''
+        Release an object on the server straight away
+        '''
         return self.decode(self.get("del", obj_id))
+
+    def release_object(self, obj_id, count=1):
+        '''
+        Queue an object on the server to be released 'count' times.
+        Queued releases are sent along with the next request, rather than
+        costing a request of their own.
+        This is safe to call at any time, including from __del__ methods.
+        '''
+        if count == 1:
+            self._pending_releases.append(obj_id)
+        else:
+            self._pending_releases.append((obj_id, count))
+
+    def take_pending_releases(self):
+        '''
+        Remove and return the ids of all queued releases
+        '''
+        releases = []
+        try:
+            while True:
+                releases.append(self._pending_releases.popleft())
+        except IndexError:
+            pass
+        return releases
+
+    def flush_releases(self):
+        '''
+        Send any queued releases to the server now
+        '''
+        if self._pending_releases:
+            self.get("release")
+
+    def server_stats(self, reset=False):
+        '''
+        Get a dictionary of statistics from the server, including
+        the number of objects it is holding for this connection
+        ('handles') and for all connections ('server_handles'), and
+        the memory used by the server process in bytes ('memory').
+        If the server is instrumented, 'instrumentation' is a snapshot
+        of its NukeStats, which are then cleared if 'reset' is True.
+        '''
+        parameters = None
+        if reset:
+            parameters = {'reset': True}
+        return self.decode(self.get("stats", parameters = parameters))
+
+    def dump_stats(self, out=None):
+        '''
+        Print the NukeStats recorded by this connection and by the
+        server, for whichever of them are instrumented
+        '''
+        if out is None:
+            out = sys.stdout
+        if self.instrumentation is not None:
+            print >> out, format_stats(self.instrumentation.snapshot(), "Client")
+            print >> out
+        server = self.server_stats().get('instrumentation')
+        if server is not None:
+            print >> out, format_stats(server, "Server")
+            print >> out
     
     def get_object_isinstance(self, obj_id, instance):
         return self.decode(self.get("isinstance", obj_id, instance))
@@ -225,6 +668,63 @@ class NukeConnection(object):
     def get_object_issubclass(self, obj_id, subclass):
         return self.decode(self.get("issubclass", obj_id, subclass))
     
+    def batch(self):
+        '''
+        Start a batch of operations that will be sent to the server
+        in a single request. See NukeBatch.
+        '''
+        return NukeBatch(self)
+
+    def run_batch(self, operations):
+        '''
+        Perform a list of operations on the server in a single request,
+        and return a list of their results (or exceptions).
+        Each operation is a dictionary with the same 'action', 'id'
+        and 'parameters' keys as any other request, except that
+        the 'id' can also be a NukeBatchResult from earlier in the list.
+        '''
+        return self.decode(self.get("batch", parameters = operations))
+
+    def run(self, func, *args, **kwargs):
+        '''
+        Run a function inside Nuke, and return its result
+        result = func(*args, **kwargs)
+
+        The function's source is sent to the server, so it must be a plain
+        module-level function (no decorators or lambdas), and it can only
+        use what is available inside Nuke. The nuke module is available as
+        'nuke', but anything else it needs must be imported within it.
+        '''
+        return self.decode(self.get("exec", parameters = self.run_parameters(func, args, kwargs)))
+
+    def run_parameters(self, func, args, kwargs):
+        '''
+        Build the parameters for running a function inside Nuke
+        '''
+        source = self._functions.get(func)
+        if source is None:
+            if func.__name__ == "<lambda>":
+                raise TypeError("Lambdas cannot be run remotely")
+            source = textwrap.dedent(inspect.getsource(func))
+            self._functions[func] = source
+        return {'source': source, 'name': func.__name__, 'args': args, 'kwargs': kwargs}
+
+    def execute(self, source, **variables):
+        '''
+        Execute a block of Python source inside Nuke, with the nuke module
+        and any passed variables available to it
+        exec source
+        '''
+        return self.decode(self.get("exec", parameters = {'source': source, 'variables': variables}))
+
+    def evaluate(self, expression, **variables):
+        '''
+        Evaluate a Python expression inside Nuke, with the nuke module
+        and any passed variables available to it
+        result = eval(expression)
+        '''
+        return self.decode(self.get("eval", parameters = {'expression': expression, 'variables': variables}))
+
     def import_module(self, module_name):
         '''
         Import a module on the server
@@ -232,6 +732,61 @@ class NukeConnection(object):
         return module_name
         '''
         return self.decode(self.get("import", parameters = module_name))
+
+    def snapshot(self, classes=None, pattern=None, selected=None, knobs=None, recurse_groups=False):
+        '''
+        Get the knob values of every node that matches a filter as plain
+        data, in a single request. Nodes can be filtered by class name (or
+        a list of them), an fnmatch pattern for their names, and whether
+        they are selected. Only the knobs named in 'knobs' are included,
+        if it is given.
+
+        Returns a list with a dictionary for each node, with its 'name',
+        'class', 'knobs' (a dictionary of knob values) and 'animated' (a
+        list of the included knobs that are animated).
+        '''
+        if isinstance(classes, basestring):
+            classes = [classes]
+        parameters = {'classes': classes, 'pattern': pattern, 'selected': selected, 'knobs': knobs, 'recurse_groups': recurse_groups}
+        return self.decode(self.get("snapshot", parameters = parameters))
+
+    def apply_snapshot(self, values):
+        '''
+        Set knob values on many nodes in a single request. 'values' is a
+        dictionary of {node name: {knob name: value}}, or a list of nodes
+        as returned by snapshot().
+        Returns a dictionary of {node name: {knob name: error message}} for
+        every value that could not be set, which is empty if all of them were.
+        '''
+        if not isinstance(values, dict):
+            values = dict([(node['name'], node['knobs']) for node in values])
+        return self.decode(self.get("apply_snapshot", parameters = values))
+
+    def sample(self, node, channels, x=0, y=0, width=None, height=None, frame=None):
+        '''
+        Sample a region of a node's image (by default the whole of it) for
+        a channel or list of channels, in a single request.
+        Returns a NukeSamples holding the raw samples, which can be turned
+        into an array or a NumPy array.
+        '''
+        if isinstance(channels, basestring):
+            channels = [channels]
+        parameters = {'channels': list(channels), 'x': x, 'y': y, 'width': width, 'height': height, 'frame': frame}
+        return NukeSamples(**self.decode(self.get("sample", node._id, parameters)))
+
+    def call_action(self, name, *args, **kwargs):
+        '''
+        Perform an action registered on the server with register_action(),
+        and return its result
+        '''
+        return self.decode(self.get(name, parameters = {'args': args, 'kwargs': kwargs}))
+
+    def list_actions(self):
+        '''
+        Get a dictionary of the actions registered on the server,
+        and their descriptions
+        '''
+        return self.decode(self.get("actions"))
     
     def recode_data(self, data, recode_object_func):
         '''
@@ -239,7 +794,7 @@ class NukeConnection(object):
         This deals with passing data both to and from the interim format,
         and recursively recoding lists and dictionaries.
         '''
-        if type(data) in basicTypes:
+        if type(data) in basicTypes or isinstance(data, Exception):
             return data
         elif type(data) in listTypes:
             newList = []
@@ -257,6 +812,32 @@ class NukeConnection(object):
         else:
             return recode_object_func(data)
             
+    def persistent_id(self, obj):
+        '''
+        Get the persistent id to send in place of an object that cannot
+        be passed directly. Returns None for plain data.
+        '''
+        if passed_by_value(obj):
+            return None
+        elif isinstance(obj, NukeObject):
+            return ('object', obj._id)
+        elif isinstance(obj, NukeBatchResult):
+            return obj._batch.persistent_id(obj)
+        elif isinstance(obj, NukeRemoteMethod):
+            # The server gets the method itself, rather than this
+            # having to ask for it first
+            return ('method', obj._object._id, obj._name)
+        else:
+            raise TypeError("Invalid object type being passed through connection: '%s'" % obj)
+
+    def persistent_load(self, pid):
+        '''
+        Get the NukeObject for a persistent id sent by the server
+        '''
+        if pid[0] == 'object':
+            return self.get_proxy(pid[1], pid[2])
+        raise pickle.UnpicklingError("Unknown persistent id %r" % (pid,))
+
     def encode_data(self, data):
         '''
         Encode data to send to the server
@@ -276,20 +857,47 @@ class NukeConnection(object):
         '''
         if isinstance(data, NukeObject):
             return {'type': "NukeTransferObject", 'id': data._id}
+        elif isinstance(data, NukeBatchResult):
+            return data._batch.encode_result(data)
+        elif isinstance(data, NukeRemoteMethod):
+            return self.encode_data_object(data._resolve())
         else:
             raise TypeError("Invalid object type being passed through connection: '%s'" % data)
     
     def decode_data_object(self, data):
         '''
         Convert a dictionary representing an object on the server into
-        a NukeObject instance
+        a NukeObject instance.
+        '''
+        return self.get_proxy(data['id'], data.get('class'))
+
+    def get_proxy(self, obj_id, obj_class=None, refs=1):
+        '''
+        Get the NukeObject for an id.
+        The server always uses the same id for the same object, so while
+        there is a NukeObject for an id it is reused, and counts the extra
+        references it will need to release.
         '''
-        return NukeObject(self, data['id'])
+        self._proxies_lock.acquire()
+        try:
+            obj = self._proxies.get(obj_id)
+            if obj is None:
+                obj = NukeObject(self, obj_id, obj_class, refs)
+                self._proxies[obj_id] = obj
+            else:
+                obj.__dict__['_refs'] += refs
+        finally:
+            self._proxies_lock.release()
+        return obj
     
     def encode(self, data):
         '''
-        Encode some data, and turn it into a pickled stream
+        Encode some data, and turn it into a pickled stream.
+        Nothing needs doing if objects are swapped for persistent ids
+        while the data is serialized instead.
         '''
+        if self._serializer.persistent_ids:
+            return data
         return self.encode_data(data)
     
     def decode(self, data):
@@ -297,13 +905,29 @@ class NukeConnection(object):
         Decode a pickle stream of data, ensuring that any NukeObject
         instances are created
         '''
-        return self.decode_data(data)
+        if self._serializer.persistent_ids:
+            return data
+        if self.instrumentation is None:
+            return self.decode_data(data)
+        start = time.time()
+        try:
+            return self.decode_data(data)
+        finally:
+            action = getattr(self._instrument_local, 'action', None)
+            self.instrumentation.record_part(action, 'recode', time.time() - start)
     
     def __getattr__(self, attrname):
         '''
         Get a globals-level item from the server, by requesting it as an
         attribute from the connection object
         '''
+        if self._prefetch_schema is not None:
+            if self._global_ids is None:
+                self.prefetch_schemas()
+            if attrname in self._global_ids:
+                obj_id, obj_class = self._global_ids[attrname]
+                # The connection already holds the server's reference
+                return self.get_proxy(obj_id, obj_class, 0)
         return self.get_object_item(-1, attrname)
     
     def __getitem__(self, itemname):
@@ -325,6 +949,409 @@ class NukeConnection(object):
         '''
         return self.__repr__()
 
+class NukeAsyncConnection(NukeConnection):
+    '''
+    A NukeConnection that can have many requests in flight at once.
+
+    Each request is sent with an id, and a thread reading from the socket
+    matches each reply to the request with the same id as it arrives, so
+    requests do not have to wait for each other. The server handles the
+    requests of a session at the same time, and answers them in whatever
+    order they finish, so requests that depend on each other should wait
+    for the earlier ones first.
+
+    The *_async() methods send a request and return a NukeFuture for its
+    result straight away, which makes it possible to talk to many servers
+    at once from a single thread:
+
+        futures = [conn.call_async(conn.nuke.allNodes) for conn in connections]
+        for future in as_completed(futures, timeout=10):
+            print len(future.result())
+
+    Everything else works as it does for a NukeConnection, and can be used
+    from several threads at once without them waiting for each other's
+    replies.
+
+    Callbacks added to the futures are run by the thread reading replies,
+    so they must not wait for any other reply from the same connection.
+
+    If the server is too old to support request ids, requests are sent
+    one at a time, and the futures returned are already finished.
+    '''
+    request_ids = True
+
+    def __init__(self, *args, **kwargs):
+        # The requests waiting for replies, by request id
+        self._requests = {}
+        self._request_counter = itertools.count()
+        NukeConnection.__init__(self, *args, **kwargs)
+
+    def open_session(self):
+        '''
+        Open a new socket and introduce ourselves to the server on it, and
+        then start reading replies from it, if the server agreed to use
+        request ids
+        '''
+        s = NukeConnection.open_session(self)
+        if self._request_ids:
+            self._requests = {}
+            t = threading.Thread(None, self.read_replies, args=(s, self._serializer, self._requests))
+            t.setDaemon(True)
+            t.start()
+        return s
+
+    def close(self):
+        '''
+        Close the session with the server, failing any requests that are
+        still waiting for a reply
+        '''
+        if self._socket is not None:
+            try:
+                # Wake up the thread reading replies
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        NukeConnection.close(self)
+
+    def send(self, data):
+        '''
+        Serialize some data, send it to the server, and then wait for a
+        response and return it deserialized
+        '''
+        future = self.send_async(data)
+        result = future.result()
+        # The thread reading replies can still be holding on to the future
+        # for a moment, so let go of the result here, for its objects to
+        # be released as soon as the caller drops them
+        future.store()
+        return result
+
+    def send_async(self, data, decode=False, keep=None):
+        '''
+        Serialize some data and send it to the server, and return a
+        NukeFuture for the response.
+        If 'decode' is True, the response is decoded once it arrives, and
+        the future raises it if it is an exception. Otherwise it is passed
+        back as it is, in the same way as send() does.
+        'keep' is held on to until the request is answered, along with the
+        data, for any objects that the data only refers to by id.
+        '''
+        future = NukeFuture()
+        self._socket_lock.acquire()
+        try:
+            try:
+                if self._socket is None:
+                    self._socket = self.open_session()
+                if self._request_ids:
+                    start = time.time()
+                    encoded = self._serializer.dumps(data)
+                    if len(encoded) > self._max_message_size:
+                        raise NukeMessageSizeError("Request of %d bytes exceeds the maximum message size of %d bytes" % (len(encoded), self._max_message_size))
+                    request_id = self._request_counter.next() & 0xFFFFFFFF
+                    # The request's data is kept until it is answered, so
+                    # that none of the objects in it can be released first
+                    self._requests[request_id] = (future, data, decode, start, time.time(), len(encoded), keep)
+                    try:
+                        send_message(self._socket, encoded, request_id)
+                    except:
+                        del self._requests[request_id]
+                        raise
+                    self.round_trips += 1
+                    return future
+            except socket.error:
+                self.close()
+                raise NukeConnectionError("Connection with Nuke failed")
+        finally:
+            self._socket_lock.release()
+        self.store_reply(future, NukeConnection.send(self, data), decode)
+        future.notify()
+        return future
+
+    def read_replies(self, sock, serializer, requests):
+        '''
+        Read the replies to requests from a session's socket as they
+        arrive, and finish their futures, until the session is closed.
+        Any requests that have not been answered by then are failed.
+        '''
+        stats = self.instrumentation
+        try:
+            while True:
+                message = recv_message(sock, self._max_message_size, request_ids=True)
+                if message is None:
+                    break
+                request_id, result = message
+                self._socket_lock.acquire()
+                try:
+                    request = requests.pop(request_id, None)
+                finally:
+                    self._socket_lock.release()
+                if request is None:
+                    continue
+                future, data, decode, start, sent, sent_bytes, keep = request
+                received = time.time()
+                try:
+                    reply = serializer.loads(result)
+                except Exception, e:
+                    future.finish(error=e)
+                    continue
+                if stats is not None:
+                    finished = time.time()
+                    stats.record(data.get('action'), finished - start, len(result), sent_bytes,
+                                 serialize = (sent - start) + (finished - received),
+                                 network = received - sent)
+                self.store_reply(future, reply, decode)
+                # Let go of the reply before waking anyone waiting for it,
+                # so that its objects are released as soon as they drop them
+                request = data = keep = reply = None
+                future.notify()
+                future = None
+        except (socket.error, NukeMessageSizeError):
+            pass
+        self._socket_lock.acquire()
+        try:
+            if self._socket is sock:
+                self.close()
+            else:
+                sock.close()
+            unanswered = requests.values()
+            requests.clear()
+        finally:
+            self._socket_lock.release()
+        for request in unanswered:
+            request[0].finish(error=NukeConnectionError("Connection with Nuke failed"))
+
+    def store_reply(self, future, reply, decode):
+        '''
+        Store the reply to a request in its future, ready to be notified
+        '''
+        if not decode:
+            future.store(reply)
+        elif isinstance(reply, Exception):
+            future.store(error=reply)
+        else:
+            try:
+                future.store(self.decode(reply))
+            except Exception, e:
+                future.store(error=e)
+
+    def get_async(self, item_type, item_id = -1, parameters = None, target = None):
+        '''
+        Send a request in the same way as get(), and return a NukeFuture
+        for its decoded result.
+        The NukeObject with id 'item_id' should be passed as 'target'. It
+        and the parameters are kept until the request is answered, so that
+        releasing them cannot overtake the request on the server.
+        '''
+        return self.send_async(self.encode(self.request(item_type, item_id, parameters)), decode=True,
+                               keep=(target, parameters))
+
+    def call_async(self, func, *args, **kwargs):
+        '''
+        Call a NukeObject or a method of one on the server, and return a
+        NukeFuture for the result
+        future = func(*args, **kwargs)
+        '''
+        if isinstance(func, NukeRemoteMethod):
+            return self.get_async("callattr", func._object._id, {'name': func._name, 'args': args, 'kwargs': kwargs},
+                                  func._object)
+        return self.get_async("call", func._id, {'args': args, 'kwargs': kwargs}, func)
+
+    def getattr_async(self, obj, name):
+        '''
+        Get an attribute from a NukeObject, and return a NukeFuture for it
+        future = obj.name
+        '''
+        return self.get_async("getattr", obj._id, name, obj)
+
+    def run_async(self, func, *args, **kwargs):
+        '''
+        Run a function inside Nuke in the same way as run(), and return a
+        NukeFuture for its result
+        '''
+        return self.get_async("exec", parameters = self.run_parameters(func, args, kwargs))
+
+    def evaluate_async(self, expression, **variables):
+        '''
+        Evaluate a Python expression inside Nuke in the same way as
+        evaluate(), and return a NukeFuture for its result
+        '''
+        return self.get_async("eval", parameters = {'expression': expression, 'variables': variables})
+
+    def call_action_async(self, name, *args, **kwargs):
+        '''
+        Perform an action registered on the server in the same way as
+        call_action(), and return a NukeFuture for its result
+        '''
+        return self.get_async(name, parameters = {'args': args, 'kwargs': kwargs})
+
+class NukeFuture(object):
+    '''
+    The eventual result of a request that is still in progress
+    '''
+    # What to raise if the result is not ready in time
+    timeout_error = NukeConnectionError
+    timeout_message = "Timed out waiting for a reply"
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+
+    def finish(self, result=None, error=None):
+        self.store(result, error)
+        self.notify()
+
+    def store(self, result=None, error=None):
+        '''
+        Keep the result (or exception), without waking anyone waiting
+        for it until notify() is called
+        '''
+        self._result = result
+        self._error = error
+
+    def notify(self):
+        '''
+        Mark the future as finished, waking anyone waiting for it and
+        running its callbacks
+        '''
+        self._lock.acquire()
+        try:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            self.run_callback(callback)
+
+    def run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            traceback.print_exc()
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback(future) once the future has finished (or straight
+        away if it already has)
+        '''
+        self._lock.acquire()
+        try:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        self.run_callback(callback)
+
+    def add_listener(self, queue):
+        '''
+        Have the future put itself in 'queue' once it has finished
+        '''
+        self.add_done_callback(queue.put)
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise self.timeout_error(self.timeout_message)
+
+    def result(self, timeout=None):
+        '''
+        Wait for the future to finish, and return its result (or raise
+        its exception)
+        '''
+        self.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        '''
+        Wait for the future to finish, and return its exception (or None
+        if it succeeded)
+        '''
+        self.wait(timeout)
+        return self._error
+
+def as_completed(futures, timeout=None):
+    '''
+    Yield each of the NukeFutures (or NukeClusterTasks) as it finishes.
+    Raises NukeConnectionError if they have not all finished within
+    'timeout' seconds.
+    '''
+    finished = Queue.Queue()
+    futures = list(futures)
+    for future in futures:
+        future.add_listener(finished)
+    if timeout is not None:
+        end = time.time() + timeout
+    for i in xrange(len(futures)):
+        if timeout is None:
+            yield finished.get()
+            continue
+        try:
+            yield finished.get(True, max(end - time.time(), 0))
+        except Queue.Empty:
+            raise NukeConnectionError("Timed out waiting for %d of %d requests" % (len(futures) - i, len(futures)))
+
+class NukeActions(object):
+    '''
+    Gives access to the actions registered on the server as methods:
+    conn.actions.<name>(*args, **kwargs)
+    '''
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        connection = self._connection
+        def action(*args, **kwargs):
+            return connection.call_action(name, *args, **kwargs)
+        action.__name__ = name
+        return action
+
+    def __dir__(self):
+        return sorted(self._connection.list_actions())
+
+
+class NukeSamples(object):
+    '''
+    Image samples sent back by NukeConnection.sample(): 32-bit floats in
+    rows from the bottom up, with the channels of each pixel together.
+    'shape' is (height, width, number of channels).
+    '''
+    def __init__(self, data, shape, channels, byteorder):
+        self.data = data
+        self.shape = tuple(shape)
+        self.channels = channels
+        self.byteorder = byteorder
+
+    def array(self):
+        '''
+        Get the samples as a flat array.array of floats
+        '''
+        samples = array.array('f')
+        samples.fromstring(self.data)
+        if self.byteorder != sys.byteorder:
+            samples.byteswap()
+        return samples
+
+    def numpy(self):
+        '''
+        Get the samples as a read-only NumPy array of the right shape,
+        which uses the received data without copying it
+        '''
+        if numpy is None:
+            raise ImportError("NumPy is not available")
+        dtype = numpy.dtype(numpy.float32).newbyteorder(self.byteorder == "little" and "<" or ">")
+        return numpy.frombuffer(self.data, dtype).reshape(self.shape)
+
+
 class NukeObject(object):
     '''
     The class that is used on the client to represent objects on the server
@@ -333,9 +1360,13 @@ class NukeObject(object):
     ensuring that it is passed through to the server, and the appropriate
     result is returned
     '''
-    def __init__(self, connection, id):
+    def __init__(self, connection, id, obj_class=None, refs=1):
         self.__dict__['_id'] = id
         self.__dict__['_connection'] = connection
+        # The key of the object's schema, if the server sent it
+        self.__dict__['_class'] = obj_class
+        # The number of times the server has passed this object to us
+        self.__dict__['_refs'] = refs
     
     def __getattr__(self, attrname):
         '''
@@ -347,8 +1378,13 @@ class NukeObject(object):
         '''
         if attrname in self.__dict__:
             return self.__dict__[attrname]
-        else:
-            return self._connection.get_object_attribute(self._id, attrname)
+        schema = self._connection.get_schema(self)
+        if schema is not None:
+            if attrname in schema['callables']:
+                return NukeRemoteMethod(self, attrname)
+            if attrname in schema['constants']:
+                return schema['constants'][attrname]
+        return self._connection.get_object_attribute(self._id, attrname)
         
     def __setattr__(self, attrname, value):
         '''
@@ -389,8 +1425,24 @@ class NukeObject(object):
         result = len(object)
         '''
         return self._connection.get_object_length(self._id)
-    
-    def __str__(self):
+
+    def __iter__(self):
+        '''
+        Iterate over the object a page of items at a time
+
+        for item in object:
+        '''
+        return self._connection.iterate(self)
+
+    def __contains__(self, item):
+        '''
+        Check whether the object contains an item
+
+        result = item in object
+        '''
+        return self._connection.get_object_contains(self._id, item)
+    
+    def __str__(self):
         '''
         Get the string equivalent of the object
         
@@ -408,11 +1460,13 @@ class NukeObject(object):
 
     def __del__(self):
         '''
-        Delete an object
+        Release the object on the server once there are no more
+        references to it on the client
         
         del object
         '''
-        return self._connection.delete_object(self._id)
+        if self._refs:
+            self._connection.release_object(self._id, self._refs)
        
     def __instancecheck__(cls, inst):
         '''
@@ -431,6 +1485,207 @@ class NukeObject(object):
         return self._connection.get_object_issubclass(self._id, subclass)
 
 
+class NukeRemoteMethod(object):
+    '''
+    Stands in for a method or function of an object on the server, when
+    the object's schema says that the attribute is one.
+    Calling it takes a single request, without getting the method itself
+    from the server first. Anything else done with it does get the method
+    from the server, and passes it on to that.
+    '''
+    def __init__(self, obj, name):
+        self._object = obj
+        self._name = name
+        self._method = None
+
+    def _resolve(self):
+        '''
+        Get the NukeObject for the actual method
+        '''
+        if self._method is None:
+            self._method = self._object._connection.get_object_attribute(self._object._id, self._name)
+        return self._method
+
+    def __call__(self, *args, **kwargs):
+        return self._object._connection.call_object_method(self._object._id, self._name, args, kwargs)
+
+    def __getattr__(self, attrname):
+        return getattr(self._resolve(), attrname)
+
+    def __str__(self):
+        return str(self._resolve())
+
+    def __repr__(self):
+        return repr(self._resolve())
+
+
+class NukeBatch(object):
+    '''
+    Queues up operations on the server so that they can all be sent in a
+    single request, rather than one request per operation.
+    It is designed to be used as the 'as' assignment in a 'with' statement,
+    and the queued operations are sent when the 'with' block finishes.
+
+    Example usage:
+
+        with conn.batch() as batch:
+            nuke = batch.nuke
+            for i in range(200):
+                blur = nuke.createNode('Blur')
+                blur['size'].setValue(i)
+                names.append(blur.name())
+        print [batch.result(name) for name in names]
+
+    Getting things from the batch (or from anything returned by it) gives
+    a NukeBatchResult, which stands in for the eventual result and can be
+    used in later operations of the same batch. Existing NukeObjects can be
+    brought into a batch with wrap().
+
+    The operations are run in order. If one fails, its exception is kept in
+    place of its result and the rest still run, although any that use the
+    failed result fail in the same way.
+    '''
+    def __init__(self, connection):
+        self._connection = connection
+        self._operations = []
+        self.results = None
+
+    def add(self, action, obj, parameters = None):
+        '''
+        Queue an action on an object, which may be a NukeObject,
+        a NukeBatchResult from this batch, or None for the globals.
+        Returns a NukeBatchResult for the result of the action.
+        '''
+        if self.results is not None:
+            raise RuntimeError("Cannot add operations to a batch that has already been run")
+        if obj is None:
+            obj_id = -1
+        elif isinstance(obj, NukeObject):
+            obj_id = obj._id
+        else:
+            obj_id = obj
+        self._operations.append({'action': action, 'id': obj_id, 'parameters': parameters})
+        return NukeBatchResult(self, len(self._operations) - 1)
+
+    def wrap(self, obj):
+        '''
+        Get a NukeBatchResult standing in for an existing NukeObject,
+        so that operations on it are added to this batch
+        '''
+        return NukeBatchWrapper(self, obj)
+
+    def run(self):
+        '''
+        Send the queued operations to the server, and return their results
+        '''
+        if self.results is None:
+            self.results = self._connection.run_batch(self._operations)
+        return self.results
+
+    def result(self, batch_result):
+        '''
+        Get the result of a queued operation once the batch has been run,
+        raising its exception if it failed
+        '''
+        if self.results is None:
+            raise RuntimeError("The batch has not been run yet")
+        result = self.results[batch_result._index]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def encode_result(self, batch_result):
+        '''
+        Encode a NukeBatchResult to be passed through the connection.
+        Before the batch has been run, this is a reference to the operation
+        that will produce it. Afterwards, it is the result itself. A wrapped
+        object is always the object itself.
+        '''
+        if batch_result._batch is not self:
+            raise TypeError("Results can only be used within the batch that produced them")
+        if batch_result._index is None:
+            return self._connection.encode_data_object(batch_result._target())
+        if self.results is not None:
+            return self._connection.encode_data(self.result(batch_result))
+        return {'type': "NukeTransferBatchReference", 'index': batch_result._index}
+
+    def persistent_id(self, batch_result):
+        '''
+        Get the persistent id of a NukeBatchResult, in the same way as
+        encode_result()
+        '''
+        if batch_result._batch is not self:
+            raise TypeError("Results can only be used within the batch that produced them")
+        if batch_result._index is None:
+            return self._connection.persistent_id(batch_result._target())
+        if self.results is not None:
+            result = self.result(batch_result)
+            if isinstance(result, NukeObject):
+                return ('object', result._id)
+            return ('value', result)
+        return ('batch', batch_result._index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.run()
+
+    def __getattr__(self, attrname):
+        '''
+        Queue getting a globals-level item from the server
+        '''
+        return self.add("getitem", None, attrname)
+
+    def __getitem__(self, itemname):
+        return self.__getattr__(itemname)
+
+class NukeBatchResult(object):
+    '''
+    Stands in for the result of an operation queued in a NukeBatch.
+    Getting or setting attributes or items on it, or calling it, queues
+    those operations in the same batch.
+    '''
+    def __init__(self, batch, index):
+        self.__dict__['_batch'] = batch
+        self.__dict__['_index'] = index
+
+    def _target(self):
+        return self
+
+    def __getattr__(self, attrname):
+        if attrname in self.__dict__:
+            return self.__dict__[attrname]
+        if attrname.startswith('__'):
+            # Don't queue operations for special method lookups
+            raise AttributeError(attrname)
+        return self._batch.add("getattr", self._target(), attrname)
+
+    def __setattr__(self, attrname, value):
+        self._batch.add("setattr", self._target(), (attrname, value))
+
+    def __getitem__(self, itemname):
+        return self._batch.add("getitem", self._target(), itemname)
+
+    def __setitem__(self, itemname, value):
+        self._batch.add("setitem", self._target(), (itemname, value))
+
+    def __call__(self, *args, **kwargs):
+        return self._batch.add("call", self._target(), {'args': args, 'kwargs': kwargs})
+
+class NukeBatchWrapper(NukeBatchResult):
+    '''
+    Stands in for an existing NukeObject within a NukeBatch
+    '''
+    def __init__(self, batch, obj):
+        NukeBatchResult.__init__(self, batch, None)
+        self.__dict__['_object'] = obj
+
+    def _target(self):
+        return self._object
+
+
 class NukeCommandManager(object):
     '''
     This class internally manages a Nuke command client-server pair.
@@ -462,20 +1717,45 @@ class NukeCommandManager(object):
     its companion server the 'shutdown' signal. This will cause the
     server to send back its shutdown message, close the connection to
     the client, and exit cleanly.
+
+    If the server process exits before calling back, the manager gives up
+    straight away. Otherwise it waits up to 'startup_timeout' seconds.
+    A server that fails to get a license is started again after
+    'license_retry_delay' seconds, up to 'license_retry_count' times. The
+    delay is multiplied by 'license_retry_backoff' after each attempt,
+    up to 'license_retry_max_delay' seconds.
+
+    Once the server has started, 'timeline' holds the time in seconds
+    from spawning the process to each of these start up events:
+    'spawn', 'interpreter_up' (the server script started running),
+    'port_bound', 'callback' (the manager heard from the server) and
+    'first_command' (the server answered the client's first request).
     '''
-    def __init__(self, license_retry_count=5, license_retry_delay=5, extra_nuke_args=()):
+    # Arguments passed to the managed server script after the manager port
+    server_args = ()
+    # Whether to collect the output of the Nuke process, which is then
+    # available as 'nuke_stdout' and 'nuke_stderr' once it has exited
+    capture_output = True
+
+    def __init__(self, license_retry_count=5, license_retry_delay=5, extra_nuke_args=(), license_retry_backoff=1, license_retry_max_delay=None, startup_timeout=15):
         self.manager_port = -1
         self.manager_socket = None
         self.server_port = -1
+        self.server_proc = None
         self.client = None
         self.license_retry_count = license_retry_count
         self.license_retry_delay = license_retry_delay
+        self.license_retry_backoff = license_retry_backoff
+        self.license_retry_max_delay = license_retry_max_delay
+        self.startup_timeout = startup_timeout
         self.nuke_stdout, self.nuke_stderr = None, None
+        self.spawn_time = None
+        self.timeline = {}
 
         bound_port = False
 
         manager = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        manager.settimeout(15.0)
+        manager.settimeout(startup_timeout)
         manager.bind(('', 0))
         bound_port = True
         self.manager_port = manager.getsockname()[1]
@@ -486,6 +1766,16 @@ class NukeCommandManager(object):
         self.extra_nuke_args = extra_nuke_args
 
     def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        '''
+        Start the server process, and return a NukeConnection to it.
+        Each manager can only start a single server.
+        '''
         if not self.manager_socket:
             raise NukeManagerError("Manager failed to initialize socket.")
         backlog = 5
@@ -501,84 +1791,142 @@ class NukeCommandManager(object):
         except:
             self.shutdown_server()
             raise
+        # Connecting sends the server its first command
+        self.mark('first_command')
         return self.client
 
-    def __exit__(self, type, value, traceback):
+    def stop(self):
+        '''
+        Shut down the server process, and wait for it to exit
+        '''
         self.client.shutdown_server()
         self.nuke_stdout, self.nuke_stderr = self.server_proc.communicate()
 
+    def mark(self, event, when=None):
+        '''
+        Record when a start up event happened in the timeline
+        '''
+        if when is None:
+            when = time.time()
+        self.timeline[event] = when - self.spawn_time
+
     def start_server(self):
         if not THIS_FILE:
             raise RuntimeError("could not determine absolute path to %s module" % globals()['__name__'])
     
         # Make sure the port number has a trailing space... this is a bug in Nuke's
         # Python argument parsing (logged with The Foundry as Bug 17918)
-        procArgs = ([NUKE_EXEC, '-t', '-m', '1'] + list(self.extra_nuke_args) + ['--', THIS_FILE, '%d ' % self.manager_port],)
+        procArgs = ([NUKE_EXEC, '-t', '-m', '1'] + list(self.extra_nuke_args) + ['--', THIS_FILE, '%d ' % self.manager_port] + list(self.server_args),)
+        output = None
+        if self.capture_output:
+            output = subprocess.PIPE
         for i in xrange(self.license_retry_count+1):
-            self.server_proc = subprocess.Popen(stdout=subprocess.PIPE,
-                                               stderr=subprocess.PIPE,
+            self.timeline = {}
+            self.spawn_time = time.time()
+            self.server_proc = subprocess.Popen(stdout=output,
+                                               stderr=output,
                                                *procArgs)
-            startTime = time.time()
-            timeout = startTime + 15 # Timeout after 10 seconds of waiting for server
+            self.mark('spawn')
             try:
-                while True:
-                    try:
-                        # Times out after 15 seconds based on the socket settings
-                        server, address = self.manager_socket.accept()
-                    except socket.timeout:
-                        retCode = self.server_proc.poll()
-                        if retCode:
-                            if retCode == 100: # License failure.
-                                raise NukeLicenseError
-                            else: # Nuke died with another return code
-                                print "Nuke process died with an unexpected return code"
-                                raise NukeManagerError("Server process failed to start. Nuke exited with code %s." % retCode)
-                        elif retCode is None:
-                            # Nuke is still running
-                            print "Nuke process is still alive but hasn't responded to the Manager yet (timed out)."
-                            raise nukeManagerError("Nuke process hasn't exited, but hasn't responded to the Manager either.")
-                        else: # Nuke exited cleanly (0) for some reason
-                            print "Nuke exited with code 0 (server script failed to start running)"
-                            raise NukeManagerError("Server process failed to start properly.")
-                    data = server.recv(SOCKET_BUFFER_SIZE)
-                    if data:
-                        serverData = pickle.loads(data)
-                        server.close()
-                        if not serverData[0]:
-                            raise NukeServerError("Server could not find port to bind to.")
-                        self.server_port = serverData[1]
-                        break
-                    if time.time() >= timeout:
-                        raise NukeManagerError("Manager timed out waiting for server connection.")
+                self.wait_for_callback()
 
             except NukeConnectionError, e:
                 traceback.print_exc()
-                try:
-                    self.shutdown_server()
-                except NukeServerError, se:
-                    self.nuke_stdout = self.nuke_stderr = ""
-                    print "Error in emergency Nuke shutdown:"
-                    print se
-                else:
-                    retCode = self.server_proc.poll()
-                    if retCode is not None:
-                        self.nuke_stdout, self.nuke_stderr = self.server_proc.communicate()
-                    else:
-                        print "Issuing shell kill on stalled process"
-                        #FIXME: Kill is not cross-platform
-                        subprocess.call(["kill", "-9", self.server_proc.pid])
-
-                e.nuke_sdout, e.nuke_stderr = self.nuke_stdout, self.nuke_stderr
+                self.stop_failed_server()
+                e.nuke_stdout, e.nuke_stderr = self.nuke_stdout, self.nuke_stderr
                 raise
 
             except NukeLicenseError:
-                print "License error. Retrying in %d seconds..." % self.license_retry_delay
-                time.sleep(self.license_retry_delay)
+                if i == self.license_retry_count:
+                    break
+                delay = self.license_retry_delay * self.license_retry_backoff ** i
+                if self.license_retry_max_delay is not None:
+                    delay = min(delay, self.license_retry_max_delay)
+                print "License error. Retrying in %g seconds..." % delay
+                time.sleep(delay)
             else:
                 return
 
         raise NukeLicenseError("Maximum license retry count exceeded. Aborting.")
 
+    def wait_for_callback(self):
+        '''
+        Wait for the server to call back to the manager with its port.
+        This returns as soon as the callback arrives, and raises as soon
+        as the server process exits without making it, rather than waiting
+        for the whole start up timeout.
+        '''
+        timeout = self.spawn_time + self.startup_timeout
+        while True:
+            remaining = timeout - time.time()
+            if remaining <= 0:
+                # Nuke is still running
+                print "Nuke process is still alive but hasn't responded to the Manager yet (timed out)."
+                raise NukeManagerError("Nuke process hasn't exited, but hasn't responded to the Manager either.")
+            readable = select.select([self.manager_socket], [], [], min(remaining, MANAGER_POLL_INTERVAL))[0]
+            if readable:
+                server, address = self.manager_socket.accept()
+                if self.read_callback(server):
+                    return
+                continue
+
+            retCode = self.server_exit_code()
+            if retCode is None:
+                continue
+            if retCode == 100: # License failure.
+                raise NukeLicenseError
+            elif retCode: # Nuke died with another return code
+                print "Nuke process died with an unexpected return code"
+                raise NukeManagerError("Server process failed to start. Nuke exited with code %s." % retCode)
+            else: # Nuke exited cleanly (0) for some reason
+                print "Nuke exited with code 0 (server script failed to start running)"
+                raise NukeManagerError("Server process failed to start properly.")
+
+    def server_exit_code(self):
+        '''
+        Get the exit code of the server process, or None if it is running
+        '''
+        return self.server_proc.poll()
+
+    def stop_failed_server(self):
+        '''
+        Shut down a server process that failed to start properly,
+        killing it if it will not shut down, and collect its output
+        '''
+        if self.server_proc.poll() is None and self.server_port != -1:
+            try:
+                self.shutdown_server()
+            except NukeServerError, se:
+                print "Error in emergency Nuke shutdown:"
+                print se
+        if self.server_proc.poll() is None:
+            print "Killing stalled Nuke process"
+            self.server_proc.kill()
+        self.nuke_stdout, self.nuke_stderr = self.server_proc.communicate()
+
+    def read_callback(self, server):
+        '''
+        Read the status and port that a managed server sends to the
+        manager once it has started.
+        Returns False if the server closed the connection without them.
+        '''
+        try:
+            data = recv_message(server)
+        finally:
+            server.close()
+        if not data:
+            return False
+        self.mark('callback')
+        serverData = pickle.loads(data)
+        if not serverData[0]:
+            raise NukeServerError("Server could not find port to bind to.")
+        self.server_port = serverData[1]
+        # Servers also send the times of their own start up events
+        if len(serverData) > 2:
+            for event, when in serverData[2].items():
+                self.mark(event, when)
+        return True
+
     def shutdown_server(self):
         '''
         Used to shut down a managed server if its
@@ -589,8 +1937,8 @@ class NukeCommandManager(object):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             s.connect(('', self.server_port))
-            s.send(pickle.dumps(packet))
-            result = s.recv(SOCKET_BUFFER_SIZE)
+            send_message(s, pickle.dumps(packet))
+            result = recv_message(s)
             s.close()
             return pickle.loads(result)
         except socket.error:
@@ -598,19 +1946,581 @@ class NukeCommandManager(object):
             raise NukeServerError("Server failed to initialize.")
 
 
-def start_managed_nuke_server(manager_port=None):
+class NukeZygote(NukeCommandManager):
+    '''
+    Starts a single terminal instance of Nuke that is kept running, and
+    forks a copy of it for each managed server that is asked for. A forked
+    server starts almost immediately, and begins with a clean copy of the
+    zygote's interpreter, sharing its memory until either of them writes
+    to it. This is only supported on Linux.
+
+    Example usage:
+
+        with NukeZygote(preload=['nukescripts']) as zygote:
+            with zygote.manager() as conn:
+                nuke = conn.nuke
+                b = nuke.createNode('Blur')
+                print b.writeKnobs()
+
+    Any modules named in 'preload' are imported by the zygote before it
+    forks any servers. Any other keyword arguments are passed on to
+    NukeCommandManager.
+
+    Servers that are still running when the zygote is stopped are left
+    running until their own managers shut them down.
+    '''
+    # The zygote's output is not collected, as forked servers share it
+    # for as long as they are running
+    capture_output = False
+
+    def __init__(self, preload=(), **manager_args):
+        NukeCommandManager.__init__(self, **manager_args)
+        self.server_args = ['zygote'] + list(preload)
+
+    def start(self):
+        '''
+        Start the zygote process
+        '''
+        if not sys.platform.startswith('linux'):
+            raise NukeManagerError("Forking servers is only supported on Linux")
+        if not self.manager_socket:
+            raise NukeManagerError("Manager failed to initialize socket.")
+        self.manager_socket.listen(5)
+        self.start_server()
+        self.manager_socket.close()
+        return self
+
+    def stop(self):
+        '''
+        Shut down the zygote process, and wait for it to exit
+        '''
+        self.send_request({'action': 'shutdown'})
+        self.server_proc.wait()
+
+    def send_request(self, request):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(('localhost', self.server_port))
+            send_message(s, pickle.dumps(request))
+            result = recv_message(s)
+        finally:
+            s.close()
+        if result is None:
+            raise NukeServerError("Zygote closed the connection without replying.")
+        result = pickle.loads(result)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def fork(self, manager_port, manager_host='localhost'):
+        '''
+        Fork a managed server that calls back to the manager on
+        'manager_port' once it has started. Returns its process ID.
+        '''
+        return self.send_request({'action': 'fork', 'manager_port': manager_port, 'manager_host': manager_host})
+
+    def exit_code(self, pid):
+        '''
+        Get the exit code of a server forked by the zygote, or None if it
+        is still running
+        '''
+        return self.send_request({'action': 'status', 'pid': pid})
+
+    def manager(self, **manager_args):
+        '''
+        Get a NukeCommandManager that forks its server from this zygote
+        '''
+        return NukeForkedManager(self, **manager_args)
+
+class NukeForkedManager(NukeCommandManager):
+    '''
+    A NukeCommandManager whose server is forked from a running NukeZygote,
+    rather than started from scratch
+    '''
+    def __init__(self, zygote, **manager_args):
+        NukeCommandManager.__init__(self, **manager_args)
+        self.zygote = zygote
+        self.server_pid = None
+
+    def start_server(self):
+        self.timeline = {}
+        self.spawn_time = time.time()
+        # The server can be up before the zygote has replied
+        self.mark('spawn')
+        self.server_pid = self.zygote.fork(self.manager_port)
+        self.wait_for_callback()
+
+    def server_exit_code(self):
+        # The zygote is the parent of the server, so only it can tell
+        if self.server_pid is None:
+            return None
+        try:
+            return self.zygote.exit_code(self.server_pid)
+        except (socket.error, NukeServerError):
+            return None
+
+    def stop(self):
+        '''
+        Shut down the server. The zygote waits for it to exit.
+        '''
+        self.client.shutdown_server()
+
+
+class NukeServerPool(object):
+    '''
+    Keeps a number of managed Nuke servers running, so that they can be
+    leased out without waiting for Nuke to start up each time.
+
+    Example usage:
+
+        pool = NukeServerPool(4)
+        with pool.lease() as conn:
+            nuke = conn.nuke
+            b = nuke.createNode('Blur')
+            print b.writeKnobs()
+        pool.close()
+
+    Leases can be taken from any number of threads at once. If every
+    server is in use, lease() waits for one to be returned.
+
+    At the end of each lease the server's script is cleared and the
+    connection's session is closed, so the server drops every object
+    handed out during the lease.
+    A server is shut down and replaced with a fresh one once it has been
+    leased 'max_leases' times, or once its process is using more than
+    'max_memory' bytes.
+
+    Any other keyword arguments are passed on to each NukeCommandManager.
+    '''
+    def __init__(self, size=2, max_leases=None, max_memory=None, **manager_args):
+        self.size = size
+        self.max_leases = max_leases
+        self.max_memory = max_memory
+        self.manager_args = manager_args
+        self._condition = threading.Condition()
+        self._idle = []
+        self._busy = {}
+        self._lease_counts = {}
+        self._starting = 0
+        self._start_error = None
+        self._closed = False
+        self._created = time.time()
+        self._stats = {'leases': 0, 'started': 0, 'recycled': 0, 'failed': 0, 'wait_time': 0.0, 'busy_time': 0.0}
+        self.fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def lease(self, timeout=None):
+        '''
+        Return a context manager that leases a server for the duration
+        of a 'with' block, giving a NukeConnection to it
+        '''
+        return NukeServerLease(self, timeout)
+
+    def fill(self, wait=True):
+        '''
+        Start as many servers as the pool is short of. If 'wait' is
+        False, they are left starting in the background.
+        '''
+        self._condition.acquire()
+        try:
+            missing = self.size - len(self._idle) - len(self._busy) - self._starting
+            missing = max(missing, 0)
+            self._starting += missing
+        finally:
+            self._condition.release()
+        threads = [self._start_in_background() for i in xrange(missing)]
+        if wait:
+            for t in threads:
+                t.join()
+
+    def _start_in_background(self):
+        t = threading.Thread(None, self.start_server)
+        t.setDaemon(True)
+        t.start()
+        return t
+
+    def start_server(self):
+        '''
+        Start a single server and add it to the pool. The caller must have
+        already counted it as starting.
+        '''
+        manager = None
+        error = None
+        try:
+            manager = NukeCommandManager(**self.manager_args)
+            manager.start()
+        except Exception, e:
+            manager = None
+            error = e
+        self._condition.acquire()
+        try:
+            self._starting -= 1
+            if manager is None:
+                self._stats['failed'] += 1
+                self._start_error = error
+            elif not self._closed:
+                self._stats['started'] += 1
+                self._lease_counts[manager] = 0
+                self._idle.append(manager)
+                manager = None
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        if manager is not None:
+            # The pool was closed while the server was starting
+            self.stop_server(manager)
+
+    def stop_server(self, manager):
+        '''
+        Shut down a server, killing it if it does not respond
+        '''
+        try:
+            manager.stop()
+        except Exception:
+            if manager.server_proc.poll() is None:
+                manager.server_proc.kill()
+            manager.server_proc.communicate()
+
+    def acquire(self, timeout=None):
+        '''
+        Take an idle server from the pool, waiting up to 'timeout' seconds
+        (or forever if it is None) for one to be available.
+        Returns the server's NukeCommandManager.
+        '''
+        start = time.time()
+        self._condition.acquire()
+        try:
+            while True:
+                if self._closed:
+                    raise NukeManagerError("Server pool has been closed")
+                if self._idle:
+                    manager = self._idle.pop()
+                    break
+                if not self._starting and len(self._busy) < self.size:
+                    # A server failed to start (or was lost), so try again,
+                    # passing on the failure to one waiting caller
+                    if self._start_error is not None:
+                        error, self._start_error = self._start_error, None
+                        raise error
+                    self._starting += 1
+                    self._start_in_background()
+                remaining = None
+                if timeout is not None:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        raise NukeManagerError("Timed out waiting for a server from the pool")
+                self._condition.wait(remaining)
+            now = time.time()
+            self._busy[manager] = now
+            self._lease_counts[manager] += 1
+            self._stats['leases'] += 1
+            self._stats['wait_time'] += now - start
+        finally:
+            self._condition.release()
+        return manager
+
+    def release(self, manager):
+        '''
+        Reset a leased server and return it to the pool, replacing it
+        if it has been used too much
+        '''
+        recycle = False
+        try:
+            conn = manager.client
+            if self.max_memory is not None:
+                memory = conn.server_stats().get('memory')
+                recycle = memory is not None and memory > self.max_memory
+            conn.nuke.scriptClear()
+            conn.close()
+        except Exception:
+            # The server has died or stopped responding
+            recycle = True
+
+        self._condition.acquire()
+        try:
+            self._stats['busy_time'] += time.time() - self._busy.pop(manager)
+            if self.max_leases and self._lease_counts[manager] >= self.max_leases:
+                recycle = True
+            if self._closed:
+                recycle = True
+            elif recycle:
+                self._stats['recycled'] += 1
+                self._starting += 1
+                self._start_in_background()
+            else:
+                self._idle.append(manager)
+            if recycle:
+                del self._lease_counts[manager]
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        if recycle:
+            self.stop_server(manager)
+
+    def report(self):
+        '''
+        Get a dictionary describing the state of the pool and how much it
+        has been used. 'utilisation' is the fraction of the pool's total
+        server time (since it was created) that servers spent leased out.
+        '''
+        self._condition.acquire()
+        try:
+            now = time.time()
+            report = dict(self._stats)
+            report['busy_time'] += sum([now - start for start in self._busy.values()])
+            report.update({
+                'size': self.size,
+                'idle': len(self._idle),
+                'busy': len(self._busy),
+                'starting': self._starting,
+                'utilisation': report['busy_time'] / max(self.size * (now - self._created), 1e-9),
+            })
+            if report['leases']:
+                report['mean_wait_time'] = report['wait_time'] / report['leases']
+            return report
+        finally:
+            self._condition.release()
+
+    def close(self):
+        '''
+        Shut down every idle server. Servers that are leased out are
+        shut down when they are returned.
+        '''
+        self._condition.acquire()
+        try:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            for manager in idle:
+                del self._lease_counts[manager]
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        for manager in idle:
+            self.stop_server(manager)
+
+class NukeServerLease(object):
+    '''
+    Leases a server from a NukeServerPool for the duration
+    of a 'with' block
+    '''
+    def __init__(self, pool, timeout=None):
+        self.pool = pool
+        self.timeout = timeout
+        self.manager = None
+
+    def __enter__(self):
+        self.manager = self.pool.acquire(self.timeout)
+        return self.manager.client
+
+    def __exit__(self, type, value, traceback):
+        manager, self.manager = self.manager, None
+        self.pool.release(manager)
+
+
+class NukeCluster(object):
+    '''
+    Spreads work across a pool of managed servers, so that many Nuke
+    licenses and processor cores can be used at once.
+
+    Example usage:
+
+        def count_nodes(path, node_class):
+            return len(nuke.allNodes(node_class))
+
+        with NukeCluster(4) as cluster:
+            for path, count in cluster.map(count_nodes, script_paths, "Blur", scripts=True):
+                print path, count
+
+    Each task leases a server from the pool for as long as it runs, so
+    the servers that finish first take on the next tasks. Functions are run
+    inside Nuke with NukeConnection.run(), and so have the same limitations.
+
+    If a server dies or cannot be started while a task is running, the
+    task is tried again on another server, up to 'retries' more times.
+    Exceptions raised by the task itself are not retried.
+
+    The cluster runs a NukeServerPool of 'size' servers (one per processor
+    core by default), which is passed 'pool_args'. An existing pool can be
+    passed in as 'pool' instead.
+    '''
+    def __init__(self, size=None, retries=2, pool=None, **pool_args):
+        if pool is None:
+            if size is None:
+                size = multiprocessing.cpu_count()
+            pool = NukeServerPool(size, **pool_args)
+        self.pool = pool
+        self.retries = retries
+        self._tasks = Queue.Queue()
+        self._workers = []
+        for i in xrange(pool.size):
+            t = threading.Thread(None, self.work)
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Queue func(*args, **kwargs) to be run inside Nuke.
+        Returns a NukeClusterTask for its result.
+        '''
+        return self.add_task(NukeClusterTask(func, args, kwargs))
+
+    def submit_script(self, path, func=None, *args, **kwargs):
+        '''
+        Queue a task that opens the script at 'path', and then runs
+        func(*args, **kwargs) inside Nuke (if a function is given).
+        Returns a NukeClusterTask for its result.
+        '''
+        return self.add_task(NukeClusterTask(func, args, kwargs, script=path))
+
+    def add_task(self, task):
+        self._tasks.put(task)
+        return task
+
+    def map(self, func, items, *args, **kwargs):
+        '''
+        Run func(item, *args, **kwargs) inside Nuke for every item, and
+        return an iterator of (item, result) pairs in the order that
+        they finish.
+        If 'scripts' is True, each item is the path of a script that is
+        opened first.
+        If any task fails, its exception is raised.
+        '''
+        scripts = kwargs.pop('scripts', False)
+        tasks = []
+        for item in items:
+            if scripts:
+                task = self.submit_script(item, func, item, *args, **kwargs)
+            else:
+                task = self.submit(func, item, *args, **kwargs)
+            task.item = item
+            tasks.append(task)
+        return self.results(tasks)
+
+    def results(self, tasks):
+        '''
+        Yield (item, result) pairs for tasks queued by map()
+        as each of them finishes
+        '''
+        for task in self.as_completed(tasks):
+            yield task.item, task.result()
+
+    def as_completed(self, tasks):
+        '''
+        Yield each of the tasks as it finishes
+        '''
+        return as_completed(tasks)
+
+    def work(self):
+        '''
+        Run queued tasks until the cluster is closed
+        '''
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    break
+                self.run_task(task)
+            finally:
+                self._tasks.task_done()
+
+    def run_task(self, task):
+        '''
+        Run a single task on the next free server, or queue it again if
+        the server is lost part way through
+        '''
+        try:
+            manager = self.pool.acquire()
+            try:
+                result = task.run(manager.client)
+            finally:
+                self.pool.release(manager)
+        except (NukeConnectionError, NukeLicenseError), e:
+            # The server was lost (and has been replaced by the pool),
+            # so give the task to the next free server. It is queued
+            # before this one is marked as done, so close() waits for it.
+            task.attempts += 1
+            if task.attempts <= self.retries:
+                self._tasks.put(task)
+            else:
+                task.finish(error=e)
+        except Exception, e:
+            task.finish(error=e)
+        else:
+            task.finish(result)
+
+    def close(self):
+        '''
+        Wait for every queued task to finish, and then shut down the pool
+        '''
+        # Tasks can be queued again by the workers, so wait for all of
+        # them to be done before telling the workers to stop
+        self._tasks.join()
+        for t in self._workers:
+            self._tasks.put(None)
+        for t in self._workers:
+            t.join()
+        self.pool.close()
+
+class NukeClusterTask(NukeFuture):
+    '''
+    A piece of work queued on a NukeCluster
+    '''
+    timeout_error = NukeManagerError
+    timeout_message = "Timed out waiting for task to finish"
+
+    def __init__(self, func, args, kwargs, script=None):
+        NukeFuture.__init__(self)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.script = script
+        self.attempts = 0
+
+    def run(self, conn):
+        if self.script is not None:
+            conn.nuke.scriptOpen(self.script)
+        if self.func is None:
+            return None
+        return conn.run(self.func, *self.args, **self.kwargs)
+
+
+def start_managed_nuke_server(manager_port=None, start_time=None):
     '''
     Convenience function for launching a managed Nuke command
     server instance that will communicate with a NukeCommandManager
     on the specified port. Must be called from within Nuke.
     '''
     import nukeExternalControl.server as comServer
-    comServer.NukeManagedServer(manager_port=manager_port)
+    comServer.NukeManagedServer(manager_port=manager_port, start_time=start_time)
+
+def start_nuke_zygote(manager_port=None, preload=()):
+    '''
+    Convenience function for launching a zygote that forks managed Nuke
+    command servers for a NukeZygote. Must be called from within Nuke.
+    '''
+    import nukeExternalControl.server as comServer
+    comServer.NukeZygoteServer(manager_port=manager_port, preload=preload)
 
 if __name__ == '__main__':
+    start_time = time.time()
     manager_port = None
 
     if len(sys.argv) > 1:
         manager_port = int(sys.argv[1])
 
-    start_managed_nuke_server(manager_port)
+    if sys.argv[2:3] == ['zygote']:
+        start_nuke_zygote(manager_port, sys.argv[3:])
+    else:
+        start_managed_nuke_server(manager_port, start_time)
@@ -1,12 +1,84 @@
+import copy
+import errno
+import getpass
+import json
+import marshal
+import mmap
 import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import cPickle as _pickle
+except ImportError:
+    import pickle as _pickle
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 
 SOCKET_BUFFER_SIZE = 4096
-MAX_SOCKET_BYTES = 2048
+
+# Every message sent over a connection is prefixed with its length, packed
+# as a 4-byte unsigned integer in network byte order.
+MESSAGE_HEADER = struct.Struct('!I')
+
+# On sessions that have agreed to use request ids, the length is followed by
+# the id of the request (another 4-byte unsigned integer), and the reply to
+# each request carries the same id, so that replies can be sent in any order.
+REQUEST_HEADER = struct.Struct('!II')
+
+# The largest single message either end will send or accept, in bytes.
+# This can be overridden per connection or per server.
+MAX_MESSAGE_SIZE = int(os.getenv("NUKE_EXTERNAL_CONTROL_MAX_MESSAGE_SIZE", 512 * 1024 * 1024))
 
 # These constants set the default port range for any automatic searches.
 DEFAULT_START_PORT = 54200
 DEFAULT_END_PORT = 54300
 
+# Whether connections and servers collect NukeStats by default
+INSTRUMENT = bool(os.getenv("NUKE_EXTERNAL_CONTROL_STATS"))
+
+# Messages larger than this many bytes are compressed on connections that
+# have agreed to use compression, at this zlib level
+COMPRESSION_THRESHOLD = 16 * 1024
+COMPRESSION_LEVEL = 1
+
+# Messages larger than this many bytes are passed through shared memory
+# rather than the socket, on connections over a Unix domain socket that
+# have agreed to it
+SHARED_MEMORY_THRESHOLD = 1024 * 1024
+
+# When no server is listed in the registry, clients try every port in the
+# range at once, and wait this long (in seconds) for any of them to answer.
+PROBE_TIMEOUT = 0.5
+
+# Running servers list themselves in this directory, one file per port,
+# so that clients on the same machine can find them straight away.
+def _registry_user():
+    try:
+        return getpass.getuser()
+    except Exception:
+        return "default"
+REGISTRY_DIR = os.getenv("NUKE_EXTERNAL_CONTROL_REGISTRY")
+if REGISTRY_DIR is None:
+    REGISTRY_DIR = os.path.join(tempfile.gettempdir(), "nukeExternalControl-%s" % _registry_user())
+
+# Messages passed through shared memory are written to files in this
+# directory (which is held in memory on Linux), and are deleted as soon
+# as the other end has opened them
+SHARED_MEMORY_DIR = "/dev/shm"
+if not os.path.isdir(SHARED_MEMORY_DIR):
+    SHARED_MEMORY_DIR = tempfile.gettempdir()
+SHARED_MEMORY_PREFIX = "nukeExternalControl-"
+
 # This constant should be set to whatever absolute or relative call your system
 # uses to launch Nuke (excluding any flags or arguments).
 NUKE_EXEC = os.getenv("NUKE_EXEC")
@@ -15,18 +87,669 @@ if NUKE_EXEC is None:
 
 # Safe type lists for pickling. Objects whose types are not included in one
 # of these lists will be represented by proxy objects on the client side.
-basicTypes = [int, float, complex, str, unicode, buffer, xrange, bool, type(None)]
+basicTypes = [int, float, complex, str, unicode, buffer, xrange, slice, bool, type(None)]
 listTypes = [list, tuple, set, frozenset]
+constantTypes = [int, long, float, str, unicode, bool, type(None)]
 dictTypes = [dict]
 
+# Every type that is passed as plain data rather than by proxy
+plainTypes = frozenset(basicTypes + listTypes + constantTypes + dictTypes)
+
+def passed_by_value(obj):
+    '''
+    Check whether an object is passed through a connection as it is,
+    rather than being swapped for a persistent id. That is plain data
+    and exceptions, along with the types pickle uses to rebuild them.
+    '''
+    if type(obj) in plainTypes or isinstance(obj, BaseException):
+        return True
+    return isinstance(obj, type) and (obj in plainTypes or issubclass(obj, BaseException))
+
+# The 'type' values of dictionaries that stand in for something other than
+# plain data when they are passed through a connection
+transferTypes = ["NukeTransferObject", "NukeTransferBatchReference"]
+
+class PickleSerializer(object):
+    '''
+    Serializes messages with a specific pickle protocol
+    '''
+    persistent_ids = False
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.name = "pickle%d" % protocol
+
+    def dumps(self, data, persistent_id = None):
+        if persistent_id is None:
+            return _pickle.dumps(data, self.protocol)
+        f = StringIO()
+        pickler = _pickle.Pickler(f, self.protocol)
+        pickler.persistent_id = persistent_id
+        pickler.dump(data)
+        return f.getvalue()
+
+    def loads(self, data, persistent_load = None):
+        # Pickles can only be loaded from strings, not from buffers
+        # such as mmaps
+        if not isinstance(data, str):
+            data = data[:]
+        if persistent_load is None:
+            return _pickle.loads(data)
+        unpickler = _pickle.Unpickler(StringIO(data))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+    def close(self):
+        pass
+
+class MarshalSerializer(object):
+    '''
+    Serializes messages with marshal, which is much faster than pickle
+    for plain data such as lists of tuples or dictionaries. Anything
+    marshal cannot represent (exceptions, for example) is pickled instead.
+
+    The fallback must use pickle protocol 2 or higher, as every such
+    pickle starts with a PROTO opcode that is never the first byte of
+    marshal data. That means the two can be told apart without tagging
+    (and so copying) every message.
+
+    Note that marshal sends buffer objects as plain strings.
+    '''
+    # The marshal format differs between major Python versions as well
+    # as marshal versions, so both ends need to agree on both
+    name = "marshal%d.%d" % (sys.version_info[0], marshal.version)
+    persistent_ids = False
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def dumps(self, data, persistent_id = None):
+        # Marshal only accepts plain data, so anything that needs a
+        # persistent id is always left to the fallback
+        try:
+            return marshal.dumps(data, marshal.version)
+        except ValueError:
+            return self.fallback.dumps(data, persistent_id)
+
+    def loads(self, data, persistent_load = None):
+        if data[:1] == '\x80':
+            return self.fallback.loads(data, persistent_load)
+        return marshal.loads(data)
+
+    def close(self):
+        pass
+
+class PersistentIdSerializer(object):
+    '''
+    Wraps another serializer, swapping objects that cannot be passed as
+    plain data for persistent ids while they are serialized, and back
+    again while they are deserialized. This avoids copying everything
+    sent through a connection just to find the few objects in it.
+    'persistent_id' is called with every object that is pickled, and
+    returns None for anything that should be pickled as it is.
+
+    Pickle protocol 0 can only carry string persistent ids, so this
+    cannot be used with it.
+    '''
+    persistent_ids = True
+
+    def __init__(self, serializer, persistent_id, persistent_load):
+        self.serializer = serializer
+        self.name = serializer.name
+        self.persistent_id = persistent_id
+        self.persistent_load = persistent_load
+
+    def dumps(self, data):
+        return self.serializer.dumps(data, self.persistent_id)
+
+    def loads(self, data):
+        return self.serializer.loads(data, self.persistent_load)
+
+    def close(self):
+        self.serializer.close()
+
+class CompressedSerializer(object):
+    '''
+    Wraps another serializer, compressing messages of more than
+    'threshold' bytes with zlib. Every message starts with a flag byte
+    saying whether the rest of it is compressed, so this is only used
+    once both ends have agreed to it during the 'initiate' handshake.
+
+    Messages are never allowed to expand past 'max_size' bytes, so a small
+    compressed message cannot be used to exhaust memory.
+    '''
+    def __init__(self, serializer, level=COMPRESSION_LEVEL, threshold=COMPRESSION_THRESHOLD, max_size=MAX_MESSAGE_SIZE):
+        self.serializer = serializer
+        self.name = serializer.name
+        self.persistent_ids = serializer.persistent_ids
+        self.level = level
+        self.threshold = threshold
+        self.max_size = max_size
+
+    def dumps(self, data):
+        data = self.serializer.dumps(data)
+        if len(data) > self.threshold:
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                return '\x01' + compressed
+        return '\x00' + data
+
+    def loads(self, data):
+        if data[:1] == '\x01':
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(buffer(data, 1), self.max_size)
+            if decompressor.unconsumed_tail:
+                raise NukeMessageSizeError("Compressed message expands past the maximum message size of %d bytes" % self.max_size)
+            return self.serializer.loads(data)
+        return self.serializer.loads(data[1:])
+
+    def close(self):
+        self.serializer.close()
+
+class SharedMemorySerializer(object):
+    '''
+    Wraps another serializer, passing messages of more than 'threshold'
+    bytes through a file in SHARED_MEMORY_DIR instead of the socket, and
+    sending just the name of the file. The other end maps the file into
+    memory and deserializes the message straight from it.
+    The name of the file is marked by a first byte of 1, which none of the
+    serializers ever starts a message with, so other messages are passed
+    on untouched. This is only used once both ends
+    have agreed to it during the 'initiate' handshake.
+
+    The other end deletes each file as soon as it has opened it. Files it
+    never gets to (because the session ended first) are deleted when the
+    serializer is closed. The files are named after the process that
+    wrote them, so that any left behind by a process that died can be
+    found by sweep_shared_memory().
+    '''
+    def __init__(self, serializer, threshold=SHARED_MEMORY_THRESHOLD, max_size=MAX_MESSAGE_SIZE):
+        self.serializer = serializer
+        self.name = serializer.name
+        self.persistent_ids = serializer.persistent_ids
+        self.threshold = threshold
+        self.max_size = max_size
+        # The files written that the other end may not have read yet
+        self._unread = set()
+        self._unread_lock = threading.Lock()
+
+    def dumps(self, data):
+        data = self.serializer.dumps(data)
+        if len(data) <= self.threshold:
+            return data
+        fd, path = tempfile.mkstemp(prefix = "%s%d-" % (SHARED_MEMORY_PREFIX, os.getpid()), dir = SHARED_MEMORY_DIR)
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(fd, buffer(data, written))
+        except:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        os.close(fd)
+        self._unread_lock.acquire()
+        try:
+            for unread in list(self._unread):
+                if not os.path.exists(unread):
+                    self._unread.discard(unread)
+            self._unread.add(path)
+        finally:
+            self._unread_lock.release()
+        return '\x01' + path
+
+    def loads(self, data):
+        if data[:1] != '\x01':
+            return self.serializer.loads(data)
+        path = data[1:]
+        # Never open anything but a message file, whatever the other end says
+        if os.path.dirname(path) != SHARED_MEMORY_DIR or not os.path.basename(path).startswith(SHARED_MEMORY_PREFIX):
+            raise NukeConnectionError("Invalid shared memory message '%s'" % path)
+        f = open(path, 'rb')
+        try:
+            os.unlink(path)
+            size = os.fstat(f.fileno()).st_size
+            if size > self.max_size:
+                raise NukeMessageSizeError("Incoming message of %d bytes exceeds the maximum message size of %d bytes" % (size, self.max_size))
+            mapped = mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            return self.serializer.loads(mapped)
+        finally:
+            mapped.close()
+
+    def close(self):
+        '''
+        Delete any files written that the other end has not read, once
+        the session is over and it never will
+        '''
+        self._unread_lock.acquire()
+        try:
+            unread, self._unread = self._unread, set()
+        finally:
+            self._unread_lock.release()
+        for path in unread:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self.serializer.close()
+
+# All of the serializers this end of the connection can use, by name.
+# Every connection starts out using DEFAULT_SERIALIZER, and the client
+# then offers SERIALIZER_PREFERENCE as part of the 'initiate' handshake.
+SERIALIZERS = {}
+for _protocol in range(_pickle.HIGHEST_PROTOCOL + 1):
+    SERIALIZERS["pickle%d" % _protocol] = PickleSerializer(_protocol)
+SERIALIZERS[MarshalSerializer.name] = MarshalSerializer(SERIALIZERS["pickle%d" % _pickle.HIGHEST_PROTOCOL])
+
+DEFAULT_SERIALIZER = "pickle0"
+SERIALIZER_PREFERENCE = [MarshalSerializer.name] + ["pickle%d" % _protocol for _protocol in range(_pickle.HIGHEST_PROTOCOL, -1, -1)]
+
+def negotiate_serializer(offered):
+    '''
+    Pick the first of the serializers offered by the other end that
+    this end also supports
+    '''
+    for name in offered:
+        if name in SERIALIZERS:
+            return name
+    return DEFAULT_SERIALIZER
+
 class NukeLicenseError(StandardError):
     pass
 
 class NukeConnectionError(StandardError):
     pass
 
+class NukeConnectionDeniedError(NukeConnectionError):
+    pass
+
 class NukeManagerError(NukeConnectionError):
     pass
 
 class NukeServerError(NukeConnectionError):
     pass
+
+
+class NukeMessageSizeError(NukeConnectionError):
+    pass
+
+class NukeStats(object):
+    '''
+    Collects the number of requests for each action, how long they took,
+    and how many bytes were sent and received for them.
+
+    Latencies are counted in a histogram of power-of-two buckets of
+    microseconds. On the server, the time covers a request from its
+    arrival to its reply being ready. On the client, it covers sending the
+    request and waiting for the reply, including serializing both.
+    The time spent in parts of handling an action (such as 'serialize' or
+    'recode') is also totalled separately.
+
+    Time spent waiting for Nuke's main thread is not tied to any single
+    action, so it is recorded on its own as 'main_thread', along with the
+    time spent running there (as its 'run' part).
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.started = time.time()
+            self.actions = {}
+            self.main_thread = self.new_entry()
+        finally:
+            self._lock.release()
+
+    def new_entry(self):
+        return {'count': 0, 'time': 0.0, 'max_time': 0.0, 'histogram': {}, 'bytes_in': 0, 'bytes_out': 0, 'parts': {}}
+
+    def add(self, entry, seconds, parts):
+        entry['count'] += 1
+        entry['time'] += seconds
+        entry['max_time'] = max(entry['max_time'], seconds)
+        bucket = histogram_bucket(seconds)
+        entry['histogram'][bucket] = entry['histogram'].get(bucket, 0) + 1
+        for name, part_seconds in parts.items():
+            entry['parts'][name] = entry['parts'].get(name, 0.0) + part_seconds
+
+    def record(self, action, seconds, bytes_in=0, bytes_out=0, **parts):
+        '''
+        Record a request for an action that took 'seconds' to handle
+        '''
+        self._lock.acquire()
+        try:
+            entry = self.actions.get(action)
+            if entry is None:
+                entry = self.actions[action] = self.new_entry()
+            self.add(entry, seconds, parts)
+            entry['bytes_in'] += bytes_in
+            entry['bytes_out'] += bytes_out
+        finally:
+            self._lock.release()
+
+    def record_part(self, action, name, seconds):
+        '''
+        Add time spent on one part of handling an action, outside of
+        the time recorded for the request itself
+        '''
+        self._lock.acquire()
+        try:
+            entry = self.actions.get(action)
+            if entry is None:
+                entry = self.actions[action] = self.new_entry()
+            entry['parts'][name] = entry['parts'].get(name, 0.0) + seconds
+        finally:
+            self._lock.release()
+
+    def record_main_thread(self, wait, run):
+        '''
+        Record a call made in Nuke's main thread, which waited 'wait'
+        seconds to start and then ran for 'run' seconds
+        '''
+        self._lock.acquire()
+        try:
+            self.add(self.main_thread, wait, {'run': run})
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        '''
+        Get a copy of everything recorded so far
+        '''
+        self._lock.acquire()
+        try:
+            return copy.deepcopy({
+                'elapsed': time.time() - self.started,
+                'actions': self.actions,
+                'main_thread': self.main_thread,
+            })
+        finally:
+            self._lock.release()
+
+def histogram_bucket(seconds):
+    '''
+    Get the power-of-two number of microseconds that a time falls under
+    '''
+    microseconds = seconds * 1e6
+    bucket = 1
+    while bucket < microseconds:
+        bucket <<= 1
+    return bucket
+
+def histogram_percentile(histogram, fraction):
+    '''
+    Get the bucket that a fraction of the counts in a histogram fall under
+    '''
+    total = sum(histogram.values())
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= total * fraction:
+            return bucket
+    return 0
+
+def format_stats(snapshot, title="Stats"):
+    '''
+    Format a NukeStats snapshot as a table, with a line for each action
+    '''
+    entries = sorted(snapshot['actions'].items())
+    if snapshot['main_thread']['count']:
+        entries.append(("(main thread wait)", snapshot['main_thread']))
+    part_names = sorted(set([name for action, entry in entries for name in entry['parts']]))
+    columns = ['action', 'count', 'mean_us', 'p50_us', 'p95_us', 'max_us', 'bytes_in', 'bytes_out'] + ["%s_us" % name for name in part_names]
+    lines = ["%s (over %.1fs)" % (title, snapshot['elapsed']), "  ".join(["%18s" % c for c in columns])]
+    for action, entry in entries:
+        count = entry['count']
+        cells = [str(action), count]
+        if count:
+            cells += [1e6 * entry['time'] / count, histogram_percentile(entry['histogram'], 0.5), histogram_percentile(entry['histogram'], 0.95), 1e6 * entry['max_time']]
+        else:
+            cells += ["", "", "", ""]
+        cells += [entry['bytes_in'], entry['bytes_out']]
+        for name in part_names:
+            # Parts are shown as the mean time per request
+            cells.append(1e6 * entry['parts'].get(name, 0.0) / max(count, 1))
+        lines.append("  ".join([isinstance(c, float) and "%18.1f" % c or "%18s" % (c,) for c in cells]))
+    return "\n".join(lines)
+
+def is_local_host(host):
+    '''
+    Check whether a host name or address refers to this machine
+    '''
+    if host in ("localhost", "", "::1") or host.startswith("127."):
+        return True
+    return host == socket.gethostname()
+
+def send_message(sock, data, request_id=None):
+    '''
+    Send a single length-prefixed message over a connected socket,
+    along with its request id if it has one.
+    Large messages are sent straight from the passed string rather
+    than being copied on to the end of the header.
+    '''
+    if request_id is None:
+        header = MESSAGE_HEADER.pack(len(data))
+    else:
+        header = REQUEST_HEADER.pack(len(data), request_id)
+    if len(data) <= SOCKET_BUFFER_SIZE:
+        sock.sendall(header + data)
+    else:
+        sock.sendall(header)
+        sock.sendall(data)
+
+def recv_bytes(sock, size):
+    '''
+    Read exactly 'size' bytes from a connected socket, straight into a
+    buffer allocated up front.
+    Raises socket.error if the connection is closed part way through.
+    '''
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise socket.error("Connection closed during message transfer")
+        received += count
+    return str(buf)
+
+def recv_message(sock, max_size=MAX_MESSAGE_SIZE, request_ids=False):
+    '''
+    Read a single length-prefixed message from a connected socket.
+    If 'request_ids' is True, the message has a request id in its header,
+    and a (request id, message) tuple is returned.
+    Returns None if the other end closed the connection cleanly
+    before a new message was started.
+    Raises NukeMessageSizeError if the message is larger than 'max_size',
+    as the stream cannot be trusted after that.
+    '''
+    if request_ids:
+        header_format = REQUEST_HEADER
+    else:
+        header_format = MESSAGE_HEADER
+    header = sock.recv(header_format.size)
+    if not header:
+        return None
+    if len(header) < header_format.size:
+        header += recv_bytes(sock, header_format.size - len(header))
+    header = header_format.unpack(header)
+    size = header[0]
+    if size > max_size:
+        raise NukeMessageSizeError("Incoming message of %d bytes exceeds the maximum message size of %d bytes" % (size, max_size))
+    if request_ids:
+        return header[1], recv_bytes(sock, size)
+    return recv_bytes(sock, size)
+
+def is_private(path, is_kind=stat.S_ISREG):
+    '''
+    Check that a path is of the expected kind (not a symlink to one), is
+    owned by this user, and cannot be written to by anyone else, so that
+    what is in it can be trusted.
+    Ownership cannot be checked on systems without os.getuid(), where this
+    is always True for a path that exists.
+    '''
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    if not hasattr(os, 'getuid'):
+        return True
+    if not is_kind(info.st_mode):
+        return False
+    return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def registry_is_private():
+    '''
+    Check that the registry directory belongs to this user. The directory's
+    name can be guessed, so anyone else could have created it first, and
+    neither its entries nor the Unix domain sockets in it are trusted if so.
+    '''
+    return is_private(REGISTRY_DIR, stat.S_ISDIR)
+
+def make_registry_dir():
+    '''
+    Create the registry directory if it does not exist yet, so that only
+    this user can use it.
+    Returns False if it cannot be created, or belongs to someone else.
+    '''
+    try:
+        if not os.path.lexists(REGISTRY_DIR):
+            os.makedirs(REGISTRY_DIR, 0700)
+        else:
+            # Tighten up a directory made by an older version of this module
+            info = os.lstat(REGISTRY_DIR)
+            if stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid():
+                os.chmod(REGISTRY_DIR, 0700)
+    except (OSError, AttributeError):
+        pass
+    return registry_is_private()
+
+def registry_path(port):
+    return os.path.join(REGISTRY_DIR, "%d.json" % port)
+
+def unix_socket_path(port):
+    return os.path.join(REGISTRY_DIR, "%d.sock" % port)
+
+def register_server(port, **info):
+    '''
+    Add a running server to the registry, along with any other details
+    about it passed as keyword arguments.
+    Failing to write to the registry is not fatal, as clients can still
+    find the server by probing.
+    '''
+    info['port'] = port
+    info['pid'] = os.getpid()
+    path = registry_path(port)
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    if not make_registry_dir():
+        return False
+    try:
+        f = open(temp_path, 'w')
+        try:
+            json.dump(info, f)
+        finally:
+            f.close()
+        # Write the entry in one go, so that clients never read half of one
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            os.remove(path)
+            os.rename(temp_path, path)
+    except (IOError, OSError):
+        return False
+    return True
+
+def unregister_server(port):
+    '''
+    Remove a server from the registry, if it is the one listed
+    for that port
+    '''
+    entry = read_registry_entry(registry_path(port))
+    if entry is not None and entry.get('pid') == os.getpid():
+        try:
+            os.remove(registry_path(port))
+        except OSError:
+            pass
+
+def read_registry_entry(path):
+    if not registry_is_private():
+        return None
+    try:
+        f = open(path)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return None
+
+def process_exists(pid):
+    '''
+    Check whether a process is still running. This can only be
+    checked on POSIX systems, so is always True elsewhere.
+    '''
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def sweep_shared_memory():
+    '''
+    Delete any shared memory message files of this user's that were left
+    behind by processes that are no longer running
+    '''
+    try:
+        names = os.listdir(SHARED_MEMORY_DIR)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(SHARED_MEMORY_PREFIX):
+            continue
+        try:
+            pid = int(name[len(SHARED_MEMORY_PREFIX):].split("-", 1)[0])
+        except ValueError:
+            continue
+        path = os.path.join(SHARED_MEMORY_DIR, name)
+        if process_exists(pid) or not is_private(path):
+            continue
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def registered_servers():
+    '''
+    Return the registry entries of every server running on this machine,
+    ordered by port. Entries left behind by servers that did not exit
+    cleanly are removed.
+    '''
+    if not registry_is_private():
+        return []
+    try:
+        names = os.listdir(REGISTRY_DIR)
+    except OSError:
+        return []
+    servers = []
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(REGISTRY_DIR, name)
+        entry = read_registry_entry(path)
+        if entry is None or 'port' not in entry:
+            continue
+        if not process_exists(entry.get('pid', 0)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        servers.append(entry)
+    servers.sort(key = lambda entry: entry['port'])
+    return servers
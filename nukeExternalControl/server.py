@@ -4,10 +4,23 @@ This module defines the server-side classes for the Nuke command server interfac
 It can also be passed as an executable to automatically start server instances.
 '''
 
+import array
+import collections
+import errno
+import os
 import pickle
+import Queue
+import select
 import socket
+import sys
 import threading
+import time
+import traceback
 import imp
+import inspect
+import itertools
+import types
+import fnmatch
 import nuke
 
 from nukeExternalControl.common import *
@@ -16,6 +29,348 @@ VERIFY_CONNECTION_NONE = 0
 VERIFY_CONNECTION_ALWAYS = 1
 VERIFY_CONNECTION_ONLY_REMOTE = 2
 
+# The number of compiled code objects from 'exec' and 'eval' to keep
+CODE_CACHE_SIZE = 256
+
+# How often (in seconds) a zygote collects forked servers that have exited
+# while it is waiting for requests, and how many of their exit codes it
+# keeps for managers to ask about
+ZYGOTE_REAP_INTERVAL = 0.5
+ZYGOTE_EXIT_CODES = 1000
+
+# The most requests from a single session that are handled at once, when
+# its client sends requests with ids. Any more wait for one to finish.
+SESSION_REQUEST_THREADS = 8
+
+# Nuke's wrapper types, which are made afresh each time a node or knob is
+# looked up, and compare equal when they wrap the same one
+VALUE_KEYED_TYPES = tuple([getattr(nuke, name) for name in ["Node", "Knob"] if hasattr(nuke, name)])
+
+# Actions that call into Nuke, and so need to run in the main thread
+MAIN_THREAD_ACTIONS = ["call", "callattr", "exec", "eval", "snapshot", "apply_snapshot", "iter", "next", "sample"]
+
+class NukeSession(object):
+    '''
+    The state belonging to a single client connection, including the
+    objects that have been passed to that client by id.
+    Nothing in a session is shared with any other session, so clients
+    served at the same time cannot interfere with each other.
+
+    Object ids are unique across all sessions, so an id left over from
+    an earlier session can never refer to an object in a later one.
+
+    Passing the same object to the client more than once always uses the
+    same id. Nuke's node and knob wrappers that compare equal count as the
+    same object, as Nuke returns a new wrapper each time one is looked up.
+    Each id keeps a count of the number of times it has been passed, and
+    the object is only forgotten once the client has released it that
+    many times.
+    '''
+    _object_ids = itertools.count()
+
+    def __init__(self, client, address):
+        self.client = client
+        self.address = address
+        self.serializer = SERIALIZERS[DEFAULT_SERIALIZER]
+        # Whether objects passed to the client say what type they are,
+        # so that the client can use their schema
+        self.describe_objects = False
+        # Whether requests carry ids, in which case several of them can be
+        # handled at once and answered in whatever order they finish
+        self.request_ids = False
+        self.send_lock = threading.Lock()
+        self.requests = Queue.Queue(SESSION_REQUEST_THREADS)
+        self.request_threads = []
+        self.closed = False
+        # The schemas passed to the client, which stay the same for the
+        # rest of the session
+        self.schemas = {}
+        self._objects = {}
+        self._object_refs = {}
+        self._ids_by_object = {}
+        self._object_keys = {}
+        self._objects_lock = threading.Lock()
+        # The error from the first object that is not stored, in the
+        # request each thread is loading
+        self.load_errors = threading.local()
+
+    def object_key(self, obj):
+        '''
+        Get the key an object is looked up by, to find whether it has
+        already been passed to the client.
+        Nuke's wrappers (VALUE_KEYED_TYPES) are keyed on their value, so
+        that equal wrappers for the same node or knob share an id. Anything
+        else is keyed on its id(), which is safe for as long as it is
+        stored, so that equal but separate objects get separate proxies.
+        '''
+        if isinstance(obj, VALUE_KEYED_TYPES):
+            try:
+                key = (type(obj), obj)
+                hash(key)
+                return key
+            except Exception:
+                pass
+        return id(obj)
+
+    def add_object(self, obj):
+        '''
+        Store an object, and return the id the client will use for it
+        '''
+        self._objects_lock.acquire()
+        try:
+            key = self.object_key(obj)
+            object_id = self._ids_by_object.get(key)
+            if object_id is None:
+                object_id = self._object_ids.next()
+                self._objects[object_id] = obj
+                self._object_refs[object_id] = 1
+                self._ids_by_object[key] = object_id
+                self._object_keys[object_id] = key
+            else:
+                self._object_refs[object_id] += 1
+        finally:
+            self._objects_lock.release()
+        return object_id
+
+    def get_object(self, object_id):
+        '''
+        Get a stored object by id
+        '''
+        try:
+            return self._objects[object_id]
+        except KeyError:
+            raise KeyError("Object %s has been released, or belongs to another session" % object_id)
+
+    def release_objects(self, object_ids):
+        '''
+        Release the objects with the passed ids, forgetting them so that
+        they can be freed once they have been released as many times as
+        they were passed. Each id can be paired with a count, as
+        (id, count), to release it more than once.
+        Ids that are not stored are ignored.
+        '''
+        self._objects_lock.acquire()
+        try:
+            for object_id in object_ids:
+                count = 1
+                if isinstance(object_id, tuple):
+                    object_id, count = object_id
+                if object_id not in self._objects:
+                    continue
+                self._object_refs[object_id] -= count
+                if self._object_refs[object_id] <= 0:
+                    # The key of an object that has changed since it was
+                    # stored may no longer be found, which is no reason to
+                    # fail the rest of the request
+                    self._ids_by_object.pop(self._object_keys.pop(object_id), None)
+                    del self._objects[object_id]
+                    del self._object_refs[object_id]
+        finally:
+            self._objects_lock.release()
+
+    def object_count(self):
+        '''
+        Get the number of objects currently stored for the client
+        '''
+        return len(self._objects)
+
+    def clear_objects(self):
+        '''
+        Forget every object stored for this session
+        '''
+        self._objects_lock.acquire()
+        try:
+            self._objects.clear()
+            self._object_refs.clear()
+            self._ids_by_object.clear()
+            self._object_keys.clear()
+        finally:
+            self._objects_lock.release()
+
+class NukeMainThreadCall(object):
+    '''
+    A call queued to run in Nuke's main thread
+    '''
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self.queued_time = time.time()
+        self.start_time = None
+
+    def run(self):
+        self.start_time = time.time()
+        try:
+            self._result = self.func(*self.args, **self.kwargs)
+        except:
+            self._error = sys.exc_info()
+        self._done.set()
+
+    def wait(self):
+        '''
+        Wait for the call to be made, and return its result
+        (or raise its exception)
+        '''
+        self._done.wait()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+class NukeMainThreadDispatcher(object):
+    '''
+    Makes calls that have to happen in Nuke's main thread.
+
+    Without a GUI there is no main thread event loop to hand calls over to,
+    so they are made straight from the calling thread, one at a time.
+    With a GUI, a call is queued and a hop to the main thread is scheduled.
+    Every call queued before the hop happens is made during it, so calls
+    from several sessions at once can share a single hop.
+
+    Calls from code that is already running in the main thread are always
+    made straight away.
+
+    If 'instrumentation' is a NukeStats, the time each call waits to be made
+    and then takes to run is recorded in it.
+    '''
+    def __init__(self, direct = None, instrumentation = None):
+        if direct is None:
+            direct = not nuke.GUI
+        self.direct = direct
+        self.instrumentation = instrumentation
+        self._direct_lock = threading.RLock()
+        self._queue = []
+        self._queue_lock = threading.Lock()
+        self._local = threading.local()
+
+    def call(self, func, args = (), kwargs = None):
+        '''
+        Call a function in the main thread, and return its result
+        '''
+        if kwargs is None:
+            kwargs = {}
+        if getattr(self._local, 'in_main_thread', False):
+            return func(*args, **kwargs)
+        if self.direct:
+            stats = self.instrumentation
+            if stats is not None:
+                queued = time.time()
+            self._direct_lock.acquire()
+            try:
+                if stats is None:
+                    return func(*args, **kwargs)
+                started = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    stats.record_main_thread(started - queued, time.time() - started)
+            finally:
+                self._direct_lock.release()
+
+        call = NukeMainThreadCall(func, args, kwargs)
+        self._queue_lock.acquire()
+        try:
+            self._queue.append(call)
+            # Only the first call queued since the last hop needs to ask for one
+            schedule = len(self._queue) == 1
+        finally:
+            self._queue_lock.release()
+        if schedule:
+            nuke.executeInMainThread(self.run_queued)
+        if self.instrumentation is None:
+            return call.wait()
+        try:
+            return call.wait()
+        finally:
+            self.instrumentation.record_main_thread(call.start_time - call.queued_time, time.time() - call.start_time)
+
+    def run_queued(self):
+        '''
+        Make every queued call. This runs in the main thread.
+        '''
+        self._queue_lock.acquire()
+        try:
+            calls = self._queue
+            self._queue = []
+        finally:
+            self._queue_lock.release()
+        self._local.in_main_thread = True
+        try:
+            for call in calls:
+                call.run()
+        finally:
+            self._local.in_main_thread = False
+
+class NukeRegisteredAction(object):
+    '''
+    An action added to every server with register_action()
+    '''
+    def __init__(self, name, func, main_thread = True):
+        self.name = name
+        self.func = func
+        self.main_thread = main_thread
+        self.doc = inspect.getdoc(func)
+
+    def run(self, dispatcher, params):
+        args = ()
+        kwargs = {}
+        if params:
+            args = params.get('args', ())
+            kwargs = params.get('kwargs', {})
+        if self.main_thread:
+            return dispatcher.call(self.func, args, kwargs)
+        return self.func(*args, **kwargs)
+
+# Actions added with register_action(), by name
+registered_actions = {}
+
+def register_action(name, func, main_thread = True):
+    '''
+    Add an action that clients can request by name from any command server
+    in this copy of Nuke, with conn.actions.<name>(*args, **kwargs).
+    The action calls func(*args, **kwargs) and returns its result. Unless
+    'main_thread' is False, it is called in Nuke's main thread.
+
+    Actions can be registered at any time, such as in a startup script,
+    and do not need the server to allow 'exec'.
+    '''
+    if ("action_" + name) in dir(NukeInternal):
+        raise ValueError("'%s' is a built in action" % name)
+    registered_actions[name] = NukeRegisteredAction(name, func, main_thread)
+
+def unregister_action(name):
+    '''
+    Remove an action added with register_action()
+    '''
+    registered_actions.pop(name, None)
+
+def process_memory():
+    '''
+    Get the memory used by this process in bytes, or None if that cannot
+    be found out. This is the resident size where /proc is available, and
+    the peak resident size otherwise.
+    '''
+    try:
+        f = open('/proc/self/statm')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # This is in bytes on OS X, but kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
 def nuke_command_server(verifyConnection = VERIFY_CONNECTION_NONE):
     '''
     Launch the command server in a separate thread
@@ -31,13 +386,46 @@ class NukeInternal(object):
     It deals with keeping track of any objects that cannot be passed over
     the socket and ensures that the client side feels as similar to running
     the code inside Nuke as possible.
+
+    Clients are served concurrently, each in its own thread. If
+    'max_sessions' is set, no more than that many clients are served at
+    once, and any others wait to be accepted until a session ends.
+
+    If 'allow_exec' is False, clients cannot send code to be run with the
+    'exec' and 'eval' actions.
+
+    Calls into Nuke are made through a NukeMainThreadDispatcher. By default
+    they are made directly if Nuke has no GUI, and in the main thread if it
+    does. 'direct_calls' can be set to True or False to choose explicitly.
+
+    If 'instrument' is True (or $NUKE_EXTERNAL_CONTROL_STATS is set), the
+    server records NukeStats for every request in 'instrumentation', and
+    includes them in the result of the 'stats' action.
     '''
-    def __init__(self, port = None, verifyConnection = VERIFY_CONNECTION_NONE):
-        self._objects = {}
-        self._next_object_id = 0
+    def __init__(self, port = None, verifyConnection = VERIFY_CONNECTION_NONE, max_message_size = MAX_MESSAGE_SIZE, max_sessions = None, allow_exec = True, direct_calls = None, instrument = INSTRUMENT):
+        # Objects passed outside of a client session (such as by
+        # subclasses calling get() directly) are kept here
+        self._default_session = NukeSession(None, None)
+        self._sessions = set()
+        self._sessions_lock = threading.Lock()
+        self._shutting_down = False
+        self.instrumentation = None
+        if instrument:
+            self.instrumentation = NukeStats()
+        self.dispatcher = NukeMainThreadDispatcher(direct_calls, self.instrumentation)
+        self.actions = {}
+        for attrname in dir(self):
+            if attrname.startswith('action_'):
+                self.actions[attrname[len('action_'):]] = getattr(self, attrname)
+        self._allow_exec = allow_exec
+        self._code_cache = {}
+        self._session_slots = None
+        if max_sessions:
+            self._session_slots = threading.BoundedSemaphore(max_sessions)
         self._verify_connection = verifyConnection
         self.port = port
         self.bound_port = False
+        self.max_message_size = max_message_size
         
         host = ''
         backlog = 5
@@ -50,7 +438,10 @@ class NukeInternal(object):
         for port in xrange(start_port, end_port + 1):
             try:
                 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                print "SERVER: Checking port %d" % port
+                if os.name == 'posix':
+                    # Let a restarted server take over its old port straight
+                    # away. Elsewhere this would allow two servers on one port.
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 s.bind((host, port))
                 self.bound_port = True
                 self.port = port
@@ -60,27 +451,232 @@ class NukeInternal(object):
         
         if not self.bound_port:
             raise NukeConnectionError("Cannot find port to bind to")
+        self.bound_time = time.time()
             
         s.listen(backlog)
+        print "SERVER: Listening on port %d" % self.port
         self.start_server(s)
         
     def start_server(self, sock):
         '''
-        Starts the main server loop
+        Starts the main server loop.
+        Each client connection is a long-lived session that is served
+        in its own thread, so that an idle client does not block others.
+        The server is listed in the registry while the loop is running.
+        Where possible, the server also listens on a Unix domain socket,
+        which is listed with it so that clients on this machine can use it.
+        '''
+        listeners = [sock]
+        info = {}
+        unix_sock = self.open_unix_socket()
+        if unix_sock is not None:
+            listeners.append(unix_sock)
+            info['unix_socket'] = unix_sock.getsockname()
+        sweep_shared_memory()
+        register_server(self.port, nuke_version = nuke.NUKE_VERSION_STRING, gui = bool(nuke.GUI), start_time = time.time(), **info)
+        try:
+            while 1:
+                if self._session_slots is not None:
+                    self._session_slots.acquire()
+                ready = sock
+                if len(listeners) > 1:
+                    ready = self.wait_for_client(listeners)
+                client, address = ready.accept()
+                if self._shutting_down:
+                    client.close()
+                    raise SystemExit
+                t = threading.Thread(None, self.serve_client, args = (client, address))
+                t.setDaemon(True)
+                t.start()
+        finally:
+            unregister_server(self.port)
+            sock.close()
+            if unix_sock is not None:
+                unix_sock.close()
+                try:
+                    os.unlink(unix_socket_path(self.port))
+                except OSError:
+                    pass
+
+    def open_unix_socket(self):
+        '''
+        Listen on a Unix domain socket next to the server's registry entry,
+        that only this user can connect to.
+        Returns None if that is not possible on this system.
+        '''
+        if not hasattr(socket, 'AF_UNIX'):
+            return None
+        path = unix_socket_path(self.port)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if not make_registry_dir():
+            return None
+        try:
+            # A socket left behind by a server on the same port that did
+            # not shut down cleanly is no longer in use, as we have the port
+            if os.path.lexists(path):
+                os.unlink(path)
+            s.bind(path)
+            os.chmod(path, 0600)
+            s.listen(5)
+        except (socket.error, OSError):
+            s.close()
+            return None
+        return s
+
+    def wait_for_client(self, listeners):
+        '''
+        Wait for a client to connect to any of the listening sockets,
+        and return the one it connected to
         '''
         while 1:
-            client, address = sock.accept()
             try:
-				data = client.recv(SOCKET_BUFFER_SIZE)
-				if data:
-					result = self.receive(data)
-					client.send(result)
-            except SystemExit:
-                result = self.encode('SERVER: Shutting down...')
-                client.send(result)
-                raise
+                return select.select(listeners, [], [])[0][0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def serve_client(self, client, address):
+        '''
+        Serve every message sent by a single client until it closes
+        the connection, or asks the server to shut down.
+        '''
+        if client.family == socket.AF_INET:
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session = NukeSession(client, address)
+        self._sessions_lock.acquire()
+        try:
+            self._sessions.add(session)
+        finally:
+            self._sessions_lock.release()
+        try:
+            try:
+                while 1:
+                    if session.request_ids:
+                        message = recv_message(client, self.max_message_size, request_ids=True)
+                        if message is None:
+                            break
+                        self.queue_request(session, message)
+                        continue
+                    data = recv_message(client, self.max_message_size)
+                    if data is None:
+                        break
+                    if not self.serve_request(session, data):
+                        break
+            except (socket.error, NukeMessageSizeError):
+                # The client went away part way through a message, or
+                # sent one too large to accept
+                pass
+        finally:
+            # Wait for any requests still being handled before clearing
+            # up, and drop those that have not been started
+            session.closed = True
+            for t in session.request_threads:
+                session.requests.put(None)
+            for t in session.request_threads:
+                t.join()
+            client.close()
+            session.serializer.close()
+            session.clear_objects()
+            self._sessions_lock.acquire()
+            try:
+                self._sessions.discard(session)
             finally:
-				client.close()
+                self._sessions_lock.release()
+            if self._session_slots is not None:
+                self._session_slots.release()
+
+    def queue_request(self, session, message):
+        '''
+        Queue a (request id, data) message from a session to be handled by
+        one of its request threads, starting another one if there are
+        fewer than SESSION_REQUEST_THREADS. This waits while all of them
+        are busy, so that the client cannot start any more.
+        '''
+        if len(session.request_threads) < SESSION_REQUEST_THREADS:
+            t = threading.Thread(None, self.serve_requests, args=(session,))
+            t.setDaemon(True)
+            t.start()
+            session.request_threads.append(t)
+        session.requests.put(message)
+
+    def serve_requests(self, session):
+        '''
+        Handle queued requests from a session until it ends.
+        Nothing a request does stops the thread early, as the session
+        counts on each of its threads to keep taking requests.
+        '''
+        while 1:
+            message = session.requests.get()
+            if message is None:
+                break
+            if session.closed:
+                continue
+            request_id, data = message
+            try:
+                self.serve_request(session, data, request_id)
+            except Exception:
+                traceback.print_exc()
+
+    def serve_request(self, session, data, request_id=None):
+        '''
+        Handle a single request from a session, and send back the reply
+        (with the same request id, if it has one).
+        Returns False if the client asked the server to shut down.
+        '''
+        running = True
+        try:
+            result = self.receive(data, session)
+        except SystemExit:
+            result = self.encode('SERVER: Shutting down...', session)
+            running = False
+        except Exception, e:
+            # Every request gets a reply, so that the client is never left
+            # waiting for one
+            result = self.encode_exception(e, session)
+        session.send_lock.acquire()
+        try:
+            try:
+                send_message(session.client, result, request_id)
+            except socket.error:
+                # Requests with ids are handled away from the session's
+                # own thread, which will find out that the client has gone
+                if request_id is None:
+                    raise
+        finally:
+            session.send_lock.release()
+        if not running:
+            self.stop_server()
+        return running
+
+    def stop_server(self):
+        '''
+        Flag the main server loop to exit, and wake it up if it is
+        waiting for a new connection.
+        Every open session is shut down too, so that no other clients are
+        served once the server has been asked to stop.
+        '''
+        self._shutting_down = True
+        self._sessions_lock.acquire()
+        try:
+            sessions = list(self._sessions)
+        finally:
+            self._sessions_lock.release()
+        for session in sessions:
+            try:
+                session.client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self._session_slots is not None:
+            try:
+                self._session_slots.release()
+            except ValueError:
+                pass
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.connect(('localhost', self.port))
+            s.close()
+        except socket.error:
+            pass
     
     def recode_data(self, data, recode_object_func):
         '''
@@ -96,7 +692,7 @@ class NukeInternal(object):
                 newList.append(self.recode_data(i, recode_object_func))
             return type(data)(newList)
         elif type(data) in dictTypes:
-            if 'type' in data and data['type'] == "NukeTransferObject":
+            if 'type' in data and data['type'] in transferTypes:
                 return recode_object_func(data)
             else:
 	            newDict = {}
@@ -106,48 +702,138 @@ class NukeInternal(object):
         else:
             return recode_object_func(data)
 
-    def encode_data(self, data):
+    def encode_data(self, data, session = None):
         '''
         Encode data to send back to the client
         '''
-        return self.recode_data(data, self.encode_data_object)
+        return self.recode_data(data, lambda obj: self.encode_data_object(obj, session))
     
-    def decode_data(self, data):
+    def decode_data(self, data, session = None):
         '''
         Decode data that the client has passed through
         '''
-        return self.recode_data(data, self.decode_data_object)
+        return self.recode_data(data, lambda obj: self.decode_data_object(obj, session))
 
-    def encode_data_object(self, data):
+    def encode_data_object(self, data, session = None):
         '''
         Encode an object that cannot be directly passed.
-        Stores the object, and creates a dictionary with the
-        id of the stored object
+        Stores the object in the session, and creates a dictionary
+        with the id of the stored object
         '''
-        this_object_id = self._next_object_id
-        self._next_object_id += 1
-        self._objects[this_object_id] = data
-        return {'type': "NukeTransferObject", 'id': this_object_id}
+        if session is None:
+            session = self._default_session
+        encoded = {'type': "NukeTransferObject", 'id': session.add_object(data)}
+        if session.describe_objects:
+            encoded['class'] = self.schema_key(data)
+        return encoded
     
-    def decode_data_object(self, data):
+    def decode_data_object(self, data, session = None):
+        '''
+        Gets a stored data object based on the passed id.
+        References to batch results are left for the batch to resolve.
+        '''
+        if data['type'] != "NukeTransferObject":
+            return data
+        if session is None:
+            session = self._default_session
+        return session.get_object(data['id'])
+
+    def persistent_id(self, obj, session):
         '''
-        Gets a stored data object based on the passed id
+        Get the persistent id to send in place of an object that cannot
+        be passed directly, storing the object in the session.
+        Returns None for plain data.
         '''
-        object_id = data['id']
-        return self._objects[object_id]
+        if passed_by_value(obj):
+            return None
+        obj_class = None
+        if session.describe_objects:
+            obj_class = self.schema_key(obj)
+        return ('object', session.add_object(obj), obj_class)
 
-    def encode(self, data):
+    def persistent_load(self, pid, session):
         '''
-        Encode some data, and turn it into a pickled stream
+        Get the object a client has passed back by its persistent id.
+        References to batch results are left for the batch to resolve.
+        An object that is not stored is loaded as None, and the error
+        saved for load_request() to raise.
         '''
-        return pickle.dumps(self.encode_data(data))
+        if pid[0] in ('object', 'method'):
+            try:
+                obj = session.get_object(pid[1])
+                if pid[0] == 'method':
+                    obj = getattr(obj, pid[2])
+                return obj
+            except Exception, e:
+                # Carry on loading, so that the request's releases can
+                # still be read
+                if getattr(session.load_errors, 'error', None) is None:
+                    session.load_errors.error = e
+                return None
+        elif pid[0] == 'batch':
+            return {'type': "NukeTransferBatchReference", 'index': pid[1]}
+        elif pid[0] == 'value':
+            return pid[1]
+        raise pickle.UnpicklingError("Unknown persistent id %r" % (pid,))
+
+    def encode(self, data, session = None, serializer = None):
+        '''
+        Encode some data, and turn it into a serialized stream
+        using the session's serializer, unless another is passed
+        '''
+        if serializer is None:
+            serializer = SERIALIZERS[DEFAULT_SERIALIZER]
+            if session is not None:
+                serializer = session.serializer
+        if serializer.persistent_ids:
+            return serializer.dumps(data)
+        return serializer.dumps(self.encode_data(data, session))
     
-    def decode(self, data):
+    def decode(self, data, session = None):
         '''
-        Decode a pickle stream of data, ensuring that any Nuke objects are
+        Decode a serialized stream of data, ensuring that any Nuke objects are
         re-linked
         '''
-        return self.decode_data(pickle.loads(data))
+        if session is None:
+            serializer = SERIALIZERS[DEFAULT_SERIALIZER]
+        else:
+            serializer = session.serializer
+        if serializer.persistent_ids:
+            return self.load_request(serializer, data, session)
+        return self.decode_request(serializer.loads(data), session)
+
+    def load_request(self, serializer, data, session):
+        '''
+        Deserialize a request using persistent ids. If it refers to any
+        objects that are not stored, the rest of it is still loaded, and
+        its releases made, before raising the error.
+        '''
+        session.load_errors.error = None
+        data = serializer.loads(data)
+        error, session.load_errors.error = session.load_errors.error, None
+        if error is not None:
+            self.release_request_objects(data, session)
+            raise error
+        return data
+
+    def decode_request(self, data, session):
+        '''
+        Re-link the objects in a deserialized request. If any of them are
+        not stored, the request's releases are still made before raising
+        the error.
+        '''
+        try:
+            return self.decode_data(data, session)
+        except Exception:
+            self.release_request_objects(data, session)
+            raise
+
+    def release_request_objects(self, data, session):
+        '''
+        Make the releases a request carries, when it cannot be performed
+        '''
+        if isinstance(data, dict) and data.get('release'):
+            self.release_objects(data['release'], session)
 
     def verify_connection(self, host):
         '''
@@ -161,116 +847,587 @@ class NukeInternal(object):
         
         # If Nuke isn't running in GUI mode, then allow the connection to verify
         if nuke.GUI:
-            return nuke.executeInMainThreadWithResult(nuke.ask, ("Something is trying to connect to Nuke from %s.\nDo you wish to allow this?" % host,))
+            return self.dispatcher.call(nuke.ask, ("Something is trying to connect to Nuke from %s.\nDo you wish to allow this?" % host,))
         
         return True
         
-    def get(self, data):
+    def initiate(self, params, session):
+        '''
+        Handle the handshake at the start of a session.
+        Newer clients pass a dictionary with their host and the serializers
+        they support, and are told which serializer the rest of the session
+        will use. Older clients just pass their host.
+        Clients that ask for 'persistent_ids' have objects swapped for ids
+        while messages are serialized, rather than in a separate pass.
+        Clients can also ask for large messages to be compressed, by
+        passing the 'compression' level and threshold to use, or if they
+        are connected over a Unix domain socket, to be passed through
+        shared memory, by passing the 'shared_memory' threshold.
+        Clients that ask for 'request_ids' send an id with each request from
+        then on, and can send more requests before earlier ones are answered.
+        '''
+        if not isinstance(params, dict):
+            if self.verify_connection(params):
+                return "accept"
+            return "deny"
+
+        if not self.verify_connection(params.get('host')):
+            return {'status': "deny"}
+
+        serializer = DEFAULT_SERIALIZER
+        persistent_ids = False
+        compression = False
+        shared_memory = False
+        request_ids = False
+        if session is not None:
+            serializer = negotiate_serializer(params.get('serializers', ()))
+            session.serializer = SERIALIZERS[serializer]
+            session.describe_objects = bool(params.get('schema'))
+            # Persistent ids need a binary pickle protocol
+            if params.get('persistent_ids') and serializer != "pickle0":
+                session.serializer = PersistentIdSerializer(session.serializer,
+                                                            lambda obj: self.persistent_id(obj, session),
+                                                            lambda pid: self.persistent_load(pid, session))
+                persistent_ids = True
+            if params.get('compression'):
+                session.serializer = CompressedSerializer(session.serializer, max_size = self.max_message_size, **params['compression'])
+                compression = True
+            elif params.get('shared_memory') and session.client.family != socket.AF_INET:
+                session.serializer = SharedMemorySerializer(session.serializer, max_size = self.max_message_size, **params['shared_memory'])
+                shared_memory = True
+            if params.get('request_ids'):
+                session.request_ids = True
+                request_ids = True
+        return {'status': "accept", 'serializer': serializer, 'persistent_ids': persistent_ids, 'compression': compression, 'shared_memory': shared_memory,
+                'request_ids': request_ids}
+
+    def get(self, data, session = None):
         '''
-        Perform whatever action is requested, and return the result
+        Perform whatever action is requested, and return the result.
+        Any object ids the client has finished with are released first.
         '''
-        obj = self.get_object(data['id'])
-        params = data['parameters']
-        result = None
-        action = data['action']
         try:
-            if data['action'] == "initiate":
-                if self.verify_connection(params):
-                    result = "accept"
-                else:
-                    result = "deny"
-            elif data['action'] == "test":
-                result = True
-            elif data['action'] == "getattr":
-                result = getattr(obj, params)
-            elif action == "setattr":
-                setattr(obj, params[0], params[1])
-            elif action == "getitem":
-                # If we're actually getting from globals(), then raise NameError instead of KeyError
-                if data['id'] == -1 and params not in obj:
-                    raise NameError("name '%s' is not defined" % params)
-                result = obj[params]
-            elif action == "setitem":
-                obj[params[0]] = params[1]
-            elif action == "call":
-                result = nuke.executeInMainThreadWithResult(obj, args=params['args'], kwargs=params['kwargs'])
-            elif action == "len":
-                result = len(obj)
-            elif action == "str":
-                result = str(obj)
-            elif action == "repr":
-                result = `obj`
-            elif data['action'] == "del":
-                del obj
-            elif data['action'] == "isinstance":
-                result = obj.__instancecheck__(params)
-            elif data['action'] == "issubclass":
-                result = issubclass(params, obj)
-            elif action == "import":
-                result = imp.load_module(params, *imp.find_module(params))
-            elif action == "shutdown":
-                # This keyword triggers the server shutdown
-                raise SystemExit
+            if data.get('release'):
+                self.release_objects(data['release'], session)
+            obj = self.get_object(data['id'], session)
+            result = self.perform(data['action'], data['id'], obj, data['parameters'], session)
         except Exception, e:
             result = e
         
         return result
+
+    def perform(self, action, obj_id, obj, params, session = None):
+        '''
+        Perform a single action on an object, and return the result.
+        Built in actions are the server's action_<name> methods, and any
+        others are looked up among those added with register_action().
+        '''
+        handler = self.actions.get(action)
+        if handler is not None:
+            return handler(obj_id, obj, params, session)
+        registered = registered_actions.get(action)
+        if registered is None:
+            raise ValueError("Unknown action '%s'" % action)
+        return registered.run(self.dispatcher, params)
+
+    def action_initiate(self, obj_id, obj, params, session):
+        return self.initiate(params, session)
+
+    def action_test(self, obj_id, obj, params, session):
+        return True
+
+    def action_getattr(self, obj_id, obj, params, session):
+        return getattr(obj, params)
+
+    def action_setattr(self, obj_id, obj, params, session):
+        setattr(obj, params[0], params[1])
+
+    def action_getitem(self, obj_id, obj, params, session):
+        # If we're actually getting from globals(), then raise NameError instead of KeyError
+        if obj_id == -1 and params not in obj:
+            raise NameError("name '%s' is not defined" % params)
+        return obj[params]
+
+    def action_setitem(self, obj_id, obj, params, session):
+        obj[params[0]] = params[1]
+
+    def action_call(self, obj_id, obj, params, session):
+        return self.dispatcher.call(obj, params['args'], params['kwargs'])
+
+    def action_callattr(self, obj_id, obj, params, session):
+        return self.dispatcher.call(getattr(obj, params['name']), params['args'], params['kwargs'])
+
+    def action_len(self, obj_id, obj, params, session):
+        return len(obj)
+
+    def action_contains(self, obj_id, obj, params, session):
+        return params in obj
+
+    def action_iter(self, obj_id, obj, params, session):
+        return self.dispatcher.call(self.iterate, (obj, params))
+
+    def action_next(self, obj_id, obj, params, session):
+        return self.dispatcher.call(self.next_page, (obj, params))
+
+    def action_str(self, obj_id, obj, params, session):
+        return str(obj)
+
+    def action_repr(self, obj_id, obj, params, session):
+        return `obj`
+
+    def action_del(self, obj_id, obj, params, session):
+        self.release_objects([obj_id], session)
+
+    def action_release(self, obj_id, obj, params, session):
+        # Releases have already been dealt with in get()
+        pass
+
+    def action_stats(self, obj_id, obj, params, session):
+        result = self.stats(session)
+        if params and params.get('reset') and self.instrumentation is not None:
+            self.instrumentation.reset()
+        return result
+
+    def action_schema(self, obj_id, obj, params, session):
+        if obj_id == -1:
+            return self.global_schemas(obj, params, session)
+        return self.schema(obj, session)
+
+    def action_isinstance(self, obj_id, obj, params, session):
+        return obj.__instancecheck__(params)
+
+    def action_issubclass(self, obj_id, obj, params, session):
+        return issubclass(params, obj)
+
+    def action_import(self, obj_id, obj, params, session):
+        # The imp functions are not thread-safe on their own
+        imp.acquire_lock()
+        try:
+            return imp.load_module(params, *imp.find_module(params))
+        finally:
+            imp.release_lock()
+
+    def action_batch(self, obj_id, obj, params, session):
+        # A batch that calls into Nuke at all is run in the main thread
+        # as a whole, rather than hopping there for each call
+        if [op for op in params if self.needs_main_thread(op['action'])]:
+            return self.dispatcher.call(self.run_batch, (params, session))
+        return self.run_batch(params, session)
+
+    def action_exec(self, obj_id, obj, params, session):
+        return self.run_code(params)
+
+    def action_eval(self, obj_id, obj, params, session):
+        return self.run_code({'source': params['expression'], 'variables': params.get('variables')}, 'eval')
+
+    def action_snapshot(self, obj_id, obj, params, session):
+        return self.dispatcher.call(self.snapshot, (), params or {})
+
+    def action_apply_snapshot(self, obj_id, obj, params, session):
+        return self.dispatcher.call(self.apply_snapshot, (params,))
+
+    def action_sample(self, obj_id, obj, params, session):
+        return self.dispatcher.call(self.sample, (obj,), params)
+
+    def action_actions(self, obj_id, obj, params, session):
+        '''
+        List the registered actions, with their descriptions
+        '''
+        result = {}
+        for name, registered in registered_actions.items():
+            result[name] = registered.doc
+        return result
+
+    def action_shutdown(self, obj_id, obj, params, session):
+        # This keyword triggers the server shutdown
+        raise SystemExit
+
+    def snapshot(self, classes = None, pattern = None, selected = None, knobs = None, recurse_groups = False):
+        '''
+        Get the knob values of every node that matches a filter, as plain
+        data. Nodes can be filtered by a list of 'classes', an fnmatch
+        'pattern' for their names, and whether they are 'selected'.
+        Only the knobs named in 'knobs' are included, if it is given.
+
+        Returns a list with a dictionary for each node, with its 'name',
+        'class', 'knobs' (a dictionary of knob values) and 'animated' (a
+        list of the included knobs that are animated).
+        '''
+        if recurse_groups:
+            nodes = nuke.allNodes(recurseGroups = True)
+        else:
+            nodes = nuke.allNodes()
+        result = []
+        for node in nodes:
+            if classes is not None and node.Class() not in classes:
+                continue
+            if hasattr(node, 'fullName'):
+                name = node.fullName()
+            else:
+                name = node.name()
+            if pattern is not None and not fnmatch.fnmatchcase(name, pattern):
+                continue
+            if selected is not None and bool(node.isSelected()) != bool(selected):
+                continue
+
+            node_knobs = node.knobs()
+            if knobs is not None:
+                names = [k for k in knobs if k in node_knobs]
+            else:
+                names = node_knobs.keys()
+            values = {}
+            animated = []
+            for knob_name in names:
+                knob = node_knobs[knob_name]
+                try:
+                    values[knob_name] = knob.value()
+                except Exception:
+                    # Some knobs (such as buttons) have no value
+                    continue
+                if hasattr(knob, 'isAnimated') and knob.isAnimated():
+                    animated.append(knob_name)
+            result.append({'name': name, 'class': node.Class(), 'knobs': values, 'animated': animated})
+        return result
+
+    def apply_snapshot(self, values):
+        '''
+        Set knob values from a dictionary of {node name: {knob name: value}}.
+        Returns a dictionary of {node name: {knob name: error message}} for
+        every value that could not be set, which is empty if all of them were.
+        '''
+        errors = {}
+        for node_name, knob_values in values.items():
+            node = nuke.toNode(node_name)
+            for knob_name, value in knob_values.items():
+                try:
+                    if node is None:
+                        raise NameError("No node named '%s'" % node_name)
+                    knob = node.knobs().get(knob_name)
+                    if knob is None:
+                        raise NameError("No knob named '%s'" % knob_name)
+                    knob.setValue(value)
+                except Exception, e:
+                    errors.setdefault(node_name, {})[knob_name] = str(e)
+        return errors
+
+    def sample(self, node, channels, x = 0, y = 0, width = None, height = None, frame = None):
+        '''
+        Sample a region of a node's image for a list of channels, by
+        default the whole of it.
+        Returns the samples as the raw bytes of an array of 32-bit floats,
+        in rows from the bottom up, with the channels of each pixel
+        together. The 'shape' of the array is (height, width, channels),
+        and the 'byteorder' of this machine is passed along with it.
+        '''
+        if width is None:
+            width = node.width() - x
+        if height is None:
+            height = node.height() - y
+        extra = ()
+        if frame is not None:
+            extra = (1, 1, frame)
+        sample = node.sample
+        samples = array.array('f')
+        append = samples.append
+        for row in xrange(y, y + height):
+            for column in xrange(x, x + width):
+                for channel in channels:
+                    # Sample from the centre of each pixel
+                    append(sample(channel, column + 0.5, row + 0.5, *extra))
+        return {
+            'data': samples.tostring(),
+            'shape': (height, width, len(channels)),
+            'channels': list(channels),
+            'byteorder': sys.byteorder,
+        }
+
+    def iterate(self, obj, params):
+        '''
+        Start iterating over an object, and return the first page of items.
+        If a 'name' is passed, that method of the object is called with
+        any passed 'args' and 'kwargs' first, and its result is iterated
+        over instead, so that the result never has to be sent as a whole.
+        Similarly, if 'call' is passed, the object itself is called first.
+        If it is None, the object is only called if it cannot be iterated
+        over itself, such as a function like nuke.allNodes.
+        The iterator is only passed back to the client if there may be
+        more pages to get from it with the 'next' action.
+        '''
+        call = params.get('call', False)
+        if call is None:
+            call = callable(obj) and not hasattr(obj, '__iter__') and not hasattr(obj, '__getitem__')
+        if params.get('name'):
+            obj = getattr(obj, params['name'])(*params.get('args', ()), **params.get('kwargs', {}))
+        elif call:
+            obj = obj(*params.get('args', ()), **params.get('kwargs', {}))
+        iterator = iter(obj)
+        items = self.next_page(iterator, params['page_size'])
+        if len(items) < params['page_size']:
+            iterator = None
+        return {'items': items, 'iterator': iterator}
+
+    def next_page(self, iterator, page_size):
+        '''
+        Get up to 'page_size' more items from an iterator. Fewer items
+        than that means the iterator is finished.
+        '''
+        return list(itertools.islice(iterator, page_size))
+
+    def needs_main_thread(self, action):
+        '''
+        Check whether an action calls into Nuke, and so has to be
+        performed in the main thread
+        '''
+        if action in MAIN_THREAD_ACTIONS:
+            return True
+        registered = registered_actions.get(action)
+        return registered is not None and registered.main_thread
+
+    def run_batch(self, operations, session = None):
+        '''
+        Perform a list of operations in order, and return a list of
+        their results.
+        Operations can refer to the results of earlier operations in
+        the same batch. An operation that fails has its exception in
+        place of a result, and any later operation that refers to that
+        result fails with the same exception.
+        '''
+        results = []
+        resolve = lambda data: self.resolve_batch_reference(data, results)
+        for operation in operations:
+            try:
+                obj_id = operation['id']
+                if isinstance(obj_id, dict):
+                    obj = resolve(obj_id)
+                else:
+                    obj = self.get_object(obj_id, session)
+                params = self.recode_data(operation['parameters'], resolve)
+                result = self.perform(operation['action'], obj_id, obj, params, session)
+            except Exception, e:
+                result = e
+            results.append(result)
+        return results
+
+    def compile_code(self, source, mode):
+        '''
+        Compile some source sent by a client, reusing the code object if
+        the same source has been sent before
+        '''
+        key = (source, mode)
+        code = self._code_cache.get(key)
+        if code is None:
+            code = compile(source, "<nukeExternalControl>", mode)
+            if len(self._code_cache) >= CODE_CACHE_SIZE:
+                self._code_cache.clear()
+            self._code_cache[key] = code
+        return code
+
+    def run_code(self, params, mode = 'exec'):
+        '''
+        Run source sent by a client in the main thread, in a fresh namespace
+        that contains the nuke module and any variables that were passed.
+        In 'exec' mode, if a function name is passed, the function of that
+        name is then called with the passed arguments and its result is
+        returned. In 'eval' mode, the value of the expression is returned.
+        '''
+        if not self._allow_exec:
+            raise RuntimeError("This server does not allow code to be run remotely")
+        code = self.compile_code(params['source'], mode)
+        namespace = {'__name__': "__nukeExternalControl__", 'nuke': nuke}
+        namespace.update(params.get('variables') or {})
+
+        def run():
+            if mode == 'eval':
+                return eval(code, namespace)
+            exec code in namespace
+            if params.get('name'):
+                return namespace[params['name']](*params.get('args', ()), **params.get('kwargs', {}))
+        return self.dispatcher.call(run)
+
+    def resolve_batch_reference(self, data, results):
+        '''
+        Swap a reference to an earlier result in a batch for that result
+        '''
+        if isinstance(data, dict) and data.get('type') == "NukeTransferBatchReference":
+            result = results[data['index']]
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return data
     
-    def receive(self, data_string):
+    def receive(self, data_string, session = None):
         '''
-        Receive the pickled data that has been sent by the client, and
+        Receive the serialized data that has been sent by the client, and
         do whatever needs to be done with it.
-        If the data is being passed through as a multi-part transfer, store
-        the parts so far and send back a request for the rest.
-        Also, when sending data back, deal with splitting it up into a multi-part
-        message if it is too long.
+        Returns the serialized result to send back. A request that cannot
+        be decoded (for example, one passing an object from another
+        session) is answered with the exception, leaving the session open,
+        and a result that is too large to send is replaced by the
+        exception saying so.
         '''
-        data = self.decode(data_string)
-        
-        if isinstance(data, dict) and 'type' in data and data['type'] == "NukeTransferPartialObjectRequest":
-            if data['part'] in self.partialObjects:
-                encoded = self.partialObjects[data['part']]
-                del self.partialObjects[data['part']]
-                return encoded
-        
-        if isinstance(data, dict) and 'type' in data and data['type'] == "NukeTransferPartialObject":
-            if data['part'] == 0:
-                self.partialData = ""
-            self.partialData += data['data']
-            
-            if data['part'] == (data['part_count'] - 1):
-                data = pickle.loads(self.partialData)
+        # The reply is always encoded the same way as the request, even if
+        # the request changed the serializer for the rest of the session
+        serializer = SERIALIZERS[DEFAULT_SERIALIZER]
+        if session is not None:
+            serializer = session.serializer
+        try:
+            if self.instrumentation is not None:
+                encoded = self.receive_instrumented(data_string, session, serializer)
             else:
-                nextPart = data['part'] + 1
-                return pickle.dumps({'type': "NukeTransferPartialObjectRequest", 'part': nextPart})
-            
-        encoded = self.encode(self.get(data))
-        
-        if len(encoded) > MAX_SOCKET_BYTES:
-            encodedBits = []
-            while encoded:
-                encodedBits.append(encoded[:MAX_SOCKET_BYTES])
-                encoded = encoded[MAX_SOCKET_BYTES:]
-            
-            self.partialObjects = {}
-            for i in range(len(encodedBits)):
-                self.partialObjects[i] = pickle.dumps({'type': "NukeTransferPartialObject", 'part': i, 'part_count': len(encodedBits), 'data': encodedBits[i]})
-            
-            encoded = self.partialObjects[0]
-            del self.partialObjects[0]
+                data = self.decode(data_string, session)
+                encoded = self.encode(self.get(data, session), session, serializer)
+        except Exception, e:
+            encoded = self.encode_exception(e, session, serializer)
+
+        if len(encoded) > self.max_message_size:
+            encoded = self.encode(NukeMessageSizeError("Result of %d bytes exceeds the maximum message size of %d bytes" % (len(encoded), self.max_message_size)), session, serializer)
 
         return encoded
 
-        
-    def get_object(self, id):
+    def encode_exception(self, e, session = None, serializer = None):
+        '''
+        Encode an exception to send back in place of a result. An exception
+        that cannot itself be encoded is sent as a RuntimeError describing
+        it instead.
+        '''
+        try:
+            return self.encode(e, session, serializer)
+        except Exception:
+            return self.encode(RuntimeError("%s: %s" % (type(e).__name__, e)), session, serializer)
+
+    def receive_instrumented(self, data_string, session, serializer):
+        '''
+        The same as receive, but timing each step and recording it
+        '''
+        start = time.time()
+        if serializer.persistent_ids:
+            data = self.load_request(serializer, data_string, session)
+        else:
+            data = serializer.loads(data_string)
+        loaded = time.time()
+        if not serializer.persistent_ids:
+            data = self.decode_request(data, session)
+        decoded = time.time()
+        result = self.get(data, session)
+        performed = time.time()
+        if not serializer.persistent_ids:
+            result = self.encode_data(result, session)
+        recoded = time.time()
+        encoded = serializer.dumps(result)
+        finished = time.time()
+
+        action = None
+        if isinstance(data, dict):
+            action = data.get('action')
+        self.instrumentation.record(action, finished - start, len(data_string), len(encoded),
+                                    serialize = (loaded - start) + (finished - recoded),
+                                    recode = (decoded - loaded) + (recoded - performed),
+                                    perform = performed - decoded)
+        return encoded
+
+    def schema_key(self, obj):
+        '''
+        Get the key that identifies the schema for an object.
+        Modules each have their own schema, and everything else shares
+        the schema of its type.
+        '''
+        if isinstance(obj, types.ModuleType):
+            return "module:%s" % obj.__name__
+        cls = type(obj)
+        return "%s.%s" % (cls.__module__, cls.__name__)
+
+    def schema(self, obj, session = None):
+        '''
+        Describe the attributes of an object that the client can deal with
+        without asking the server about them each time: which of them are
+        methods or functions, and for modules, the values of any constants
+        (upper case names with simple values).
+        Schemas are worked out once per session, as the client keeps them
+        for the rest of the session anyway. Anything added to a module, or
+        any constant changed, after that is only seen by later sessions.
+        '''
+        if session is None:
+            session = self._default_session
+        key = self.schema_key(obj)
+        schema = session.schemas.get(key)
+        if schema is not None:
+            return schema
+
+        if isinstance(obj, types.ModuleType):
+            source = obj
+        else:
+            source = type(obj)
+        callables = []
+        constants = {}
+        for name in dir(source):
+            if name.startswith('__'):
+                continue
+            try:
+                value = getattr(source, name)
+            except Exception:
+                continue
+            if inspect.isroutine(value):
+                callables.append(name)
+            elif source is obj and name.isupper() and type(value) in constantTypes:
+                constants[name] = value
+
+        schema = {'key': key, 'callables': callables, 'constants': constants}
+        session.schemas[key] = schema
+        return schema
+
+    def global_schemas(self, namespace, names, session = None):
+        '''
+        Get every module in the globals, along with the schemas of those
+        named in 'names', so that a client can find them all up front
+        '''
+        modules = {}
+        for name, value in namespace.items():
+            if isinstance(value, types.ModuleType):
+                modules[name] = value
+        schemas = {}
+        for name in names or ():
+            if name in modules:
+                schema = self.schema(modules[name], session)
+                schemas[schema['key']] = schema
+        return {'modules': modules, 'schemas': schemas}
+
+    def release_objects(self, object_ids, session = None):
+        '''
+        Release stored objects that the client no longer needs
+        '''
+        if session is None:
+            session = self._default_session
+        session.release_objects(object_ids)
+
+    def stats(self, session = None):
+        '''
+        Get a dictionary of statistics about the server
+        '''
+        if session is None:
+            session = self._default_session
+        self._sessions_lock.acquire()
+        try:
+            sessions = list(self._sessions)
+        finally:
+            self._sessions_lock.release()
+        return {
+            'handles': session.object_count(),
+            'sessions': len(sessions),
+            'server_handles': sum([s.object_count() for s in sessions]) + self._default_session.object_count(),
+            'memory': process_memory(),
+            'instrumentation': self.instrumentation and self.instrumentation.snapshot(),
+        }
+
+    def get_object(self, id, session = None):
         '''
         Get the stored object with the appropriate id.
         If the id is -1, then get the globals
         '''
         if id == -1:
             return globals()
-        else:
-            return self._objects[id]
+        if session is None:
+            session = self._default_session
+        return session.get_object(id)
 
 
 class NukeManagedServer(NukeInternal):
@@ -283,12 +1440,15 @@ class NukeManagedServer(NukeInternal):
     server loop is started, it sends a status "packet" to the
     manager on 'manager_port,' which informs the manager whether
     the server has successfully bound itself to a port, and
-    which port it is using.
+    which port it is using, along with when the server started
+    ('start_time', if it is passed) and bound its port.
     '''
-    def __init__(self, port=None, manager_port=None, manager_host='localhost'):
+    def __init__(self, port=None, manager_port=None, manager_host='localhost', start_time=None):
         self.manager_port = manager_port
         self.manager_host = manager_host
-        NukeInternal.__init__(self, port, VERIFY_CONNECTION_NONE)
+        self.start_time = start_time
+        # Managed servers always run in a terminal instance of Nuke
+        NukeInternal.__init__(self, port, VERIFY_CONNECTION_NONE, direct_calls = True)
 
     def start_server(self, socket):
         '''
@@ -311,11 +1471,140 @@ class NukeManagedServer(NukeInternal):
             return
         manager = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         manager.connect((self.manager_host, self.manager_port))
-        manager.send(self.encode((status, self.port)))
+        timeline = {}
+        if self.start_time is not None:
+            timeline['interpreter_up'] = self.start_time
+        if status:
+            timeline['port_bound'] = self.bound_time
+        send_message(manager, self.encode((status, self.port, timeline)))
         manager.close()
         if not status:
             raise NukeConnectionError("Cannot find port to bind to")
 
 
+class NukeZygoteServer(object):
+    '''
+    Runs in a terminal instance of Nuke, and forks a NukeManagedServer off
+    for each request sent to it by a NukeZygote. Each forked server calls
+    back to the manager named in the request, exactly as if it had been
+    started from scratch.
+
+    Once it has imported the modules in 'preload' and is ready to take
+    requests, the zygote calls back to its own manager on 'manager_port'
+    with the port it is listening on for them.
+
+    Forked servers that exit are collected straight away, and managers can
+    ask for their exit codes with a 'status' request.
+    '''
+    def __init__(self, manager_port=None, manager_host='localhost', preload=()):
+        if not hasattr(os, 'fork'):
+            raise NukeServerError("Forking servers is not supported on this platform")
+        for module_name in preload:
+            __import__(module_name)
+        self._children = set()
+        self._exit_codes = collections.OrderedDict()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('localhost', 0))
+        sock.listen(5)
+        self.port = sock.getsockname()[1]
+        if manager_port:
+            manager = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            manager.connect((manager_host, manager_port))
+            send_message(manager, pickle.dumps((True, self.port)))
+            manager.close()
+        self.serve(sock)
+
+    def serve(self, sock):
+        '''
+        Handle requests one at a time, until asked to shut down
+        '''
+        try:
+            while 1:
+                try:
+                    readable = select.select([sock], [], [], ZYGOTE_REAP_INTERVAL)[0]
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+                self.reap_children()
+                if not readable:
+                    continue
+                client, address = sock.accept()
+                try:
+                    data = recv_message(client)
+                    if data is None:
+                        continue
+                    request = pickle.loads(data)
+                    if request['action'] == "shutdown":
+                        send_message(client, pickle.dumps(True))
+                        break
+                    try:
+                        if request['action'] == "fork":
+                            result = self.fork(request, [sock, client])
+                        elif request['action'] == "status":
+                            result = self.exit_code(request['pid'])
+                        else:
+                            raise ValueError("Unknown zygote action '%s'" % request['action'])
+                    except Exception, e:
+                        result = e
+                    send_message(client, pickle.dumps(result))
+                finally:
+                    client.close()
+        finally:
+            sock.close()
+
+    def fork(self, request, sockets):
+        '''
+        Fork a managed server, and return its process ID
+        '''
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return pid
+
+        # This is the forked server, which must never return into the
+        # zygote's request loop
+        status = 0
+        try:
+            try:
+                for s in sockets:
+                    s.close()
+                NukeManagedServer(manager_port = request['manager_port'], manager_host = request['manager_host'], start_time = time.time())
+            except SystemExit, e:
+                if isinstance(e.code, int):
+                    status = e.code
+            except:
+                traceback.print_exc()
+                status = 1
+        finally:
+            os._exit(status)
+
+    def reap_children(self):
+        '''
+        Collect the exit status of any forked servers that have exited
+        '''
+        for pid in list(self._children):
+            try:
+                finished, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                finished, status = pid, 0
+            if finished:
+                self._children.discard(pid)
+                # Exit codes are given in the same way as subprocess does
+                if os.WIFSIGNALED(status):
+                    self._exit_codes[pid] = -os.WTERMSIG(status)
+                else:
+                    self._exit_codes[pid] = os.WEXITSTATUS(status)
+                while len(self._exit_codes) > ZYGOTE_EXIT_CODES:
+                    self._exit_codes.popitem(last = False)
+
+    def exit_code(self, pid):
+        '''
+        Get the exit code of a forked server, or None if it is still running
+        '''
+        self.reap_children()
+        return self._exit_codes.get(pid)
+
 if __name__ == '__main__':
     NukeInternal()
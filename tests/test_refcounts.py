@@ -0,0 +1,178 @@
+'''
+Checks that objects passed to clients are released on the server once the
+client has dropped its proxies for them, in each of the ways a connection
+can pass objects, by running a command server against the stub 'nuke'
+module used by the benchmarks.
+
+Run from the directory containing the nukeExternalControl package:
+
+    python -m unittest discover tests
+'''
+
+import gc
+import unittest
+
+from benchmarks import harness
+from nukeExternalControl import client
+from nukeExternalControl import server
+
+
+# Python 2 list comprehensions leave their variable behind, holding on to
+# the last proxy, so these use map() instead
+def node_name(node):
+    return node.name()
+
+class Value(object):
+    '''
+    An object that compares and hashes by its value, which can change
+    '''
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, Value) and self.value == other.value
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.value)
+
+class ObjectKeyTests(unittest.TestCase):
+    def setUp(self):
+        self.session = server.NukeSession(None, None)
+
+    def test_equal_nodes_share_an_id(self):
+        node = harness.nuke.Node("Blur", "Blur1")
+        object_id = self.session.add_object(node)
+        self.assertEqual(self.session.add_object(harness.nuke.Node(state=node._state)), object_id)
+        self.session.release_objects([(object_id, 2)])
+        self.assertEqual(self.session.object_count(), 0)
+
+    def test_equal_objects_get_their_own_ids(self):
+        first, second = Value(1), Value(1)
+        first_id = self.session.add_object(first)
+        second_id = self.session.add_object(second)
+        self.assertNotEqual(first_id, second_id)
+        self.assertTrue(self.session.get_object(second_id) is second)
+        first.value = 2
+        self.session.release_objects([first_id, second_id])
+        self.assertEqual(self.session.object_count(), 0)
+
+class RefcountTests(unittest.TestCase):
+    connection_class = client.NukeConnection
+    connection_args = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.port = harness.start_server()
+
+    @classmethod
+    def tearDownClass(cls):
+        harness.stop_server(cls.port)
+
+    def setUp(self):
+        self.conn = self.connection_class(self.port, **self.connection_args)
+        self.nuke = self.conn.nuke
+        self.nuke.scriptClear()
+        for i in xrange(5):
+            self.nuke.createNode("Blur")
+        self.baseline = self.handles()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def handles(self):
+        gc.collect()
+        # A NukeAsyncConnection's reader thread can hold on to the last
+        # future it finished for a moment, but is done with it by the
+        # time the next reply arrives
+        self.conn.get("test")
+        gc.collect()
+        return self.conn.server_stats()['handles']
+
+    def test_dropped_proxies_are_released(self):
+        nodes = self.nuke.allNodes()
+        names = map(node_name, nodes)
+        self.assertEqual(len(names), 5)
+        self.assertTrue(self.handles() > self.baseline)
+        del nodes
+        self.assertEqual(self.handles(), self.baseline)
+
+    def test_same_node_shares_one_handle(self):
+        nodes = [self.nuke.toNode("Blur1") for i in xrange(20)]
+        self.assertTrue(nodes[0] is nodes[-1])
+        self.assertEqual(self.handles(), self.baseline + 1)
+        del nodes
+        self.assertEqual(self.handles(), self.baseline)
+
+    def test_proxies_passed_back_are_released(self):
+        node = self.nuke.toNode("Blur2")
+        for i in xrange(10):
+            self.assertEqual(self.nuke.toNode(node.name()).name(), "Blur2")
+        del node
+        self.assertEqual(self.handles(), self.baseline)
+
+    def test_ids_are_not_shared_between_sessions(self):
+        node = self.nuke.toNode("Blur1")
+        self.conn.close()
+        self.assertRaises(KeyError, node_name, node)
+        del node
+        self.nuke = self.conn.nuke
+        self.assertEqual(self.handles(), self.baseline)
+
+    def test_proxy_from_another_session_is_refused(self):
+        other = self.connection_class(self.port, **self.connection_args)
+        try:
+            stale = other.nuke.toNode("Blur1")
+            node = self.nuke.toNode("Blur2")
+            self.assertRaises(KeyError, self.nuke.delete, stale)
+            self.assertEqual(node.name(), "Blur2")
+            del stale, node
+        finally:
+            other.close()
+        self.assertEqual(self.handles(), self.baseline)
+
+    def test_requests_that_fail_to_decode_still_release(self):
+        delete = self.nuke.delete
+        node = self.nuke.toNode("Blur1")
+        del node
+        self.assertRaises(KeyError, delete, client.NukeObject(self.conn, 999999))
+        del delete
+        self.assertEqual(self.handles(), self.baseline)
+
+    def test_wrapped_objects_in_a_batch(self):
+        node = self.nuke.toNode("Blur3")
+        batch = self.conn.batch()
+        batch.nuke.delete(batch.wrap(node))
+        batch.run()
+        del node, batch
+        self.assertEqual(len(self.nuke.allNodes()), 4)
+        self.assertEqual(self.handles(), self.baseline)
+
+class LegacyRecodeRefcountTests(RefcountTests):
+    connection_args = {'persistent_ids': False}
+
+class AsyncRefcountTests(RefcountTests):
+    connection_class = client.NukeAsyncConnection
+
+    def test_requests_in_flight_are_released(self):
+        futures = [self.conn.call_async(self.nuke.toNode, "Blur%d" % (i % 5 + 1)) for i in xrange(50)]
+        nodes = map(lambda future: future.result(10), futures)
+        self.assertEqual(len(set(map(node_name, nodes))), 5)
+        self.assertEqual(self.handles(), self.baseline + 5)
+        del futures, nodes
+        self.assertEqual(self.handles(), self.baseline)
+
+    def test_requests_that_fail_to_decode_are_answered(self):
+        stale = client.NukeObject(self.conn, 999999)
+        futures = [self.conn.call_async(self.nuke.delete, stale) for i in xrange(20)]
+        for future in futures:
+            self.assertTrue(isinstance(future.exception(10), KeyError))
+        del stale, futures
+        self.assertEqual(self.conn.call_async(self.nuke.toNode, "Blur1").result(10).name(), "Blur1")
+        self.assertEqual(self.handles(), self.baseline)
+
+
+if __name__ == '__main__':
+    unittest.main()